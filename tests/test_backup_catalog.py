@@ -0,0 +1,171 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+from backup_catalog import BackupCatalog, CatalogError, parseRetention, selectRetained
+from chunk_store import ChunkStore
+
+
+# Sunday 31 March 2024, noon local time; runs are counted back from here
+LAST = datetime.datetime(2024, 3, 31, 12)
+
+
+def _at(days_ago, hours=0):
+    return (LAST - datetime.timedelta(days=days_ago, hours=hours)).timestamp()
+
+
+def _daily_runs(days):
+    """(id, started) pairs, newest first: run i is i days before LAST."""
+    return [(day, _at(day)) for day in range(days)]
+
+
+def _file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+
+def _record(catalog, run_id, started, outputs=(), status='ok'):
+    stages = {'archive': {'status': status, 'seconds': 1.0, 'outputs': [dict(output) for output in outputs]}}
+    return catalog.record(run_id, 'site', started, 1.0, status, stages)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with BackupCatalog(str(tmp_path / 'catalog.sqlite')) as catalog:
+        yield catalog
+
+
+def test_parse_retention():
+    assert parseRetention('daily=7, weekly=4') == {'daily': 7, 'weekly': 4, 'monthly': 0, 'yearly': 0}
+    assert parseRetention('') is None
+    with pytest.raises(CatalogError):
+        parseRetention('hourly=3')
+
+
+def test_select_retained_keeps_the_newest_run_of_each_period():
+    runs = _daily_runs(100)
+
+    assert selectRetained(runs, daily=3) == {0, 1, 2}
+    # Newest run of this ISO week (Sunday 31 March) and of the week before (Sunday 24 March)
+    assert selectRetained(runs, weekly=2) == {0, 7}
+    # Newest of March, then 29 February
+    assert selectRetained(runs, monthly=2) == {0, 31}
+    assert selectRetained(runs, daily=2, weekly=2, monthly=2) == {0, 1, 7, 31}
+    assert selectRetained(runs) == set()
+
+
+def test_select_retained_takes_the_newest_run_of_a_day():
+    runs = [(1, _at(0)), (2, _at(0, hours=3)), (3, _at(1)), (4, _at(1, hours=3))]
+    assert selectRetained(runs, daily=2) == {1, 3}
+
+
+def test_retained_keeps_the_newest_good_run_and_later_failures(catalog):
+    old_failure = _record(catalog, 'failed-old', _at(5), status='failed')
+    good = _record(catalog, 'good', _at(4))
+    new_failure = _record(catalog, 'failed-new', _at(1), status='failed')
+
+    kept = catalog.retained('site', daily=0, weekly=0, monthly=0)
+
+    assert kept == {good, new_failure}
+    assert old_failure not in kept
+
+
+def test_retained_keeps_the_whole_chain_of_a_kept_increment(catalog):
+    chain = []
+    for day, name in ((6, 'full'), (5, 'inc-1'), (4, 'inc-2')):
+        chain.append(_record(catalog, name, _at(day), [{'kind': 'file', 'path': f'/b/{name}.tar', 'chain': 'full'}]))
+    other_full = _record(catalog, 'other-full', _at(8), [{'kind': 'file', 'path': '/b/other.tar', 'chain': 'other'}])
+
+    kept = catalog.retained('site', daily=1, weekly=0, monthly=0)
+
+    assert kept == set(chain)
+    assert other_full not in kept
+
+
+def test_prune_removes_expired_files_with_their_sidecars(catalog, tmp_path):
+    paths = {}
+    for day in range(4):
+        paths[day] = _file(tmp_path / f'site-{day}.tar.gz', 100 + day)
+        _file(tmp_path / f'site-{day}.tar.gz.sha256', 10)
+        _record(catalog, f'run-{day}', _at(day), [{'kind': 'file', 'path': paths[day], 'size': 100 + day,
+                                                   'algorithm': 'sha256'}])
+
+    summary = catalog.prune('site', daily=2, weekly=0, monthly=0)
+
+    assert summary == {'runs': 2, 'files': 2, 'chunks': 0, 'bytes': 102 + 103, 'kept': 2}
+    assert os.path.exists(paths[0]) and os.path.exists(paths[1])
+    assert not os.path.exists(paths[2]) and not os.path.exists(paths[3])
+    assert not os.path.exists(paths[3] + '.sha256')
+    assert [run['run_id'] for run in catalog.runs('site')] == ['run-0', 'run-1']
+
+
+def test_prune_dry_run_changes_nothing(catalog, tmp_path):
+    paths = [_file(tmp_path / f'{day}.sql', 50) for day in range(3)]
+    for day, path in enumerate(paths):
+        _record(catalog, f'run-{day}', _at(day), [{'kind': 'file', 'path': path}])
+
+    summary = catalog.prune('site', daily=1, weekly=0, monthly=0, dry_run=True)
+
+    assert summary == {'runs': 2, 'files': 2, 'chunks': 0, 'bytes': 100, 'kept': 1}
+    assert all(os.path.exists(path) for path in paths)
+    assert len(catalog.runs('site')) == 3
+
+
+def test_prune_keeps_a_path_a_kept_run_still_records(catalog, tmp_path):
+    shared = _file(tmp_path / 'site.tar.gz', 100)
+    own = _file(tmp_path / 'db-old.sql', 40)
+    _record(catalog, 'old', _at(3), [{'kind': 'file', 'path': shared}, {'kind': 'file', 'path': own}])
+    _record(catalog, 'new', _at(0), [{'kind': 'file', 'path': shared}])
+
+    summary = catalog.prune('site', daily=1, weekly=0, monthly=0)
+
+    assert summary['runs'] == 1 and summary['files'] == 1 and summary['bytes'] == 40
+    assert os.path.exists(shared)
+    assert not os.path.exists(own)
+
+
+def test_prune_keeps_every_archive_of_a_kept_chain(catalog, tmp_path):
+    paths = []
+    for day, name in ((9, 'stale'), (6, 'full'), (5, 'inc-1'), (4, 'inc-2')):
+        paths.append(_file(tmp_path / f'{name}.tar', 10))
+        _record(catalog, name, _at(day), [{'kind': 'file', 'path': paths[-1], 'chain': 'old' if name == 'stale' else 'full'}])
+
+    summary = catalog.prune('site', daily=1, weekly=0, monthly=0)
+
+    assert summary['runs'] == 1 and summary['kept'] == 3
+    assert not os.path.exists(paths[0])
+    assert all(os.path.exists(path) for path in paths[1:])
+
+
+def test_prune_frees_the_chunks_only_expired_manifests_used(catalog, tmp_path):
+    root = str(tmp_path / 'store')
+    shared, dropped = os.urandom(256 * 1024), os.urandom(256 * 1024)
+
+    with ChunkStore(root, avg_chunk_size=16 * 1024, min_chunk_size=4 * 1024, max_chunk_size=64 * 1024) as store:
+        for day, data in ((1, shared + dropped), (0, shared)):
+            with store.writer('db.sql') as writer:
+                writer.write(data)
+            _record(catalog, f'run-{day}', _at(day), [{'kind': 'chunk_store', 'path': writer.manifest_path, 'size': len(data)}])
+        chunks_before = store.stats()['stored_bytes']
+
+    # Past the grace period that protects chunks of backups still being written
+    for directory, _, files in os.walk(os.path.join(root, 'chunks')):
+        for file_name in files:
+            os.utime(os.path.join(directory, file_name), (_at(2), _at(2)))
+
+    preview = catalog.prune('site', daily=1, weekly=0, monthly=0, dry_run=True)
+    summary = catalog.prune('site', daily=1, weekly=0, monthly=0)
+
+    with ChunkStore(root) as store:
+        chunks_after = store.stats()['stored_bytes']
+        assert b"".join(store.read(store.latestManifest('db.sql'))) == shared
+
+    assert summary == preview
+    assert summary['chunks'] > 0
+    assert chunks_before - chunks_after >= len(dropped) * 0.9
+    assert summary['bytes'] > chunks_before - chunks_after
@@ -0,0 +1,108 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+from chunk_store import ChunkStore
+from encryption import BackupCipher, EncryptionError
+
+
+def _dump(rng, rows, line_size=256 * 1024):
+    """mysqldump-like SQL: extended INSERT lines far longer than the chunks, with no newline inside them."""
+
+    lines, values, size = [b"CREATE TABLE t (id int, name varchar(16), note text);\n"], [], 0
+    for row in range(rows):
+        value = b"(%d,'%s','%s')" % (row, rng.choice([b'alice', b'bob', b'carol']), rng.randbytes(24).hex().encode())
+        values.append(value)
+        size += len(value)
+        if size >= line_size:
+            lines.append(b"INSERT INTO t VALUES " + b",".join(values) + b";\n")
+            values, size = [], 0
+    lines.append(b"INSERT INTO t VALUES " + b",".join(values) + b";\n")
+    return b"".join(lines)
+
+
+def _ingest(store, data, block_size):
+    with store.writer('db.sql') as writer:
+        for offset in range(0, len(data), block_size):
+            writer.write(data[offset:offset + block_size])
+    return writer
+
+
+def test_edit_in_the_middle_of_a_dump_reuses_most_chunks(tmp_path):
+    data = _dump(random.Random(1), 60000)
+    middle = len(data) // 2
+    edited = data[:middle] + b"(999999,'zed','inserted row')," * 10 + data[middle:]
+
+    with ChunkStore(str(tmp_path), avg_chunk_size=64 * 1024, min_chunk_size=16 * 1024, max_chunk_size=256 * 1024) as store:
+        first = _ingest(store, data, 100 * 1024)
+        second = _ingest(store, edited, 100 * 1024)
+
+        known = {digest for digest, _ in first.manifest['chunks']}
+        reused = [digest for digest, _ in second.manifest['chunks'] if digest in known]
+
+        assert len(first.manifest['chunks']) > 20
+        assert len(reused) >= len(second.manifest['chunks']) - 3
+        assert second.new_bytes < first.new_bytes / 5
+        assert b"".join(store.read(second.manifest_path)) == edited
+
+
+def test_boundaries_do_not_depend_on_write_sizes(tmp_path):
+    data = random.Random(2).randbytes(3 * 1024 * 1024)
+
+    with ChunkStore(str(tmp_path), avg_chunk_size=64 * 1024, min_chunk_size=16 * 1024, max_chunk_size=256 * 1024) as store:
+        large = _ingest(store, data, 1024 * 1024)
+        small = _ingest(store, data, 4093)
+
+    assert large.manifest['chunks'] == small.manifest['chunks']
+
+
+def test_encrypted_store_deduplicates_without_keeping_plaintext(tmp_path):
+    data = random.Random(3).randbytes(2 * 1024 * 1024)
+    cipher = BackupCipher(os.urandom(32))
+    manifests = []
+    options = dict(avg_chunk_size=64 * 1024, min_chunk_size=16 * 1024, max_chunk_size=256 * 1024)
+
+    with ChunkStore(str(tmp_path / 'store'), cipher=cipher, **options) as store:
+        for run in range(2):
+            # Every run seals the same data under a fresh file key, so the ciphertext never repeats
+            with open(tmp_path / 'db.sql.enc', 'wb') as raw, cipher.writer(raw) as writer:
+                writer.write(data)
+            manifests.append(store.ingestFile('db.sql', str(tmp_path / 'db.sql.enc')))
+
+        assert manifests[0]['chunks'] == manifests[1]['chunks']
+        assert store.stats()['stored_bytes'] < len(data) * 1.01
+        assert b"".join(store.read(store.latestManifest('db.sql'))) == data
+
+    # Random data does not compress, so an unsealed chunk would hold these bytes verbatim
+    for directory, _, files in os.walk(tmp_path / 'store' / 'chunks'):
+        for file_name in files:
+            with open(os.path.join(directory, file_name), 'rb') as f:
+                assert data[:64] not in f.read()
+
+    with ChunkStore(str(tmp_path / 'store'), **options) as store:
+        with pytest.raises(EncryptionError):
+            list(store.read(store.latestManifest('db.sql')))
+
+
+def test_collect_frees_only_chunks_no_manifest_uses(tmp_path):
+    rng = random.Random(4)
+    shared, dropped = rng.randbytes(512 * 1024), rng.randbytes(512 * 1024)
+
+    with ChunkStore(str(tmp_path), avg_chunk_size=64 * 1024, min_chunk_size=16 * 1024, max_chunk_size=256 * 1024) as store:
+        old = _ingest(store, shared + dropped, 64 * 1024)
+        kept = _ingest(store, shared, 64 * 1024)
+        os.remove(old.manifest_path)
+
+        # Chunks this recent may belong to a manifest that is still being written
+        assert store.collect()['chunks'] == 0
+
+        would = store.collect(grace=0, dry_run=True)
+        freed = store.collect(grace=0)
+
+        assert freed == would and freed['chunks'] > 0
+        assert store.stats()['chunks'] == len({digest for digest, _ in kept.manifest['chunks']})
+        assert b"".join(store.read(kept.manifest_path)) == shared
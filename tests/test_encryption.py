@@ -0,0 +1,128 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+from encryption import HEADER, TAG_SIZE, BackupCipher, EncryptionError, plaintextSize
+
+
+SEGMENT = 1024
+SEALED_SEGMENT = SEGMENT + TAG_SIZE
+
+
+@pytest.fixture(params=['aes-256-gcm', 'chacha20-poly1305'])
+def cipher(request):
+    return BackupCipher(os.urandom(32), request.param, segment_size=SEGMENT)
+
+
+def _encrypt(cipher, data, write_size=333):
+    output = io.BytesIO()
+    with cipher.writer(output) as writer:
+        for start in range(0, len(data), write_size):
+            writer.write(data[start:start + write_size])
+    return output.getvalue()
+
+
+def _decrypt(cipher, sealed):
+    with io.BufferedReader(cipher.reader(io.BytesIO(sealed))) as reader:
+        return reader.read()
+
+
+def _segments(sealed):
+    """Header and the sealed segments of an encrypted file."""
+    body = sealed[HEADER.size:]
+    return sealed[:HEADER.size], [body[start:start + SEALED_SEGMENT] for start in range(0, len(body), SEALED_SEGMENT)]
+
+
+@pytest.mark.parametrize('size', [0, 1, SEGMENT - 1, SEGMENT, 3 * SEGMENT, 3 * SEGMENT + 5])
+def test_round_trip(cipher, size):
+    data = os.urandom(size)
+    assert _decrypt(cipher, _encrypt(cipher, data)) == data
+
+
+def test_files_round_trip_and_report_their_plaintext_size(cipher, tmp_path):
+    for size in (0, SEGMENT, 5 * SEGMENT + 17):
+        source, sealed, opened = tmp_path / f'{size}.sql', tmp_path / f'{size}.sql.enc', tmp_path / f'{size}.out'
+        source.write_bytes(os.urandom(size))
+
+        assert cipher.encryptFile(str(source), str(sealed), block_size=700) == size
+        assert plaintextSize(str(sealed)) == size
+        assert cipher.decryptFile(str(sealed), str(opened)) == size
+        assert opened.read_bytes() == source.read_bytes()
+
+
+def test_plaintext_size_rejects_files_that_are_not_encrypted(tmp_path):
+    path = tmp_path / 'plain.sql'
+    path.write_bytes(b'-- MySQL dump\n' * 10)
+    with pytest.raises(EncryptionError):
+        plaintextSize(str(path))
+
+
+def test_a_missing_last_segment_is_detected(cipher):
+    sealed = _encrypt(cipher, os.urandom(3 * SEGMENT + 5))
+    header, segments = _segments(sealed)
+
+    # Cut off at a segment boundary, so every remaining segment still authenticates on its own
+    with pytest.raises(EncryptionError):
+        _decrypt(cipher, header + b''.join(segments[:-1]))
+
+
+def test_data_cut_off_inside_a_segment_is_detected(cipher):
+    sealed = _encrypt(cipher, os.urandom(3 * SEGMENT))
+    with pytest.raises(EncryptionError):
+        _decrypt(cipher, sealed[:-7])
+    with pytest.raises(EncryptionError):
+        _decrypt(cipher, sealed[:HEADER.size + 10])
+
+
+def test_a_tampered_segment_is_detected(cipher):
+    sealed = bytearray(_encrypt(cipher, os.urandom(3 * SEGMENT)))
+    sealed[HEADER.size + SEALED_SEGMENT + 100] ^= 0x01
+
+    with pytest.raises(EncryptionError, match='Segment 1'):
+        _decrypt(cipher, bytes(sealed))
+
+
+def test_reordered_segments_are_detected(cipher):
+    header, segments = _segments(_encrypt(cipher, os.urandom(3 * SEGMENT + 5)))
+    segments[0], segments[1] = segments[1], segments[0]
+
+    with pytest.raises(EncryptionError):
+        _decrypt(cipher, header + b''.join(segments))
+
+
+def test_segments_of_another_file_are_rejected(cipher):
+    data = os.urandom(2 * SEGMENT + 5)
+    first_header, first = _segments(_encrypt(cipher, data))
+    _, second = _segments(_encrypt(cipher, data))
+
+    # Same key and plaintext, but every file has its own salt and nonce prefix
+    with pytest.raises(EncryptionError):
+        _decrypt(cipher, first_header + first[0] + second[1] + first[2])
+
+
+def test_another_key_cannot_decrypt(cipher):
+    sealed = _encrypt(cipher, b'secret' * 100)
+    other = BackupCipher(os.urandom(32), cipher.algorithm, segment_size=SEGMENT)
+    with pytest.raises(EncryptionError):
+        _decrypt(other, sealed)
+
+
+def test_chunks_open_only_under_their_own_id(cipher):
+    data, other = os.urandom(4096), os.urandom(4096)
+    chunk_id = cipher.chunkId(data)
+
+    assert cipher.chunkId(data) == chunk_id and cipher.chunkId(other) != chunk_id
+    sealed = cipher.sealChunk(chunk_id, data)
+    assert data not in sealed
+    assert cipher.openChunk(chunk_id, sealed) == data
+
+    with pytest.raises(EncryptionError):
+        cipher.openChunk(cipher.chunkId(other), sealed)
+    tampered = bytearray(sealed)
+    tampered[-1] ^= 0x01
+    with pytest.raises(EncryptionError):
+        cipher.openChunk(chunk_id, bytes(tampered))
@@ -0,0 +1,127 @@
+import datetime
+import os
+import sys
+from ftplib import error_perm
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+from ftp_manager import FTP, FTPEntry, _parseListLine, _parseMlsdEntry
+
+
+def _utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def test_mlsd_entry_types_sizes_and_times():
+    assert _parseMlsdEntry('index.php', {'type': 'file', 'size': '1234', 'modify': '20240131120005'}) == \
+        FTPEntry('index.php', 'file', 1234, _utc(2024, 1, 31, 12, 0, 5))
+    # Sizes of directories are not file sizes, and fractional seconds are ignored
+    assert _parseMlsdEntry('uploads', {'type': 'dir', 'sizd': '4096', 'modify': '20240131120005.123'}) == \
+        FTPEntry('uploads', 'dir', None, _utc(2024, 1, 31, 12, 0, 5))
+    assert _parseMlsdEntry('current', {'type': 'OS.unix=symlink'}).type == 'link'
+    assert _parseMlsdEntry('odd', {'type': 'OS.unix=chr'}).type == 'file'
+
+
+def test_mlsd_entry_skips_the_directory_itself_and_its_parent():
+    assert _parseMlsdEntry('.', {'type': 'cdir'}) is None
+    assert _parseMlsdEntry('..', {'type': 'pdir'}) is None
+    assert _parseMlsdEntry('..', {'type': 'dir'}) is None
+
+
+def test_mlsd_entry_tolerates_missing_and_bad_facts():
+    assert _parseMlsdEntry('a.txt', {}) == FTPEntry('a.txt', 'file', None, None)
+    assert _parseMlsdEntry('a.txt', {'type': 'file', 'modify': 'yesterday'}).mtime is None
+
+
+def test_unix_list_lines():
+    assert _parseListLine('-rw-r--r--    1 web  web     10240 Jan 31  2023 wp-config.php') == \
+        FTPEntry('wp-config.php', 'file', 10240, _utc(2023, 1, 31))
+    assert _parseListLine('drwxr-xr-x    2 web  web      4096 Mar  5  2022 wp content') == \
+        FTPEntry('wp content', 'dir', None, _utc(2022, 3, 5))
+    assert _parseListLine('lrwxrwxrwx    1 web  web        11 Mar  5  2022 current -> releases/42') == \
+        FTPEntry('current', 'link', None, _utc(2022, 3, 5))
+    assert _parseListLine('drwxr-xr-x    2 web  web      4096 Mar  5  2022 .') is None
+
+
+def test_unix_list_lines_without_a_year_are_not_in_the_future():
+    entry = _parseListLine('-rw-r--r--    1 web  web       100 Jan  1 00:00 new.txt')
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    assert entry.size == 100
+    modified = datetime.datetime.fromtimestamp(entry.mtime, datetime.timezone.utc)
+    assert (modified.month, modified.day, modified.hour) == (1, 1, 0)
+    assert modified <= now + datetime.timedelta(days=1)
+    assert modified.year in (now.year, now.year - 1)
+
+
+def test_dos_list_lines():
+    assert _parseListLine('01-31-20  12:00PM       <DIR>          logs') == FTPEntry('logs', 'dir', None, _utc(2020, 1, 31, 12))
+    assert _parseListLine('01-31-20  09:15AM               512 web.config') == \
+        FTPEntry('web.config', 'file', 512, _utc(2020, 1, 31, 9, 15))
+
+
+@pytest.mark.parametrize('line', ['', 'total 24', '226 Transfer complete'])
+def test_list_lines_that_are_no_entries(line):
+    assert _parseListLine(line) is None
+
+
+class ListingSession:
+    """The part of an FTP_TLS session listDir uses, with MLSD answered by `mlsd` (a reply code) or a listing."""
+
+    def __init__(self, mlsd, lines):
+        self.mlsd_reply = mlsd
+        self.lines = lines
+        self.commands = []
+
+    def mlsd(self, path, facts=()):
+        self.commands.append('MLSD')
+        if isinstance(self.mlsd_reply, str):
+            raise error_perm(self.mlsd_reply)
+        return iter(self.mlsd_reply)
+
+    def retrlines(self, command, callback):
+        self.commands.append(command.split()[0])
+        for line in self.lines:
+            callback(line)
+
+
+UNIX_LISTING = ['total 8',
+                'drwxr-xr-x    2 web  web      4096 Mar  5  2022 .',
+                'drwxr-xr-x    2 web  web      4096 Mar  5  2022 images',
+                '-rw-r--r--    1 web  web       512 Mar  5  2022 index.html']
+
+
+def _ftp():
+    return FTP('ftp.example.com', 'user', 'secret', '/tmp/backups', '/')
+
+
+def test_list_dir_uses_mlsd_when_the_server_has_it():
+    ftp = _ftp()
+    session = ListingSession([('.', {'type': 'cdir'}), ('index.html', {'type': 'file', 'size': '512'})], UNIX_LISTING)
+
+    assert ftp.listDir('/site', session) == [FTPEntry('index.html', 'file', 512, None)]
+    assert session.commands == ['MLSD']
+
+
+def test_list_dir_falls_back_to_list_once_mlsd_is_refused():
+    ftp = _ftp()
+    session = ListingSession('500 Unknown command MLSD', UNIX_LISTING)
+
+    assert [entry.name for entry in ftp.listDir('/site', session)] == ['images', 'index.html']
+    assert [entry.name for entry in ftp.listDir('/site/images', session)] == ['images', 'index.html']
+    # Refused once, MLSD is not tried again for the rest of the run
+    assert session.commands == ['MLSD', 'LIST', 'LIST']
+
+
+def test_list_dir_does_not_hide_real_errors_behind_the_fallback():
+    ftp = _ftp()
+    with pytest.raises(error_perm):
+        ftp.listDir('/missing', ListingSession('550 No such directory', UNIX_LISTING))
+
+    # Once MLSD has worked, a later refusal is an error rather than a missing feature
+    ftp = _ftp()
+    ftp.listDir('/site', ListingSession([], UNIX_LISTING))
+    with pytest.raises(error_perm):
+        ftp.listDir('/site', ListingSession('500 Unknown command MLSD', UNIX_LISTING))
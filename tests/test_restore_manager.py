@@ -0,0 +1,229 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+from restore_manager import DatabaseRestorer, RestoreError, deferIndexes, deferSchemaIndexes
+
+
+ORDERS = """CREATE TABLE `orders` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `seq` int NOT NULL,
+  `customer_id` int NOT NULL,
+  `status` varchar(20) DEFAULT NULL,
+  `placed` datetime DEFAULT NULL,
+  `email` varchar(100) DEFAULT NULL,
+  `note` text,
+  PRIMARY KEY (`seq`),
+  UNIQUE KEY `uniq_email` (`email`),
+  KEY `id` (`id`),
+  KEY `fk_customer` (`customer_id`,`status`),
+  KEY `idx_status` (`status`),
+  KEY `idx_placed` (`placed`,`status`),
+  KEY `idx_lower_email` ((lower(`email`))),
+  FULLTEXT KEY `ft_note` (`note`),
+  CONSTRAINT `fk_customer` FOREIGN KEY (`customer_id`) REFERENCES `customers` (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
+
+PLAIN = """CREATE TABLE `customers` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `name` varchar(50) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"""
+
+HEADER = """-- MySQL dump 10.13
+/*!40101 SET NAMES utf8mb4 */;
+"""
+
+DUMP = HEADER + """
+--
+-- Table structure for table `customers`
+--
+
+DROP TABLE IF EXISTS `customers`;
+""" + PLAIN + """
+
+--
+-- Dumping data for table `customers`
+--
+
+INSERT INTO `customers` VALUES (1,'ann'),(2,'bob');
+
+--
+-- Table structure for table `orders`
+--
+
+DROP TABLE IF EXISTS `orders`;
+""" + ORDERS + """
+
+--
+-- Dumping data for table `orders`
+--
+
+INSERT INTO `orders` VALUES (1,1,1,'new',NULL,'ann@example.com','first');
+
+--
+-- Temporary view structure for view `open_orders`
+--
+
+CREATE VIEW `open_orders` AS SELECT 1 AS `id`;
+
+--
+-- Final view structure for view `open_orders`
+--
+
+/*!50001 CREATE VIEW `open_orders` AS select `orders`.`id` AS `id` from `orders` where `orders`.`status` = 'new' */;
+-- Dump completed on 2024-03-31 12:00:00
+"""
+
+
+class Database:
+    """The attributes of MySQLDatabase that DatabaseRestorer uses without a server."""
+
+    def __init__(self, local_base_path):
+        self.db_name = 'shop'
+        self.local_base_path = local_base_path
+        self.cipher = None
+
+
+class RecordingRestorer(DatabaseRestorer):
+    """Keeps what every mysql session would have been fed instead of running the client."""
+
+    def __init__(self, *args, fail=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sessions = []
+        self.fail = set(fail)
+        self._recorded = threading.Lock()
+
+    def execute(self, parts, name=None, total=None, database=True):
+        text = ''.join(part if isinstance(part, str) else
+                       part.decode() if isinstance(part, bytes) else part.read_text() for part in parts)
+        with self._recorded:
+            self.sessions.append((name, text))
+        if name in self.fail:
+            raise RestoreError(f"mysql failed on {name}: simulated")
+        return len(text)
+
+
+def _lines(sql):
+    return [line + b'\n' for line in sql.encode().split(b'\n')]
+
+
+def _restorer(tmp_path, **kwargs):
+    return RecordingRestorer(Database(str(tmp_path)), workers=2, **kwargs)
+
+
+def test_defer_indexes_moves_only_plain_secondary_indexes():
+    statement, alters = deferIndexes(ORDERS)
+
+    assert alters == ["ALTER TABLE `orders` ADD KEY `idx_status` (`status`), ADD KEY `idx_placed` (`placed`,`status`);\n",
+                      "ALTER TABLE `orders` ADD FULLTEXT KEY `ft_note` (`note`);\n"]
+    for kept in ('PRIMARY KEY (`seq`)', 'UNIQUE KEY `uniq_email`', 'CONSTRAINT `fk_customer`'):
+        assert kept in statement
+    assert 'idx_status' not in statement and 'ft_note' not in statement
+    # The result stays a valid column list: no trailing comma before the closing parenthesis
+    assert ',\n)' not in statement and statement.endswith(') ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;')
+
+
+def test_defer_indexes_keeps_the_auto_increment_key():
+    # InnoDB needs an index that starts with the AUTO_INCREMENT column while the rows go in
+    statement, _ = deferIndexes(ORDERS)
+    assert "KEY `id` (`id`)" in statement
+
+
+def test_defer_indexes_keeps_keys_backing_a_foreign_key():
+    # Dropping the index a FOREIGN KEY uses would make the CREATE TABLE fail or build an implicit one
+    statement, _ = deferIndexes(ORDERS)
+    assert "KEY `fk_customer` (`customer_id`,`status`)" in statement
+
+
+def test_defer_indexes_keeps_functional_indexes():
+    statement, alters = deferIndexes(ORDERS)
+    assert "KEY `idx_lower_email` ((lower(`email`)))" in statement
+    assert not any('idx_lower_email' in alter for alter in alters)
+
+
+def test_defer_indexes_gives_every_fulltext_index_its_own_alter():
+    table = ORDERS.replace("  FULLTEXT KEY `ft_note` (`note`),",
+                           "  FULLTEXT KEY `ft_note` (`note`),\n  FULLTEXT KEY `ft_email` (`email`),")
+    _, alters = deferIndexes(table)
+    assert [alter for alter in alters if 'FULLTEXT' in alter] == [
+        "ALTER TABLE `orders` ADD FULLTEXT KEY `ft_note` (`note`);\n",
+        "ALTER TABLE `orders` ADD FULLTEXT KEY `ft_email` (`email`);\n"]
+
+
+def test_defer_indexes_leaves_other_statements_alone():
+    assert deferIndexes(PLAIN) == (PLAIN, [])
+    view = "CREATE VIEW `open_orders` AS select 1 AS `id`;"
+    assert deferIndexes(view) == (view, [])
+
+
+def test_defer_schema_indexes_rewrites_every_create_table_of_a_script():
+    script = "DROP TABLE IF EXISTS `orders`;\n" + ORDERS + "\n" + PLAIN + "\n/*!40101 SET character_set_client = @saved */;"
+
+    rewritten, indexes = deferSchemaIndexes(script)
+
+    assert list(indexes) == ['orders']
+    assert indexes['orders'] == deferIndexes(ORDERS)[1]
+    assert rewritten == "DROP TABLE IF EXISTS `orders`;\n" + deferIndexes(ORDERS)[0] + "\n" + PLAIN + \
+        "\n/*!40101 SET character_set_client = @saved */;"
+
+
+def test_restore_stream_loads_each_table_then_views_last(tmp_path):
+    restorer = _restorer(tmp_path)
+
+    restorer._restoreStream(_lines(DUMP))
+
+    tables = {name: text for name, text in restorer.sessions if name is not None}
+    assert set(tables) == {'customers', 'orders'}
+    assert "INSERT INTO `customers` VALUES (1,'ann'),(2,'bob');" in tables['customers']
+    assert 'INSERT INTO `orders`' not in tables['customers']
+    # Every table session starts with the bulk load settings and the dump header
+    assert all(text.startswith(restorer._settings() + HEADER) for text in tables.values())
+    # Its secondary indexes are left out of CREATE TABLE ...
+    assert 'idx_status' not in tables['orders']
+
+    # ... and built in a session of their own once the rows are in
+    unnamed = [text for name, text in restorer.sessions if name is None]
+    assert any("ALTER TABLE `orders` ADD KEY `idx_status`" in text for text in unnamed)
+    # The views are created after every table, in the last session
+    assert restorer.sessions[-1][0] is None
+    assert "Final view structure for view `open_orders`" in restorer.sessions[-1][1]
+    assert not any('open_orders' in text for text in tables.values())
+    assert restorer.stats['tables'] == 2
+
+
+def test_restore_stream_keeps_indexes_when_deferral_is_off(tmp_path):
+    restorer = _restorer(tmp_path, defer_indexes=False)
+
+    restorer._restoreStream(_lines(DUMP))
+
+    assert "KEY `idx_status` (`status`)" in dict((name, text) for name, text in restorer.sessions if name)['orders']
+    assert not any('ALTER TABLE' in text for _, text in restorer.sessions)
+
+
+def test_restore_stream_loads_a_dump_without_table_markers_as_it_is(tmp_path):
+    script = "SET NAMES utf8mb4;\nINSERT INTO `customers` VALUES (3,'cy');\n"
+    restorer = _restorer(tmp_path)
+
+    restorer._restoreStream(_lines(script))
+
+    assert len(restorer.sessions) == 1
+    name, text = restorer.sessions[0]
+    assert name is None and text.startswith(restorer._settings())
+    assert text[len(restorer._settings()):].rstrip('\n') == script.rstrip('\n')
+
+
+def test_restore_stream_reports_failed_tables_before_the_views(tmp_path):
+    restorer = _restorer(tmp_path, fail={'orders'})
+
+    with pytest.raises(RestoreError, match='orders'):
+        restorer._restoreStream(_lines(DUMP))
+
+    assert restorer.stats['failed'] == ['orders']
+    assert not any('open_orders' in text for _, text in restorer.sessions)
+    # The spool directory the tables were split into is removed either way
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.restore-')]
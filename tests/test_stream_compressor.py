@@ -0,0 +1,132 @@
+import gzip
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+from encryption import BackupCipher, EncryptionError
+from stream_compressor import ParallelCompressor, openCompressed
+
+
+BLOCK = 64 * 1024
+
+
+def _dump(size, seed=7):
+    """Compressible SQL-like text with some random bytes mixed in."""
+    rows, rng = [], random.Random(seed)
+    while sum(map(len, rows)) < size:
+        rows.append(f"INSERT INTO `posts` VALUES ({len(rows)},'{rng.getrandbits(64):x}','lorem ipsum dolor');\n".encode())
+    return b''.join(rows)[:size]
+
+
+def _compress(path, data, method, write_size=10_000, workers=3):
+    with open(path, 'wb') as f, ParallelCompressor(f, method, workers=workers, block_size=BLOCK) as compressor:
+        for start in range(0, len(data), write_size):
+            compressor.write(data[start:start + write_size])
+    return compressor
+
+
+@pytest.fixture(params=['gzip', 'zstd'])
+def method(request):
+    if request.param == 'zstd':
+        pytest.importorskip('zstandard')
+    return request.param
+
+
+@pytest.mark.parametrize('size', [0, 1, BLOCK - 1, BLOCK, 5 * BLOCK + 123])
+def test_round_trip(tmp_path, method, size):
+    data = _dump(size)
+    path = str(tmp_path / f'dump.sql{ParallelCompressor.extension(method)}')
+
+    compressor = _compress(path, data, method)
+
+    with openCompressed(path) as f:
+        assert f.read() == data
+    assert compressor.raw_bytes == size
+    assert compressor.compressed_bytes == os.path.getsize(path)
+
+
+def test_blocks_stay_in_order_with_many_workers(tmp_path, method):
+    # Blocks of different content, so any reordering changes the output
+    data = b''.join(bytes([index]) * BLOCK for index in range(40))
+    path = str(tmp_path / f'dump.sql{ParallelCompressor.extension(method)}')
+
+    _compress(path, data, method, write_size=BLOCK // 3, workers=8)
+
+    with openCompressed(path) as f:
+        assert f.read() == data
+
+
+def test_output_does_not_depend_on_write_sizes_or_workers(tmp_path, method):
+    data = _dump(3 * BLOCK + 17)
+    outputs = []
+    for write_size, workers in ((1000, 1), (BLOCK, 4), (len(data), 2)):
+        path = str(tmp_path / f'{write_size}-{workers}')
+        _compress(path, data, method, write_size, workers)
+        with open(path, 'rb') as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_gzip_output_is_a_multi_member_file_standard_tools_read(tmp_path):
+    data = _dump(3 * BLOCK + 5)
+    path = str(tmp_path / 'dump.sql.gz')
+    _compress(path, data, 'gzip')
+
+    assert gzip.decompress(open(path, 'rb').read()) == data
+    if shutil.which('gzip'):
+        assert subprocess.run(['gzip', '-dc', path], capture_output=True, check=True).stdout == data
+
+
+def test_compression_level_is_applied(tmp_path):
+    data = _dump(4 * BLOCK)
+    sizes = {}
+    for level in (1, 9):
+        buffer = io.BytesIO()
+        with ParallelCompressor(buffer, 'gzip', level=level, block_size=BLOCK) as compressor:
+            compressor.write(data)
+        sizes[level] = len(buffer.getvalue())
+    assert sizes[9] < sizes[1]
+
+
+def test_close_is_idempotent_and_flushes_the_tail():
+    buffer = io.BytesIO()
+    compressor = ParallelCompressor(buffer, 'gzip', block_size=BLOCK)
+    compressor.write(b'tail')
+    compressor.close()
+    compressor.close()
+    assert gzip.decompress(buffer.getvalue()) == b'tail'
+
+
+def test_unknown_methods_are_rejected():
+    with pytest.raises(ValueError):
+        ParallelCompressor(io.BytesIO(), 'lz4')
+    assert ParallelCompressor.extension(None) == '' and ParallelCompressor.extension('gzip') == '.gz'
+
+
+def test_encrypted_compressed_files_are_read_back(tmp_path):
+    cipher = BackupCipher(os.urandom(32), segment_size=4096)
+    data = _dump(2 * BLOCK + 9)
+    path = str(tmp_path / 'dump.sql.gz.enc')
+
+    with open(path, 'wb') as raw, cipher.writer(raw) as sealed, \
+            ParallelCompressor(sealed, 'gzip', block_size=BLOCK) as compressor:
+        compressor.write(data)
+
+    with openCompressed(path, cipher=cipher) as f:
+        assert f.read() == data
+    with pytest.raises(EncryptionError):
+        openCompressed(path)
+
+
+def test_uncompressed_files_are_opened_as_they_are(tmp_path):
+    path = tmp_path / 'dump.sql'
+    path.write_bytes(b'SELECT 1;\n')
+    with openCompressed(str(path)) as f:
+        assert f.read() == b'SELECT 1;\n'
@@ -0,0 +1,161 @@
+import datetime
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'website_backup_manager'))
+
+import throttle
+from throttle import Schedule, Throttle, ThrottleConfigError, TokenBucket, parseRate, prioritizeShell, priorityCommand
+
+
+class Clock:
+    """Stands in for the time module of throttle, so buckets refill only when a test moves time on."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle, 'time', types.SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    return clock
+
+
+def _at(hour, minute=0):
+    return datetime.datetime(2024, 3, 31, hour, minute)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, 0), ('', 0), (0, 0), (2048, 2048), (1.5, 1.5),
+    ('100', 100), ('512K', 512 * 1024), ('512k', 512 * 1024), ('10M', 10 * 1024 ** 2),
+    ('1.5G', 1.5 * 1024 ** 3), (' 2 MB/s ', 2 * 1024 ** 2), ('4MiB', 4 * 1024 ** 2), ('8KB/s', 8 * 1024),
+])
+def test_parse_rate(value, expected):
+    assert parseRate(value) == expected
+
+
+@pytest.mark.parametrize('value', ['fast', '10T', '-5M', '10 M bytes', 'M'])
+def test_parse_rate_rejects_what_it_cannot_read(value):
+    with pytest.raises(ThrottleConfigError):
+        parseRate(value)
+
+
+def test_schedule_windows_and_the_default_outside_them():
+    schedule = Schedule.parse('08:00-20:00=2M, 20M')
+
+    assert schedule.rateAt(_at(8)) == 2 * 1024 ** 2
+    assert schedule.rateAt(_at(19, 59)) == 2 * 1024 ** 2
+    # The end of a window is not part of it
+    assert schedule.rateAt(_at(20)) == 20 * 1024 ** 2
+    assert schedule.rateAt(_at(3)) == 20 * 1024 ** 2
+
+
+def test_schedule_windows_may_cross_midnight():
+    schedule = Schedule.parse('22:00-06:00=0,08:00-18:00=1M')
+
+    assert schedule.rateAt(_at(23, 30)) == 0
+    assert schedule.rateAt(_at(5, 59)) == 0
+    assert schedule.rateAt(_at(6)) == 0 and schedule.rateAt(_at(7)) == 0
+    assert schedule.rateAt(_at(9)) == 1024 ** 2
+    assert schedule
+
+
+def test_constant_and_empty_schedules():
+    assert Schedule.parse('10M').rateAt(_at(12)) == 10 * 1024 ** 2
+    assert Schedule.parse(4096).rateAt(_at(12)) == 4096
+    assert not Schedule.parse(None) and not Schedule.parse('')
+    schedule = Schedule.parse('1M')
+    assert Schedule.parse(schedule) is schedule
+
+
+def test_scaled_schedules_divide_every_limit():
+    schedule = Schedule.parse('08:00-20:00=2M,20M').scaled(1 / 4)
+    assert schedule.rateAt(_at(12)) == 512 * 1024
+    assert schedule.rateAt(_at(22)) == 5 * 1024 ** 2
+
+
+@pytest.mark.parametrize('spec', ['8-20=2M', '08:00=2M', '08:00-20:00=fast'])
+def test_invalid_schedules_are_rejected(spec):
+    with pytest.raises(ThrottleConfigError):
+        Schedule.parse(spec)
+
+
+def test_token_bucket_allows_a_burst_then_paces(clock):
+    bucket = TokenBucket(1000)
+    # A new bucket starts empty, so the first second of traffic is already paced
+    assert bucket.reserve(500) == pytest.approx(0.5)
+
+    clock.now += 1.5
+    assert bucket.reserve(1000) == 0.0
+    assert bucket.reserve(250) == pytest.approx(0.25)
+
+
+def test_token_bucket_delays_one_large_read_once(clock):
+    bucket = TokenBucket(1000)
+    clock.now += 10
+    # Idle time never adds up to more than one burst
+    assert bucket.reserve(4000) == pytest.approx(3.0)
+
+
+def test_token_bucket_burst_and_rate_changes(clock):
+    bucket = TokenBucket(1000, burst=200)
+    clock.now += 10
+    assert bucket.reserve(200) == 0.0
+    assert bucket.reserve(100) == pytest.approx(0.1)
+
+    bucket.setRate(0)
+    assert bucket.reserve(10 ** 9) == 0.0
+
+
+def test_throttle_is_free_until_configured(clock):
+    limiter = Throttle()
+    assert not limiter.enabled
+    assert limiter.reserve('example.com', 10 ** 9) == 0.0
+    limiter.consume('example.com', 10 ** 9)
+    assert clock.slept == []
+
+
+def test_throttle_applies_the_lower_of_the_global_and_host_limits(clock):
+    limiter = Throttle()
+    limiter.configure(rate=1000, per_host=500, host_rates={'fast.example.com': 2000})
+
+    assert limiter.reserve('slow.example.com', 1000) == pytest.approx(2.0)
+    # The global bucket is shared, so the other host already waits for the first one's bytes
+    assert limiter.reserve('fast.example.com', 1000) == pytest.approx(2.0)
+
+    limiter.consume('slow.example.com', 500)
+    assert clock.slept == [pytest.approx(3.0)]
+
+
+def test_throttle_shares_divide_the_limits(clock):
+    limiter = Throttle()
+    limiter.configure(rate=4000, per_host=1000, share=4, host_share=2)
+
+    assert limiter.reserve('example.com', 500) == pytest.approx(1.0)
+
+
+def test_priority_command_prefixes():
+    assert priorityCommand() == []
+    assert priorityCommand(nice=10) == ['nice', '-n', '10']
+    assert priorityCommand(ionice='idle') == ['ionice', '-c', '3']
+    assert priorityCommand(ionice=7) == ['ionice', '-c', '2', '-n', '7']
+    assert priorityCommand(19, 'best-effort:4') == ['nice', '-n', '19', 'ionice', '-c', '2', '-n', '4']
+    with pytest.raises(ThrottleConfigError):
+        priorityCommand(ionice='lowest')
+
+
+def test_prioritize_shell_quotes_nothing_it_does_not_add():
+    assert prioritizeShell('mysqldump shop | gzip') == 'mysqldump shop | gzip'
+    assert prioritizeShell('tar -cf - .', nice=5, ionice='idle') == 'nice -n 5 ionice -c 3 tar -cf - .'
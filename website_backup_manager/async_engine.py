@@ -0,0 +1,723 @@
+from helpers import Helpers as Utils
+from ftp_manager import FTPConnectionError, _parseMlsdEntry
+from checksums import CHECKSUM_TOOLS, writeSidecar, readSidecar, sidecarPath
+from backup_writer import BackupFileWriter
+from stream_compressor import ParallelCompressor
+from binlog_backup import BinlogBackup
+from metrics import METRICS
+from throttle import prioritizeShell
+from progress import PROGRESS
+from encryption import BackupCipher, storedPath
+from backup_catalog import BackupCatalog, parseRetention
+import asyncio
+import datetime
+import logging
+import os
+import posixpath
+import shlex
+import ssl
+import time
+
+
+def _aioftp():
+    try:
+        import aioftp
+    except ImportError:
+        raise RuntimeError("The async FTP engine requires the 'aioftp' package (pip install aioftp).")
+    return aioftp
+
+
+def _asyncssh():
+    try:
+        import asyncssh
+    except ImportError:
+        raise RuntimeError("The async SSH engine requires the 'asyncssh' package (pip install asyncssh).")
+    # asyncssh logs every channel at INFO, which would drown the backup log when many sites run at once
+    logging.getLogger('asyncssh').setLevel(logging.WARNING)
+    return asyncssh
+
+
+class AsyncFTP:
+    """
+        FTPS downloader for asyncio, the event-loop counterpart of ftp_manager.FTP.
+
+        Sessions come from a bounded pool of explicit-TLS aioftp clients (AUTH TLS, PROT P,
+        TLS session reuse on data connections). A single keep-alive task sends NOOP on
+        sessions that have been idle for `keepalive` seconds, so a loop can hold hundreds of
+        connections without a thread for each. Files are written through the same BackupFileWriter
+        as the synchronous manager (hashing, progress, bandwidth limit, encryption when configured),
+        size-checked, and a failed attempt is resumed with REST like FTP.downloadFile does.
+    """
+
+    def __init__(self, host, username, password, local_base_path, host_base_path, port=21, sessions=4,
+                 keepalive=60, checksum='sha256', block_size=1024 * 1024, encryption=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.local_base_path = local_base_path
+        self.host_base_path = host_base_path
+        self.port = int(port)
+        self.sessions = max(1, int(sessions))
+        self.keepalive = keepalive
+        self.checksum = checksum or None
+        self.block_size = block_size
+        self.cipher = BackupCipher.fromConfig(encryption)
+        self.digests = {}
+
+        self._idle = None
+        self._last_used = {}
+        self._opened = 0
+        self._keepalive_task = None
+
+    @staticmethod
+    def _sslContext():
+        # Matches ftplib.FTP_TLS, which does not verify certificates; shared hosts often present self-signed ones
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    async def _openSession(self):
+        aioftp = _aioftp()
+        client = aioftp.Client(connection_timeout=30, socket_timeout=300)
+        try:
+            with METRICS.timer('connect_seconds', backend='ftp'):
+                await client.connect(self.host, self.port)
+                await client.upgrade_to_tls(self._sslContext())
+                await client.login(self.username, self.password)
+        except Exception as e:
+            client.close()
+            raise FTPConnectionError(f"Connection to FTP host {self.host} failed\n\n{e}\n")
+        return client
+
+    async def open(self):
+        self._idle = asyncio.Queue()
+        self._keepalive_task = asyncio.create_task(self._keepAlive())
+        return self
+
+    async def close(self):
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            self._keepalive_task = None
+        while self._idle is not None and not self._idle.empty():
+            client = self._idle.get_nowait()
+            try:
+                await asyncio.wait_for(client.quit(), 10)
+            except Exception:
+                client.close()
+        self._opened = 0
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def acquire(self):
+        if self._idle.empty() and self._opened < self.sessions:
+            self._opened += 1
+            try:
+                return await self._openSession()
+            except Exception:
+                self._opened -= 1
+                raise
+        return await self._idle.get()
+
+    def release(self, client, discard=False):
+        if discard:
+            self._opened -= 1
+            self._last_used.pop(client, None)
+            client.close()
+            return
+        self._last_used[client] = time.monotonic()
+        self._idle.put_nowait(client)
+
+    async def _keepAlive(self):
+        """NOOP idle sessions from one task instead of one thread per connection."""
+        while True:
+            await asyncio.sleep(max(1, self.keepalive / 2))
+            for _ in range(self._idle.qsize()):
+                client = self._idle.get_nowait()
+                if time.monotonic() - self._last_used.get(client, 0) >= self.keepalive:
+                    try:
+                        await client.command("NOOP", "200")
+                    except Exception:
+                        self.release(client, discard=True)
+                        continue
+                self.release(client)
+
+    async def listDir(self, remote_dir):
+        client = await self.acquire()
+        try:
+            with METRICS.timer('list_seconds', backend='ftp'):
+                listing = await client.list(remote_dir)
+        except Exception:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+        entries = [_parseMlsdEntry(path.name, info) for path, info in listing]
+        return [entry for entry in entries if entry is not None]
+
+    async def stat(self, remote_path):
+        parent, name = posixpath.split(remote_path.rstrip('/'))
+        for entry in await self.listDir(parent or '/'):
+            if entry.name == name:
+                return entry
+        return None
+
+    async def walk(self, remote_dir, local_dir):
+        """Asynchronously yield (remote_path, local_path, entry) for every file under remote_dir."""
+        for entry in await self.listDir(remote_dir):
+            remote_path = posixpath.join(remote_dir, entry.name)
+            local_path = os.path.join(local_dir, entry.name)
+            if entry.type == 'dir':
+                async for item in self.walk(remote_path, local_path):
+                    yield item
+            else:
+                yield remote_path, local_path, entry
+
+    async def _retrieve(self, client, remote_path, local_path, size, offset=0):
+        """Download remote_path from byte offset on (REST), appending to what earlier attempts stored."""
+
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        started = time.perf_counter()
+
+        with BackupFileWriter(local_path, self.checksum, self.cipher, host=self.host, total=size, offset=offset,
+                              name=posixpath.basename(remote_path), buffering=self.block_size) as writer:
+            async with client.download_stream(remote_path, offset=offset) as stream:
+                async for block in stream.iter_by_block(self.block_size):
+                    delay = writer.feed(block)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+        received = offset + writer.received
+        if size is not None and received != size:
+            METRICS.increment('verify_failures_total', backend='ftp')
+            raise ValueError(f"Size mismatch: {remote_path} (expected {size}, got {received})")
+
+        METRICS.transfer('ftp', writer.received, time.perf_counter() - started)
+        if offset:
+            METRICS.increment('resumed_bytes_total', offset, backend='ftp')
+        if writer.hexdigest() is not None:
+            self.digests[local_path] = writer.hexdigest()
+
+    def _resumeOffset(self, local_path, size):
+        """Bytes a failed attempt left in local_path that the next one can continue from (plain files only)."""
+        if self.cipher is not None or size is None or not os.path.exists(local_path):
+            return 0
+        stored = os.path.getsize(local_path)
+        return stored if stored < size else 0
+
+    async def downloadFile(self, remote_path, local_path, size=None, max_retries=3):
+        """
+            Download and verify one file on a pooled session. Returns True on success.
+
+            A retry resumes where the failed attempt stopped, like FTP.downloadFile; encrypted
+            downloads start over, since a sealed file cannot be appended to.
+        """
+
+        offset = 0
+        for attempt in range(max_retries):
+            client = await self.acquire()
+            try:
+                await self._retrieve(client, remote_path, local_path, size, offset)
+            except Exception as e:
+                self.release(client, discard=True)
+                Utils.log(f"Attempt {attempt + 1} for {remote_path} failed: {e}", level='error')
+                METRICS.increment('retries_total', operation='ftp_download')
+                # A resumed attempt that added nothing (REST refused, say) is followed by a fresh one
+                resumed = self._resumeOffset(local_path, size)
+                offset = resumed if resumed > offset else 0
+                if offset:
+                    Utils.log(f"Resuming {posixpath.basename(remote_path)} at byte {offset} to {local_path}")
+                await asyncio.sleep(1)
+                continue
+            self.release(client)
+            return True
+
+        METRICS.increment('failures_total', backend='ftp')
+        Utils.log(f"Unable to download File {remote_path}.",level='error')
+        return False
+
+    async def downloadDir(self, remote_dir, local_dir, max_retries=3):
+        """Download a tree with one task per session, fed by the directory walk. Returns the failed count."""
+
+        tasks = asyncio.Queue(maxsize=self.sessions * 64)
+        stats = {'done': 0, 'failed': 0}
+
+        async def worker():
+            while True:
+                item = await tasks.get()
+                if item is None:
+                    return
+                remote_path, local_path, entry = item
+                ok = await self.downloadFile(remote_path, local_path, entry.size, max_retries)
+                stats['done'] += 1
+                stats['failed'] += not ok
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.sessions)]
+        try:
+            async for item in self.walk(remote_dir, local_dir):
+                await tasks.put(item)
+        finally:
+            for _ in workers:
+                await tasks.put(None)
+            await asyncio.gather(*workers)
+
+        Utils.log(f"Downloaded {stats['done'] - stats['failed']} of {stats['done']} files from {remote_dir} ({stats['failed']} failed).")
+        return stats['failed']
+
+    async def download(self, remote_dir_name):
+        """Download a remote file or directory into local_base_path. Returns True when every file was downloaded."""
+
+        local_path = os.path.join(self.local_base_path, os.path.basename(remote_dir_name))
+        remote_path = posixpath.join(self.host_base_path, remote_dir_name)
+        error_message = None
+        self.digests = {}
+
+        try:
+            await self.open()
+            entry = await self.stat(remote_path)
+            if entry is None:
+                raise FileNotFoundError(f"{remote_path} does not exist on FTP host {self.host}")
+
+            if entry.type == 'dir':
+                failed = await self.downloadDir(remote_path, local_path)
+            else:
+                failed = 0 if await self.downloadFile(remote_path, local_path, entry.size) else 1
+
+            if failed:
+                error_message = f"{failed} file(s) under {remote_path} could not be downloaded from FTP host {self.host}."
+            elif self.digests:
+                writeSidecar(local_path, self.digests, self.checksum)
+
+        except FTPConnectionError as e:
+            error_message = str(e)
+        except Exception as e:
+            error_message = f"Unexpected error while downloading {remote_path} from FTP host {self.host} :\n\n{e}\n"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                Utils.log(f"Downloading {remote_path} from FTP host {self.host} completed successfully.")
+            await self.close()
+
+        return error_message is None
+
+
+class AsyncSSH:
+    """
+        asyncssh counterpart of ssh_manager.SSH for archiving, streaming and checksums.
+
+        Keep-alives are handled by asyncssh on the connection itself (keepalive_interval).
+    """
+
+    STREAM_WINDOW_SIZE = 16 * 1024 * 1024
+    STREAM_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, host, user, password, local_base_url, host_base_url, port=22, checksum='sha256', keepalive=60,
+                 nice=None, ionice=None, encryption=None):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        self.local_base_url = local_base_url
+        self.host_base_url = host_base_url
+        self.checksum = checksum or 'sha256'
+        self.keepalive = keepalive
+        self.nice = nice
+        self.ionice = ionice
+        self.cipher = BackupCipher.fromConfig(encryption)
+        self.connection = None
+
+    async def connect(self):
+        if self.connection is not None:
+            return self.connection
+        asyncssh = _asyncssh()
+        with METRICS.timer('connect_seconds', backend='ssh'):
+            # known_hosts=None accepts any host key, like the AutoAddPolicy of the synchronous manager
+            self.connection = await asyncssh.connect(self.host, port=self.port, username=self.user, password=self.password,
+                                                     known_hosts=None, keepalive_interval=self.keepalive)
+        return self.connection
+
+    async def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            await self.connection.wait_closed()
+            self.connection = None
+
+    async def run(self, command):
+        """Run a command and return (exit status, stdout, stderr)."""
+        connection = await self.connect()
+        result = await connection.run(command, check=False)
+        return result.exit_status, result.stdout, result.stderr
+
+    async def make_archive(self, remote_dir_name, archive_name=None):
+        """Create <archive_name>.tar.gz in host_base_url. Returns True on success."""
+
+        remote_dir_path = posixpath.join(self.host_base_url, remote_dir_name)
+        archive_name = archive_name or remote_dir_name.lower()
+        archive_path = posixpath.join(self.host_base_url, f"{archive_name}.tar.gz")
+        command = prioritizeShell(f"tar -czf {shlex.quote(archive_path)} -C {shlex.quote(remote_dir_path)} . "
+                                  f"--ignore-failed-read --warning=no-file-changed", self.nice, self.ionice)
+
+        try:
+            with METRICS.timer('archive_seconds', backend='ssh'):
+                exit_status, _, error = await self.run(command)
+        except Exception as e:
+            Utils.log(f"An error occurred: {e}",level='error')
+            return False
+        finally:
+            await self.disconnect()
+
+        if exit_status != 0:
+            Utils.log(f"Error creating archive: {error}",level='error')
+        return exit_status == 0
+
+    async def stream_archive(self, remote_dir_name, archive_name=None, local_compression=None):
+        """Stream a tar of the remote directory into local_base_url; returns (path, digest, bytes) or False."""
+
+        remote_dir_path = posixpath.join(self.host_base_url, remote_dir_name)
+        archive_name = archive_name or remote_dir_name.lower()
+        tar_flags, extension = ('-cf', '.tar' + ParallelCompressor.extension(local_compression)) if local_compression \
+            else ('-czf', '.tar.gz')
+        local_path = os.path.join(self.local_base_url, f"{archive_name}{extension}")
+        command = prioritizeShell(f"tar {tar_flags} - -C {shlex.quote(remote_dir_path)} . --ignore-failed-read "
+                                  f"--warning=no-file-changed", self.nice, self.ionice)
+
+        os.makedirs(self.local_base_url, exist_ok=True)
+        started = time.monotonic()
+
+        try:
+            connection = await self.connect()
+            process = await connection.create_process(command, encoding=None, window=self.STREAM_WINDOW_SIZE)
+            error_task = asyncio.create_task(process.stderr.read(64 * 1024))
+
+            with BackupFileWriter(local_path, self.checksum, self.cipher, local_compression, host=self.host,
+                                  buffering=self.STREAM_CHUNK_SIZE) as writer:
+                while True:
+                    data = await process.stdout.read(self.STREAM_CHUNK_SIZE)
+                    if not data:
+                        break
+                    delay = writer.feed(data)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+            await process.wait()
+            error = await error_task
+
+            # GNU tar exits with 1 when files changed while being read; the archive is still usable
+            if process.exit_status not in (0, 1):
+                raise RuntimeError(f"Error streaming archive: {error.decode(errors='replace')}")
+
+            writeSidecar(local_path, {local_path: writer.hexdigest()}, self.checksum)
+            METRICS.transfer('ssh', writer.received, time.monotonic() - started)
+            Utils.log(f"Archive {os.path.basename(writer.stored_path)} streamed successfully: {writer.bytes_written} bytes.")
+            return writer.stored_path, writer.hexdigest(), writer.bytes_written
+
+        except Exception as e:
+            Utils.log(f"An error occurred: {e}",level='error')
+            return False
+        finally:
+            await self.disconnect()
+
+    async def verify_checksum(self, remote_file_name, expected_digest):
+        """Compare a local digest with sha256sum / b2sum on the server. Returns True when they match."""
+
+        remote_path = posixpath.join(self.host_base_url, remote_file_name)
+        tool = CHECKSUM_TOOLS[self.checksum]
+        try:
+            with METRICS.timer('verify_seconds', backend='ssh'):
+                exit_status, output, error = await self.run(f"{tool} {shlex.quote(remote_path)}")
+        finally:
+            await self.disconnect()
+
+        if exit_status != 0 or output.split()[0] != expected_digest:
+            Utils.log(f"Checksum mismatch for {remote_path}: {error or output}",level='error')
+            return False
+        return True
+
+
+async def dumpDatabase(database, output_file_name=None, chunk_size=1024 * 1024):
+    """
+        Run mysqldump for a MySQLDatabase with asyncio.create_subprocess_exec and stream it to dump_path().
+
+        The dump goes through the same BackupFileWriter as MySQLDatabase.dump (hashing, and compression
+        and encryption when the database has them set), with progress against the size estimate, and
+        a binlog chain is started when the database has binlog enabled.
+    """
+
+    dump_path = database.dump_path(output_file_name)
+    os.makedirs(database.local_base_path, exist_ok=True)
+    command = database._dumpCommand()
+    database.binlog_position = None
+    database.size_estimate = None
+    # The estimate runs the mysql client, so it is kept off the event loop
+    total_size = await asyncio.to_thread(database._estimatedDumpSize)
+    started = time.monotonic()
+
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    error_task = asyncio.create_task(process.stderr.read())
+
+    try:
+        with BackupFileWriter(dump_path, database.checksum, database.cipher, database.compression,
+                              database.compression_level, database.compression_workers, host=database.host,
+                              total=total_size) as writer:
+            while True:
+                chunk = await process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                database._recordBinlogPosition(chunk)
+                delay = writer.feed(chunk)
+                if delay:
+                    await asyncio.sleep(delay)
+    except BaseException:
+        # Nobody reads the pipe any more, so mysqldump would block on it forever
+        if process.returncode is None:
+            process.kill()
+        raise
+    finally:
+        await process.wait()
+
+    error = await error_task
+    if process.returncode != 0:
+        Utils.log(f"Database dump process failed: {error.decode(errors='replace')}",level='error')
+        return False
+
+    writeSidecar(dump_path, {dump_path: writer.hexdigest()}, database.checksum)
+    METRICS.transfer('mysql', writer.received, time.monotonic() - started)
+
+    if database.binlog:
+        BinlogBackup(database).startChain(writer.stored_path, 'file', database.binlog_position)
+
+    Utils.log(f"Database dump completed successfully: {writer.stored_path}")
+    return True
+
+
+class AsyncBackupEngine:
+    """
+        Run full backups of many sites concurrently on one event loop.
+
+        Each site runs archive -> download -> verify (or a single streamed archive) next to
+        its database dump, like remote_backup_manager.full_backup. A global limit and
+        per-host limits bound how many sites run at once. Sites are started largest first.
+        run() is the blocking wrapper for callers without an event loop.
+
+        With a catalog, every site's run and the files it stored are recorded there like
+        full_backup does it (archives and dumps get per-run names) and retention prunes the
+        site's old runs. With history_path, durations of good runs are saved to the same
+        history file BatchScheduler orders by.
+
+        Incremental archives, SFTP downloads, chunk stores and parallel dumps are not
+        implemented here; sites using them (see unsupported) are rejected with a failed
+        summary instead of being backed up differently than configured.
+    """
+
+    def __init__(self, workers=50, per_host=4, host_limits=None, ftp_sessions=2, catalog=None, retention=None,
+                 history_path=None):
+        self.workers = max(1, int(workers))
+        self.per_host = max(1, int(per_host))
+        self.host_limits = host_limits or {}
+        self.ftp_sessions = ftp_sessions
+        self.catalog = catalog
+        self.retention = parseRetention(retention)
+        self.history_path = history_path
+        self._catalog_lock = None
+
+    @staticmethod
+    def unsupported(site):
+        """Options of a site that this engine does not implement; such sites belong on the process pool."""
+
+        options = []
+        if site.get('incremental'):
+            options.append('incremental')
+        if site.get('sftp') and not site.get('ftp'):
+            options.append('sftp')
+        options += [f"{section}.chunk_store" for section in ('ftp', 'ssh', 'db')
+                    if site.get(section) and site[section].get('chunk_store')]
+        if site.get('db') and int(site['db'].get('workers') or 1) > 1:
+            options.append('db.workers')
+        return options
+
+    @staticmethod
+    async def _stage(stages, name, operation):
+        """Run one stage coroutine and record it in the StagePipeline result format."""
+        started = time.monotonic()
+        error = None
+        try:
+            result = await operation
+        except Exception as e:
+            result, error = False, e
+
+        status = 'failed' if error is not None or result is False else ('skipped' if result is None else 'ok')
+        stages[name] = {'status': status, 'seconds': round(time.monotonic() - started, 3),
+                        'error': str(error) if error is not None else None, 'result': result}
+        METRICS.record('stage_seconds', stages[name]['seconds'], stage=name)
+        return status == 'ok' or status == 'skipped'
+
+    async def _files(self, site, stages, run_stamp=None):
+        ssh_config, ftp_config = site['ssh'], site['ftp']
+        if not ssh_config:
+            return
+
+        ssh = AsyncSSH(**{key: value for key, value in ssh_config.items() if key not in ('chunk_store',)})
+        archive_name = site['archive'] or site['dir']
+
+        if site['stream_archive'] or not ftp_config:
+            stream_name = f"{archive_name}-{run_stamp}" if run_stamp else archive_name
+            if await self._stage(stages, 'archive', ssh.stream_archive(site['dir'], stream_name)) and self.catalog:
+                path, digest, _ = stages['archive']['result']
+                stages['archive']['outputs'] = [self._output(path, 'file', digest, ssh.checksum)]
+            return
+
+        if not await self._stage(stages, 'archive', ssh.make_archive(site['dir'], archive_name)):
+            return
+
+        # One archive file per site, so ftp_sessions replaces the download workers; a set chunk_store is rejected above
+        ftp = AsyncFTP(**{key: value for key, value in ftp_config.items() if key not in ('chunk_store', 'workers')},
+                       sessions=self.ftp_sessions)
+        if not await self._stage(stages, 'download', ftp.download(f"{archive_name}.tar.gz")):
+            return
+
+        await self._stage(stages, 'verify', self._verify(ssh, ftp, f"{archive_name}.tar.gz"))
+        if self.catalog:
+            stages['download']['outputs'] = [self._downloadOutput(ftp, archive_name, run_stamp)]
+
+    @staticmethod
+    async def _verify(ssh, ftp, file_name):
+        """Compare the downloaded archive's digest with the server's, like verify_downloaded_archive; None when there is none."""
+
+        local_path = os.path.join(ftp.local_base_path, file_name)
+        expected = ftp.digests.get(local_path)
+        sidecar = sidecarPath(local_path, ftp.checksum) if ftp.checksum else None
+        if expected is None and sidecar is not None and os.path.exists(sidecar):
+            expected = readSidecar(sidecar).get(os.path.normpath(os.path.abspath(local_path)))
+        if expected is None:
+            Utils.log(f"No digest recorded for {file_name}. Skipping archive verification.")
+            return None
+
+        ssh.checksum = ftp.checksum
+        return await ssh.verify_checksum(file_name, expected)
+
+    @staticmethod
+    def _downloadOutput(ftp, archive_name, run_stamp):
+        """Move the downloaded archive, which keeps the server's name, to its per-run name, like stage_outputs."""
+
+        local_path = os.path.join(ftp.local_base_path, f"{archive_name}.tar.gz")
+        digest = ftp.digests.get(local_path)
+        if run_stamp:
+            run_path = os.path.join(ftp.local_base_path, f"{archive_name}-{run_stamp}.tar.gz")
+            os.replace(storedPath(local_path, ftp.cipher), storedPath(run_path, ftp.cipher))
+            if ftp.checksum and digest:
+                writeSidecar(run_path, {run_path: digest}, ftp.checksum)
+                if os.path.exists(sidecarPath(local_path, ftp.checksum)):
+                    os.remove(sidecarPath(local_path, ftp.checksum))
+            local_path = run_path
+        return AsyncBackupEngine._output(storedPath(local_path, ftp.cipher), 'file', digest, ftp.checksum)
+
+    @staticmethod
+    def _output(path, kind, digest=None, algorithm=None):
+        from remote_backup_manager import remote_backup_manager
+        return remote_backup_manager.catalog_output(path, kind, digest, algorithm)
+
+    async def _database(self, site, stages, run_stamp=None):
+        if not site['db'] or not site['database']:
+            return
+        from database_manager import MySQLDatabase
+        database = MySQLDatabase(**site['db'])
+        name = f"{site['database']}-{run_stamp}" if run_stamp else site['database']
+
+        if await self._stage(stages, 'database', dumpDatabase(database, name)) and self.catalog:
+            dump_path = database.dump_path(name)
+            digest = readSidecar(sidecarPath(dump_path, database.checksum)).get(os.path.normpath(os.path.abspath(dump_path)))
+            stages['database']['outputs'] = [self._output(storedPath(dump_path, database.cipher), 'file', digest,
+                                                          database.checksum)]
+
+    async def _record(self, site, start_time, stages, success):
+        """Add the site's run to the backup catalog and prune its old runs, one site at a time and off the event loop."""
+
+        if not self.catalog:
+            return
+
+        def record():
+            with BackupCatalog(self.catalog) as catalog:
+                catalog.record(f"{site['name']}-{start_time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}", site['name'],
+                               start_time.timestamp(), (datetime.datetime.now() - start_time).total_seconds(),
+                               'ok' if success else 'failed', stages)
+                if self.retention and success:
+                    catalog.prune(site['name'], **self.retention)
+
+        if self._catalog_lock is None:
+            self._catalog_lock = asyncio.Lock()
+        try:
+            async with self._catalog_lock:
+                await asyncio.to_thread(record)
+            Utils.log(f"Run of {site['name']} recorded in backup catalog {self.catalog}")
+        except Exception as e:
+            Utils.log(f"Unable to record the run of {site['name']} in the backup catalog: {e}",level='error')
+
+    async def backupSite(self, site):
+        started = time.monotonic()
+        start_time = datetime.datetime.now()
+        run_stamp = start_time.strftime('%Y%m%d-%H%M%S') if self.catalog else None
+        stages = {}
+
+        options = self.unsupported(site)
+        if options:
+            error = f"not supported by the async engine: {', '.join(options)}"
+            Utils.log(f"Skipping {site['name']}: {error}.", level='warning')
+            return {'site': site['name'], 'host': site['host'], 'success': False, 'seconds': 0.0, 'failed_stages': [],
+                    'error': error, 'stages': stages}
+
+        # One site's failure outside a stage must not take the other sites of the loop down with it
+        error = None
+        try:
+            await asyncio.gather(self._files(site, stages, run_stamp), self._database(site, stages, run_stamp))
+        except Exception as e:
+            Utils.log(f"Backup of {site['name']} failed: {e}", level='error')
+            error = str(e) or e.__class__.__name__
+
+        failed = [name for name, info in stages.items() if info['status'] == 'failed']
+        await self._record(site, start_time, stages, not failed and error is None)
+        return {'site': site['name'], 'host': site['host'], 'success': not failed and error is None,
+                'seconds': round(time.monotonic() - started, 3), 'failed_stages': failed, 'error': error,
+                'stages': {name: {key: info[key] for key in ('status', 'seconds', 'error')} for name, info in stages.items()}}
+
+    async def runAsync(self, sites):
+        from batch_backup import _loadHistory, _saveHistory
+
+        overall = asyncio.Semaphore(self.workers)
+        hosts = {}
+        summaries = []
+        history = _loadHistory(self.history_path)
+
+        async def limited(site):
+            host = hosts.setdefault(site['host'], asyncio.Semaphore(max(1, int(self.host_limits.get(site['host'], self.per_host)))))
+            # Take the host slot first so a site waiting on a busy host does not hold a global slot
+            async with host, overall:
+                Utils.log(f"Started {site['name']} on {site['host']}.")
+                summary = await self.backupSite(site)
+            summaries.append(summary)
+            if summary['success']:
+                history[site['name']] = {'seconds': summary['seconds'],
+                                         'finished': datetime.datetime.now().isoformat(timespec='seconds')}
+            Utils.log(f"Finished {site['name']} in {summary['seconds']:.1f}s: {'ok' if summary['success'] else 'FAILED'} "
+                      f"({len(summaries)}/{len(sites)}).", level='info' if summary['success'] else 'error')
+
+        ordered = [site for site in sorted(sites, key=lambda site: site.get('size_mb') or 0, reverse=True)
+                   if site.get('enabled', True)]
+        results = await asyncio.gather(*(limited(site) for site in ordered), return_exceptions=True)
+        for site, result in zip(ordered, results):
+            if isinstance(result, Exception):
+                Utils.log(f"Backup of {site['name']} failed: {result}", level='error')
+                summaries.append({'site': site['name'], 'host': site['host'], 'success': False, 'seconds': 0.0,
+                                  'failed_stages': [], 'error': str(result) or result.__class__.__name__, 'stages': {}})
+        _saveHistory(self.history_path, history)
+        PROGRESS.summary()
+        return summaries
+
+    def run(self, sites):
+        """Blocking wrapper: back up every site and return the per-site summaries."""
+        return asyncio.run(self.runAsync(sites))
@@ -0,0 +1,422 @@
+from helpers import Helpers as Utils
+from checksums import sidecarPath
+from chunk_store import ChunkStore
+from encryption import EXTENSION
+import argparse
+import datetime
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+
+class CatalogError(ValueError):
+    """Raised when a retention policy cannot be parsed."""
+
+
+# Retention rules in the order they are applied, with the calendar period each one keeps a backup of
+RETENTION_PERIODS = {
+    'daily': lambda moment: moment.date(),
+    'weekly': lambda moment: moment.isocalendar()[:2],
+    'monthly': lambda moment: (moment.year, moment.month),
+    'yearly': lambda moment: moment.year,
+}
+
+
+def parseRetention(spec):
+    """
+        'daily=7,weekly=4,monthly=12,yearly=2' to {'daily': 7, ...}; rules left out keep nothing.
+    """
+
+    if spec is None or spec == '':
+        return None
+    if isinstance(spec, dict):
+        return {period: int(spec.get(period, 0)) for period in RETENTION_PERIODS}
+
+    policy = dict.fromkeys(RETENTION_PERIODS, 0)
+    for part in str(spec).split(','):
+        period, _, count = part.strip().partition('=')
+        if period not in RETENTION_PERIODS or not count.strip().isdigit():
+            raise CatalogError(f"Invalid retention rule '{part}'; use daily=N, weekly=N, monthly=N or yearly=N.")
+        policy[period] = int(count)
+    return policy
+
+
+def selectRetained(runs, daily=0, weekly=0, monthly=0, yearly=0):
+    """
+        Grandfather-father-son selection: ids of the newest run in each of the last `daily` days,
+        `weekly` ISO weeks, `monthly` months and `yearly` years that have a run.
+
+        runs are (id, started timestamp) pairs, newest first.
+    """
+
+    counts = {'daily': daily, 'weekly': weekly, 'monthly': monthly, 'yearly': yearly}
+    kept = set()
+
+    for period, count in counts.items():
+        if count <= 0:
+            continue
+        seen = set()
+        for run, started in runs:
+            key = RETENTION_PERIODS[period](datetime.datetime.fromtimestamp(started))
+            if key in seen:
+                continue
+            seen.add(key)
+            kept.add(run)
+            if len(seen) >= count:
+                break
+
+    return kept
+
+
+class BackupCatalog:
+    """
+        SQLite catalog of backup runs: which site, when, how long, how it went, and every file
+        each stage produced with its size and digest.
+
+        Lookups go through indexes on (site, status, started), output paths and archive chains,
+        so the latest good backup of a site or a retention decision never needs the backup
+        volume itself. Several batch worker processes can record runs at the same time (WAL,
+        with writers waiting for each other).
+
+        Retention only frees space when runs store their own files, which is why
+        remote_backup_manager gives every output a per-run name when it records to a catalog.
+        A path recorded by several runs is deleted only once no kept run refers to it, and chunk
+        store chunks only once no manifest left in their store refers to them.
+
+        Tables:
+            runs     run_id, site, started (unix time), seconds, status ('ok' or 'failed')
+            stages   run, stage, status, seconds, error
+            outputs  run, stage, kind ('file', 'directory' or 'chunk_store'), path, size, digest,
+                     algorithm, chain (first archive of an incremental chain the output belongs to)
+    """
+
+    def __init__(self, db_path, timeout=30):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id      INTEGER PRIMARY KEY,
+                run_id  TEXT NOT NULL UNIQUE,
+                site    TEXT NOT NULL,
+                started REAL NOT NULL,
+                seconds REAL,
+                status  TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS runs_site_status_started ON runs (site, status, started);
+            CREATE INDEX IF NOT EXISTS runs_site_started ON runs (site, started);
+
+            CREATE TABLE IF NOT EXISTS stages (
+                run     INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+                stage   TEXT NOT NULL,
+                status  TEXT NOT NULL,
+                seconds REAL,
+                error   TEXT,
+                PRIMARY KEY (run, stage)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS outputs (
+                id        INTEGER PRIMARY KEY,
+                run       INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+                stage     TEXT NOT NULL,
+                kind      TEXT NOT NULL,
+                path      TEXT NOT NULL,
+                size      INTEGER,
+                digest    TEXT,
+                algorithm TEXT,
+                chain     TEXT
+            );
+            CREATE INDEX IF NOT EXISTS outputs_run ON outputs (run);
+            CREATE INDEX IF NOT EXISTS outputs_path ON outputs (path);
+            CREATE INDEX IF NOT EXISTS outputs_chain ON outputs (chain) WHERE chain IS NOT NULL;
+        """)
+        self.db.commit()
+
+    def record(self, run_id, site, started, seconds, status, stages):
+        """
+            Add one run. stages is {name: {'status', 'seconds', 'error', 'outputs': [output, ...]}},
+            outputs being {'kind', 'path', 'size', 'digest', 'algorithm', 'chain'} dicts.
+        """
+
+        with self._lock, self.db:
+            run = self.db.execute("INSERT INTO runs (run_id, site, started, seconds, status) VALUES (?, ?, ?, ?, ?)",
+                                  (run_id, site, started, seconds, status)).lastrowid
+            self.db.executemany("INSERT INTO stages (run, stage, status, seconds, error) VALUES (?, ?, ?, ?, ?)",
+                                ((run, name, info['status'], info.get('seconds'), info.get('error'))
+                                 for name, info in stages.items()))
+            self.db.executemany(
+                "INSERT INTO outputs (run, stage, kind, path, size, digest, algorithm, chain) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((run, name, output['kind'], output['path'], output.get('size'), output.get('digest'),
+                  output.get('algorithm'), output.get('chain'))
+                 for name, info in stages.items() for output in info.get('outputs', ())))
+        return run
+
+    def _run(self, row):
+        run = dict(row)
+        run['stages'] = {stage['stage']: dict(stage) for stage in self.db.execute(
+            "SELECT stage, status, seconds, error FROM stages WHERE run = ?", (row['id'],))}
+        run['outputs'] = [dict(output) for output in self.db.execute(
+            "SELECT stage, kind, path, size, digest, algorithm, chain FROM outputs WHERE run = ? ORDER BY id", (row['id'],))]
+        return run
+
+    def latest(self, site, stage=None):
+        """
+            The newest successful run of a site with its stages and outputs, or None.
+
+            With stage, the newest run in which that stage succeeded, e.g. the last good dump
+            even if the archive of the same run failed.
+        """
+
+        with self._lock:
+            if stage is None:
+                row = self.db.execute("SELECT * FROM runs WHERE site = ? AND status = 'ok' ORDER BY started DESC LIMIT 1",
+                                      (site,)).fetchone()
+            else:
+                row = self.db.execute("""
+                    SELECT runs.* FROM runs JOIN stages ON stages.run = runs.id AND stages.stage = ? AND stages.status = 'ok'
+                    WHERE runs.site = ? ORDER BY runs.started DESC LIMIT 1
+                """, (stage, site)).fetchone()
+            return self._run(row) if row is not None else None
+
+    def runs(self, site, status=None, since=None, until=None, limit=100):
+        """Runs of a site, newest first, optionally filtered by status and a started time range (unix time)."""
+
+        query, params = "SELECT * FROM runs WHERE site = ?", [site]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        if since is not None:
+            query += " AND started >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND started < ?"
+            params.append(until)
+        query += " ORDER BY started DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+
+        with self._lock:
+            return [self._run(row) for row in self.db.execute(query, params).fetchall()]
+
+    def sites(self):
+        """{site: {'runs', 'last_ok', 'bytes'}} over the whole catalog."""
+
+        with self._lock:
+            rows = self.db.execute("""
+                SELECT runs.site, COUNT(DISTINCT runs.id) AS runs,
+                       MAX(CASE WHEN runs.status = 'ok' THEN runs.started END) AS last_ok, SUM(outputs.size) AS bytes
+                FROM runs LEFT JOIN outputs ON outputs.run = runs.id GROUP BY runs.site ORDER BY runs.site
+            """).fetchall()
+        return {row['site']: {'runs': row['runs'], 'last_ok': row['last_ok'], 'bytes': row['bytes'] or 0} for row in rows}
+
+    def retained(self, site, daily=7, weekly=4, monthly=12, yearly=0):
+        """
+            Ids of the runs of a site that a retention policy keeps:
+              - the runs selectRetained picks among the successful ones, and always the newest of them;
+              - failed runs newer than that, which may still be looked into;
+              - every run sharing an incremental archive chain with a kept run, since restoring
+                an archive needs the whole chain before it.
+        """
+
+        successful = [(row['id'], row['started']) for row in self.db.execute(
+            "SELECT id, started FROM runs WHERE site = ? AND status = 'ok' ORDER BY started DESC", (site,))]
+        kept = selectRetained(successful, daily, weekly, monthly, yearly)
+
+        if successful:
+            kept.add(successful[0][0])
+            newest = successful[0][1]
+        else:
+            newest = float('-inf')
+        kept.update(row['id'] for row in self.db.execute(
+            "SELECT id FROM runs WHERE site = ? AND status != 'ok' AND started > ?", (site, newest)))
+
+        while True:
+            chained = {row['run'] for row in self.db.execute(f"""
+                SELECT DISTINCT members.run FROM outputs AS kept JOIN outputs AS members ON members.chain = kept.chain
+                WHERE kept.run IN ({','.join('?' * len(kept))}) AND kept.chain IS NOT NULL
+            """, tuple(kept))} if kept else set()
+            if chained <= kept:
+                return kept
+            kept |= chained
+
+    def prune(self, site, daily=7, weekly=4, monthly=12, yearly=0, dry_run=False):
+        """
+            Delete the runs of a site that the retention policy does not keep, with their files.
+
+            Files still referenced by a kept run (outputs written to the same path every run) are
+            left alone. Sidecar digest files go with their backups. Chunk store manifests are
+            removed and their stores garbage collected (ChunkStore.collect), which frees the chunks
+            no remaining manifest uses. Files are deleted before the catalog rows, so an
+            interrupted prune is finished by the next one.
+
+            Returns {'runs', 'files', 'chunks', 'bytes', 'kept'}, bytes being the disk space freed;
+            with dry_run, what would go.
+        """
+
+        started = time.monotonic()
+        with self._lock:
+            kept = self.retained(site, daily, weekly, monthly, yearly)
+            expired = [row['id'] for row in self.db.execute("SELECT id FROM runs WHERE site = ?", (site,)) if row['id'] not in kept]
+
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS expired (id INTEGER PRIMARY KEY)")
+            self.db.execute("DELETE FROM expired")
+            self.db.executemany("INSERT INTO expired (id) VALUES (?)", ((run,) for run in expired))
+
+            # One query finds every file that only expired runs point to
+            outputs = self.db.execute("""
+                SELECT kind, path, MAX(size) AS size, algorithm FROM outputs
+                WHERE run IN (SELECT id FROM expired)
+                  AND path NOT IN (SELECT path FROM outputs WHERE run NOT IN (SELECT id FROM expired)
+                                   AND run IN (SELECT id FROM runs WHERE site = ?))
+                GROUP BY path
+            """, (site,)).fetchall()
+
+            # Recorded sizes are logical (a manifest's is that of the whole backup), so measure what is on disk
+            summary = {'runs': len(expired), 'files': len(outputs), 'chunks': 0,
+                       'bytes': sum(self._diskUsage(row['path']) for row in outputs), 'kept': len(kept)}
+            stores = {}
+            for row in outputs:
+                root = ChunkStore.rootOf(row['path']) if row['kind'] == 'chunk_store' else None
+                if root is not None:
+                    stores.setdefault(root, []).append(row['path'])
+
+            if dry_run or not expired:
+                self._collectChunks(stores, summary, dry_run=True)
+                self.db.execute("DELETE FROM expired")
+                self.db.commit()
+                return summary
+
+            for row in outputs:
+                self._removeOutput(row['kind'], row['path'], row['algorithm'])
+            self._collectChunks(stores, summary)
+
+            with self.db:
+                self.db.execute("DELETE FROM runs WHERE id IN (SELECT id FROM expired)")
+                self.db.execute("DELETE FROM expired")
+
+        Utils.log(f"Pruned {summary['runs']} run(s) of {site}: {summary['files']} file(s) and {summary['chunks']} chunk(s), "
+                  f"{summary['bytes']} bytes freed, {summary['kept']} run(s) kept ({time.monotonic() - started:.2f}s).")
+        return summary
+
+    @staticmethod
+    def _collectChunks(stores, summary, dry_run=False):
+        """Garbage collect the chunk stores expired manifests were in, adding what they free to summary."""
+
+        for root, manifests in stores.items():
+            try:
+                with ChunkStore(root) as store:
+                    freed = store.collect(excluded=manifests, dry_run=dry_run)
+            except OSError as e:
+                Utils.log(f"Unable to collect unreferenced chunks in {root}: {e}", level='warning')
+                continue
+            summary['chunks'] += freed['chunks']
+            summary['bytes'] += freed['bytes']
+
+    @staticmethod
+    def _diskUsage(path):
+        """Bytes a file or directory takes on disk, 0 once it is gone."""
+
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(directory, file_name))
+                       for directory, _, files in os.walk(path) for file_name in files)
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _removeOutput(kind, path, algorithm):
+        try:
+            if kind == 'directory':
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            Utils.log(f"Unable to remove expired backup {path}: {e}", level='warning')
+
+        if algorithm and kind != 'chunk_store':
+            # Sidecars are named after the unencrypted file
+            plain = path[:-len(EXTENSION)] if path.endswith(EXTENSION) else path
+            try:
+                os.remove(sidecarPath(plain, algorithm))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _formatRun(run):
+    started = datetime.datetime.fromtimestamp(run['started']).isoformat(timespec='seconds')
+    lines = [f"{run['run_id']}  {run['status']:<6}  {started}  {run['seconds'] or 0:.1f}s"]
+    for name, stage in run['stages'].items():
+        lines.append(f"    {name:<12} {stage['status']:<8} {stage['seconds'] or 0:8.1f}s" + (f"  {stage['error']}" if stage['error'] else ''))
+    for output in run['outputs']:
+        lines.append(f"    {output['stage']:<12} {output['kind']:<11} {output['size'] or 0:>14} bytes  {output['path']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Query the backup catalog and apply retention.")
+    parser.add_argument('--catalog', default=os.getenv('BACKUP_CATALOG'), help="Catalog database (default: BACKUP_CATALOG)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('sites', help="Every site with its number of runs, last good run and stored bytes")
+
+    latest_parser = commands.add_parser('latest', help="Latest good run of a site")
+    latest_parser.add_argument('site')
+    latest_parser.add_argument('--stage', help="Latest run in which this stage succeeded, e.g. database")
+
+    runs_parser = commands.add_parser('runs', help="Runs of a site, newest first")
+    runs_parser.add_argument('site')
+    runs_parser.add_argument('--status', choices=('ok', 'failed'))
+    runs_parser.add_argument('--limit', type=int, default=20)
+
+    prune_parser = commands.add_parser('prune', help="Delete the runs and files a retention policy does not keep")
+    prune_parser.add_argument('sites', nargs='*', help="Sites to prune (default: every site)")
+    prune_parser.add_argument('--retention', default=os.getenv('RETENTION') or 'daily=7,weekly=4,monthly=12',
+                              help="e.g. daily=7,weekly=4,monthly=12,yearly=2 (default: RETENTION)")
+    prune_parser.add_argument('--dry-run', action='store_true')
+
+    args = parser.parse_args()
+    if not args.catalog:
+        parser.error("no catalog given; use --catalog or set BACKUP_CATALOG")
+
+    with BackupCatalog(args.catalog) as catalog:
+        if args.command == 'sites':
+            for site, info in catalog.sites().items():
+                last_ok = datetime.datetime.fromtimestamp(info['last_ok']).isoformat(timespec='seconds') if info['last_ok'] else 'never'
+                print(f"{site:<30} {info['runs']:>6} run(s)  last ok {last_ok}  {info['bytes']} bytes")
+        elif args.command == 'latest':
+            run = catalog.latest(args.site, args.stage)
+            print(_formatRun(run) if run else f"No successful run recorded for {args.site}.")
+            raise SystemExit(0 if run else 1)
+        elif args.command == 'runs':
+            for run in catalog.runs(args.site, args.status, limit=args.limit):
+                print(_formatRun(run))
+        else:
+            policy = parseRetention(args.retention)
+            for site in args.sites or list(catalog.sites()):
+                summary = catalog.prune(site, dry_run=args.dry_run, **policy)
+                if args.dry_run:
+                    print(f"{site}: would remove {summary['runs']} run(s), {summary['files']} file(s) and "
+                          f"{summary['chunks']} chunk(s), {summary['bytes']} bytes; {summary['kept']} run(s) kept")
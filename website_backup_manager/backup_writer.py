@@ -0,0 +1,107 @@
+from checksums import HashingWriter, fileDigest
+from encryption import sealing, storedPath
+from progress import PROGRESS
+from stream_compressor import ParallelCompressor
+from throttle import THROTTLE
+import contextlib
+import os
+import time
+
+
+class BackupFileWriter:
+    """
+        The write path of every streamed backup file, shared by the synchronous managers and the
+        async engine: optional compression (ParallelCompressor), hashing, optional encryption
+        (to <path>.enc) and the file, in that order, so the digest is that of the file as it is
+        before encryption. The bytes given to write() are counted by PROGRESS and held to the
+        host's bandwidth limit: write() sleeps, feed() returns the delay for an event loop to await.
+
+        sink takes the place of the file (a chunk store writer). offset appends to a partial
+        plain file whose first `offset` bytes are hashed from disk first, for resumed downloads.
+        Use it as a context manager; leaving the block with an exception fails the transfer and
+        leaves an encrypted file unsealed, so it can never pass for a complete one.
+    """
+
+    def __init__(self, path, checksum='sha256', cipher=None, compression=None, compression_level=None,
+                 compression_workers=None, host=None, total=None, offset=0, sink=None, name=None,
+                 buffering=16 * 1024 * 1024):
+        if offset and (cipher is not None or compression or sink is not None):
+            raise ValueError(f"Cannot append to {path}: only plain files can be resumed.")
+
+        self.path = path
+        self.stored_path = storedPath(path, cipher) if sink is None else None
+        self.checksum = checksum
+        self.cipher = cipher
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_workers = compression_workers
+        self.host = host
+        self.total = total
+        self.offset = offset
+        self.sink = sink
+        self.name = name or os.path.basename(path)
+        self.buffering = buffering
+
+        self.received = 0  # Bytes given to write() / feed(), before compression
+        self.compressor = None
+        self.progress = None
+        self._hashing = None
+        self._writer = None
+        self._stack = None
+
+    def __enter__(self):
+        with contextlib.ExitStack() as stack:
+            if self.sink is not None:
+                output = stack.enter_context(self.sink)
+            else:
+                raw = stack.enter_context(open(self.stored_path, 'ab' if self.offset else 'wb', buffering=self.buffering))
+                output = stack.enter_context(sealing(raw, self.cipher))
+
+            initial = fileDigest(self.path, self.checksum, limit=self.offset) if self.offset and self.checksum else None
+            self._hashing = self._writer = HashingWriter(output, self.checksum, initial)
+
+            if self.compression:
+                self.compressor = self._writer = ParallelCompressor(self._hashing, self.compression, self.compression_level,
+                                                                    self.compression_workers)
+                stack.push(self._closeCompressor)
+
+            self.progress = stack.enter_context(PROGRESS.transfer(self.name, self.total, self.offset))
+            self._stack = stack.pop_all()
+        return self
+
+    def _closeCompressor(self, exc_type, exc, tb):
+        # Flushed into the file on success; after a failure only its threads need to stop
+        if exc_type is None:
+            self.compressor.close()
+        else:
+            with contextlib.suppress(Exception):
+                self.compressor.close()
+        return False
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._stack.__exit__(exc_type, exc, tb)
+
+    def feed(self, data):
+        """Write data through the pipeline and return the seconds to wait before writing more."""
+        self._writer.write(data)
+        self.received += len(data)
+        self.progress.advance(len(data))
+        return THROTTLE.reserve(self.host, len(data))
+
+    def write(self, data):
+        delay = self.feed(data)
+        if delay:
+            time.sleep(delay)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    @property
+    def bytes_written(self):
+        """Bytes that reached the file (after compression, before encryption), the resumed prefix left out."""
+        return self._hashing.bytes_written
+
+    def hexdigest(self):
+        """Digest of the whole file before encryption, or None without a checksum."""
+        return self._hashing.hexdigest()
@@ -0,0 +1,389 @@
+from helpers import Helpers as Utils
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+SECTIONS = ('ftp', 'sftp', 'ssh', 'db')
+
+
+class InventoryError(Exception):
+    """Raised when the site inventory file is missing required fields."""
+
+
+def _resolveSecrets(config):
+    """Replace `<key>_env` entries with the value of that environment variable under `<key>`."""
+
+    resolved = {}
+    for key, value in config.items():
+        if key.endswith('_env'):
+            name = key[:-len('_env')]
+            if value not in os.environ:
+                raise InventoryError(f"Environment variable {value} for '{name}' is not set.")
+            resolved[name] = os.environ[value]
+        else:
+            resolved[key] = value
+    return resolved
+
+
+def loadInventory(path):
+    """
+        Read a JSON site inventory and return the fully merged site definitions.
+
+        {
+            "defaults": {"local_base_path": "/backups", "ftp": {...}, "ssh": {...}, "db": {...}},
+            "host_limits": {"web1.example.com": 2},
+            "sites": [
+                {"name": "shop", "host": "web1.example.com", "dir": "shop_html", "database": "shop_db",
+                 "size_mb": 2500, "ftp": {"username": "shop", "password_env": "SHOP_FTP_PASS"}, ...}
+            ]
+        }
+
+        Section settings are merged over the defaults. Each site gets its own local folder,
+        <local_base_path>/<name>, and secrets can be read from the environment with `<key>_env`.
+        A site with an "sftp" section (SSH settings plus workers) and no "ftp" downloads over SFTP.
+        An "encryption" key file in a section (usually in the defaults) encrypts that section's output.
+    """
+
+    with open(path) as f:
+        inventory = json.load(f)
+
+    defaults = inventory.get('defaults', {})
+    sites = []
+    seen = set()
+
+    for entry in inventory.get('sites', []):
+        name = entry.get('name')
+        if not name or not re.match(r'^[A-Za-z0-9_.-]+$', name):
+            raise InventoryError(f"Every site needs a name made of letters, digits, '.', '_' or '-': {entry}")
+        if name in seen:
+            raise InventoryError(f"Site '{name}' is listed twice.")
+        seen.add(name)
+
+        local_path = os.path.join(entry.get('local_base_path', defaults.get('local_base_path', '.')), name)
+        site = {
+            'name': name,
+            'dir': entry.get('dir', name),
+            'database': entry.get('database'),
+            'archive': entry.get('archive'),
+            'stream_archive': entry.get('stream_archive', defaults.get('stream_archive', False)),
+            'incremental': entry.get('incremental', defaults.get('incremental', False)),
+            'full_every': entry.get('full_every', defaults.get('full_every', 7)),
+            'size_mb': entry.get('size_mb', 0),
+            'enabled': entry.get('enabled', True),
+        }
+
+        for section in SECTIONS:
+            if section not in entry and section not in defaults:
+                site[section] = None
+                continue
+            if entry.get(section) is False:
+                site[section] = None
+                continue
+            config = _resolveSecrets({**defaults.get(section, {}), **entry.get(section, {})})
+            if section in ('ssh', 'sftp'):
+                config.setdefault('local_base_url', local_path)
+            else:
+                config.setdefault('local_base_path', local_path)
+            if section == 'db' and site['database']:
+                config.setdefault('db_name', site['database'])
+            site[section] = config
+
+        site['host'] = entry.get('host') or next(
+            (site[section]['host'] for section in ('ssh', 'sftp', 'ftp', 'db') if site[section] and site[section].get('host')), 'localhost')
+        sites.append(site)
+
+    return sites, inventory.get('host_limits', {})
+
+
+def _loadHistory(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _saveHistory(path, history):
+    if not path:
+        return
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(history, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def backupSite(site, metrics_dir=None, bandwidth=None, progress=None, catalog=None, retention=None):
+    """Run full_backup for one site in a worker process and return a picklable summary."""
+
+    from remote_backup_manager import remote_backup_manager
+    from metrics import METRICS
+    from progress import PROGRESS
+
+    # Tag every log line with the site, since several sites share the terminal
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f"%(levelname)s - [{site['name']}] %(message)s"))
+
+    METRICS.constant_labels = {'site': site['name']}
+    PROGRESS.labels = {'site': site['name']}
+    started = time.monotonic()
+
+    try:
+        manager = remote_backup_manager(site['ftp'], site['ssh'], site['db'], metrics_dir=metrics_dir, sftp_config=site['sftp'],
+                                        bandwidth=bandwidth, progress=progress, catalog=catalog, retention=retention)
+        results = manager.full_backup(site['dir'], site['database'], site['archive'], site['stream_archive'],
+                                      site['incremental'], site['full_every'])
+        stages = {name: {'status': info['status'], 'seconds': round(info['seconds'], 3), 'error': info['error']}
+                  for name, info in results.items()}
+        failed = [name for name, info in stages.items() if info['status'] in ('failed', 'blocked')]
+        error = None if results else "full_backup returned no stage results"
+    except Exception as e:
+        stages, failed, error = {}, [], str(e)
+
+    return {
+        'site': site['name'],
+        'host': site['host'],
+        'success': not failed and error is None,
+        'seconds': round(time.monotonic() - started, 3),
+        'failed_stages': failed,
+        'error': error,
+        'stages': stages,
+    }
+
+
+class BatchScheduler:
+    """
+        Back up many sites at once on a process pool, largest first, without overloading any host.
+
+        At most `workers` sites run at a time overall and at most `per_host` (or the host's
+        entry in host_limits) on any one server. Whenever a slot frees up, the largest waiting
+        site whose host has room is started. Size is the duration of the site's last
+        successful run when one is recorded in the history file, otherwise its size_mb from
+        the inventory turned into seconds at the MB/s the sites with a history achieved.
+        Starting the longest jobs first keeps the whole batch short.
+
+        A crashed worker process breaks the whole pool: the sites that were running on it
+        are started once more on a new pool, one at a time so that a second crash can only be
+        the site's own, and only a site that crashes again fails.
+
+        Bandwidth limits ({'rate', 'per_host'}, see Throttle.configure) apply to the batch as
+        a whole: each worker process gets an equal share of the global limit and each site
+        an equal share of its host's limit.
+    """
+
+    def __init__(self, sites, workers=4, per_host=1, host_limits=None, history_path=None, metrics_dir=None, bandwidth=None,
+                 progress=None, catalog=None, retention=None):
+        self.sites = [site for site in sites if site['enabled']]
+        self.workers = max(1, int(workers))
+        self.per_host = max(1, int(per_host))
+        self.host_limits = host_limits or {}
+        self.history_path = history_path
+        self.history = _loadHistory(history_path)
+        self.metrics_dir = metrics_dir
+        self.bandwidth = bandwidth
+        self.progress = progress  # Sink spec passed to every worker, see progress.parseSinks
+        self.catalog = catalog  # Backup catalog every site records its run in, see backup_catalog.BackupCatalog
+        self.retention = retention
+
+    def hostLimit(self, host):
+        return max(1, int(self.host_limits.get(host, self.per_host)))
+
+    def _bandwidth(self, site):
+        if not self.bandwidth:
+            return None
+        return dict(self.bandwidth, share=min(self.workers, len(self.sites)), host_share=self.hostLimit(site['host']))
+
+    def _throughput(self):
+        """MB/s of the last runs of the sites that have both a recorded duration and a size_mb, or None."""
+
+        megabytes = seconds = 0
+        for site in self.sites:
+            previous = self.history.get(site['name'], {})
+            if previous.get('seconds') and site['size_mb']:
+                megabytes += site['size_mb']
+                seconds += previous['seconds']
+        return megabytes / seconds if seconds else None
+
+    def _weight(self, site, throughput=None):
+        previous = self.history.get(site['name'], {})
+        if previous.get('seconds'):
+            return (0, previous['seconds'])
+        if throughput:
+            return (0, (site['size_mb'] or 0) / throughput)
+        # Without a rate, sizes and durations cannot be compared; new sites go first, as they may be the longest
+        return (1, site['size_mb'] or 0)
+
+    def _nextSite(self, waiting, running_hosts):
+        for index, site in enumerate(waiting):
+            if running_hosts.get(site['host'], 0) < self.hostLimit(site['host']):
+                return waiting.pop(index)
+        return None
+
+    def run(self):
+        """Run every enabled site and return the list of per-site summaries, in completion order."""
+
+        throughput = self._throughput()
+        waiting = sorted(self.sites, key=lambda site: self._weight(site, throughput), reverse=True)
+        running = {}
+        running_hosts = {}
+        summaries = []
+        crashed = set()
+
+        Utils.log(f"Starting batch backup of {len(waiting)} sites with {self.workers} workers "
+                  f"(at most {self.per_host} per host unless overridden).")
+
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            while waiting or running:
+                while len(running) < self.workers:
+                    # A site lost with a crashed pool runs alone, so it cannot take others down with it again
+                    retry = next((site for site in waiting if site['name'] in crashed), None)
+                    if any(site['name'] in crashed for site in running.values()) or (retry and running):
+                        break
+                    if retry is not None:
+                        waiting.remove(retry)
+                        site = retry
+                    else:
+                        site = self._nextSite(waiting, running_hosts)
+                    if site is None:
+                        break
+                    running_hosts[site['host']] = running_hosts.get(site['host'], 0) + 1
+                    arguments = (backupSite, site, self.metrics_dir, self._bandwidth(site), self.progress, self.catalog, self.retention)
+                    try:
+                        future = executor.submit(*arguments)
+                    except BrokenProcessPool:
+                        executor = self._replacePool(executor)
+                        future = executor.submit(*arguments)
+                    running[future] = site
+                    Utils.log(f"Started {site['name']} on {site['host']} ({len(waiting)} waiting).")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    site = running.pop(future)
+                    running_hosts[site['host']] -= 1
+
+                    try:
+                        summary = future.result()
+                    except Exception as e:
+                        # The worker process died, taking every site running on the pool with it; only one of
+                        # them may have caused it, so each gets one more try on the next pool
+                        if isinstance(e, BrokenProcessPool) and site['name'] not in crashed:
+                            crashed.add(site['name'])
+                            waiting.insert(0, site)
+                            Utils.log(f"{site['name']} was lost with a crashed worker process; starting it again.", level='warning')
+                            continue
+                        summary = {'site': site['name'], 'host': site['host'], 'success': False, 'seconds': 0.0,
+                                   'failed_stages': [], 'error': f"worker crashed: {e}", 'stages': {}}
+                    summaries.append(summary)
+
+                    if summary['success']:
+                        self.history[site['name']] = {'seconds': summary['seconds'],
+                                                      'finished': datetime.datetime.now().isoformat(timespec='seconds')}
+                    level = 'info' if summary['success'] else 'error'
+                    Utils.log(f"Finished {site['name']} in {summary['seconds']:.1f}s: "
+                              f"{'ok' if summary['success'] else 'FAILED'} ({len(summaries)}/{len(self.sites)}).", level=level)
+        finally:
+            executor.shutdown(wait=True)
+            _saveHistory(self.history_path, self.history)
+
+        return summaries
+
+    def _replacePool(self, executor):
+        """A crashed worker breaks the whole pool; the remaining sites go to a new one."""
+        Utils.log("A worker process crashed; starting a new process pool for the remaining sites.", level='warning')
+        executor.shutdown(wait=False)
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    @staticmethod
+    def summary(summaries, seconds):
+        """Format one consolidated table of the batch, failures first."""
+
+        ordered = sorted(summaries, key=lambda item: (item['success'], item['site']))
+        succeeded = sum(item['success'] for item in summaries)
+        lines = [f"**** Batch backup: {succeeded}/{len(summaries)} sites succeeded in {datetime.timedelta(seconds=int(seconds))} ****",
+                 f"  {'site':<24} {'host':<28} {'status':<7} {'seconds':>9}  details"]
+        for item in ordered:
+            details = ', '.join(item['failed_stages']) or (item['error'] or '')
+            lines.append(f"  {item['site']:<24} {item['host']:<28} {'ok' if item['success'] else 'FAILED':<7} "
+                         f"{item['seconds']:9.1f}  {details}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Back up every site of an inventory file with per-host concurrency limits.")
+    parser.add_argument('inventory', help="JSON site inventory (see loadInventory)")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BATCH_WORKERS', 4)), help="Sites backed up at once")
+    parser.add_argument('--per-host', type=int, default=int(os.getenv('BATCH_PER_HOST', 1)), help="Sites at once per host")
+    parser.add_argument('--only', help="Comma separated site names to run")
+    parser.add_argument('--history', default=os.getenv('BATCH_HISTORY'), help="JSON file of previous durations used for ordering")
+    parser.add_argument('--summary', help="Write the consolidated summary as JSON to this file")
+    parser.add_argument('--metrics-dir', default=os.getenv('METRICS_DIR'))
+    parser.add_argument('--bandwidth', default=os.getenv('BANDWIDTH_LIMIT'),
+                        help="Total transfer rate, e.g. 20M, or a schedule such as 08:00-20:00=5M,50M")
+    parser.add_argument('--bandwidth-per-host', default=os.getenv('BANDWIDTH_PER_HOST'), help="Transfer rate per host, same format")
+    parser.add_argument('--progress', default=os.getenv('PROGRESS'),
+                        help="Progress sinks: log, tty, json or json:<path>, comma separated; none to disable")
+    parser.add_argument('--catalog', default=os.getenv('BACKUP_CATALOG'), help="SQLite backup catalog every run is recorded in")
+    parser.add_argument('--retention', default=os.getenv('RETENTION'),
+                        help="Prune each site's catalogued runs after a good run, e.g. daily=7,weekly=4,monthly=12,yearly=2")
+    parser.add_argument('--engine', choices=('process', 'async'), default=os.getenv('BATCH_ENGINE', 'process'),
+                        help="'process' runs full_backup in worker processes; 'async' runs every site on one event loop")
+    args = parser.parse_args()
+
+    sites, host_limits = loadInventory(args.inventory)
+    if args.only:
+        wanted = set(args.only.split(','))
+        sites = [site for site in sites if site['name'] in wanted]
+
+    bandwidth = {'rate': args.bandwidth, 'per_host': args.bandwidth_per_host} if args.bandwidth or args.bandwidth_per_host else None
+
+    start_time = time.monotonic()
+    summaries = []
+    if args.engine == 'async':
+        from async_engine import AsyncBackupEngine
+        from throttle import THROTTLE
+        from progress import PROGRESS, parseSinks
+        if bandwidth:
+            THROTTLE.configure(**bandwidth)
+        if args.progress:
+            PROGRESS.configure(parseSinks(args.progress))
+
+        # Sites whose options the event loop does not implement run on the process pool afterwards
+        pooled = []
+        for site in sites:
+            options = AsyncBackupEngine.unsupported(site)
+            if options and site['enabled']:
+                Utils.log(f"{site['name']} uses {', '.join(options)}, which the async engine does not support; "
+                          f"it runs on the process pool instead.", level='warning')
+                pooled.append(site)
+        if args.metrics_dir:
+            Utils.log("--metrics-dir is ignored for sites run by the async engine.", level='warning')
+
+        engine = AsyncBackupEngine(args.workers, args.per_host, host_limits, catalog=args.catalog, retention=args.retention,
+                                   history_path=args.history)
+        summaries = engine.run([site for site in sites if site not in pooled])
+        sites = pooled
+
+    if sites:
+        scheduler = BatchScheduler(sites, args.workers, args.per_host, host_limits, args.history, args.metrics_dir, bandwidth,
+                                   args.progress, args.catalog, args.retention)
+        summaries += scheduler.run()
+    seconds = time.monotonic() - start_time
+
+    failed = [item for item in summaries if not item['success']]
+    Utils.log(BatchScheduler.summary(summaries, seconds), level='error' if failed else 'info')
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump({'finished': datetime.datetime.now().isoformat(timespec='seconds'), 'seconds': round(seconds, 3),
+                       'succeeded': len(summaries) - len(failed), 'failed': len(failed), 'sites': summaries}, f, indent=2)
+
+    raise SystemExit(1 if failed else 0)
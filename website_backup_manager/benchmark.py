@@ -0,0 +1,594 @@
+from helpers import Helpers as Utils
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# name -> (workload, tree)
+SCENARIOS = {
+    'ftp-small': ('ftp', 'small'),
+    'ftp-large': ('ftp', 'large'),
+    'sftp-small': ('sftp', 'small'),
+    'sftp-large': ('sftp', 'large'),
+    'archive-small': ('archive', 'small'),
+    'archive-large': ('archive', 'large'),
+    'stream-small': ('stream', 'small'),
+    'stream-large': ('stream', 'large'),
+    'mysqldump': ('mysqldump', None),
+    'full-backup': ('full', 'small'),
+}
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+
+
+class BenchmarkError(Exception):
+    """Raised when a stand-in server cannot be started or a scenario worker crashes."""
+
+
+def _payload(rng, size):
+    """Half random, half repetitive bytes, so compression has some but not all of the work of real sites."""
+    random_part = rng.randbytes(size // 2)
+    return random_part + (b'<div class="row">lorem ipsum</div>\n' * (size // 35 + 1))[:size - len(random_part)]
+
+
+def generateTree(root, tree, small_files=2000, small_size=4096, large_files=4, large_size=64 * 1024 * 1024, seed=1):
+    """Create (or reuse) a deterministic benchmark tree under root/<tree>; returns (path, files, bytes)."""
+
+    path = os.path.join(root, tree)
+    marker = os.path.join(root, f".{tree}.json")
+    spec = {'small_files': small_files, 'small_size': small_size, 'large_files': large_files,
+            'large_size': large_size, 'seed': seed}
+
+    if os.path.exists(marker):
+        with open(marker) as f:
+            recorded = json.load(f)
+        if recorded['spec'] == spec and os.path.isdir(path):
+            return path, recorded['files'], recorded['bytes']
+        shutil.rmtree(path, ignore_errors=True)
+
+    rng = random.Random(seed)
+    files = total = 0
+
+    if tree == 'small':
+        # Spread like a CMS install: a few hundred directories with a handful of files each
+        for index in range(small_files):
+            directory = os.path.join(path, f"dir{index // 50:03d}", f"sub{index % 5}")
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"file{index:05d}.php"), 'wb') as f:
+                f.write(_payload(rng, small_size))
+            files += 1
+            total += small_size
+    else:
+        os.makedirs(path, exist_ok=True)
+        block_size = 4 * 1024 * 1024
+        for index in range(large_files):
+            with open(os.path.join(path, f"large{index}.bin"), 'wb') as f:
+                remaining = large_size
+                while remaining > 0:
+                    block = _payload(rng, min(block_size, remaining))
+                    f.write(block)
+                    remaining -= len(block)
+            files += 1
+            total += large_size
+
+    with open(marker, 'w') as f:
+        json.dump({'spec': spec, 'files': files, 'bytes': total}, f)
+
+    Utils.log(f"Generated {tree} benchmark tree: {files} files, {total} bytes.")
+    return path, files, total
+
+
+def _selfSignedCertificate(directory):
+    """Write a throwaway certificate and key for the FTPS stand-in; returns (certfile, keyfile)."""
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number()).not_valid_before(now)
+                   .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256()))
+
+    certfile = os.path.join(directory, 'bench-cert.pem')
+    keyfile = os.path.join(directory, 'bench-key.pem')
+    with open(certfile, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+class FTPStandIn:
+    """pyftpdlib FTPS server on 127.0.0.1 serving root, run on a background thread."""
+
+    def __init__(self, root, workdir):
+        try:
+            from pyftpdlib.authorizers import DummyAuthorizer
+            from pyftpdlib.handlers import TLS_FTPHandler
+            from pyftpdlib.servers import ThreadedFTPServer
+        except ImportError:
+            raise BenchmarkError("The FTP stand-in requires 'pyftpdlib' and 'pyopenssl' (pip install pyftpdlib pyopenssl).")
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(BENCH_USER, BENCH_PASSWORD, root, perm='elradfmwMT')
+
+        handler = type('BenchFTPHandler', (TLS_FTPHandler,), {})
+        handler.certfile, handler.keyfile = _selfSignedCertificate(workdir)
+        handler.authorizer = authorizer
+        handler.tls_control_required = True
+        handler.tls_data_required = True
+
+        logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.close_all()
+
+
+class SSHStandIn:
+    """paramiko SSH server on 127.0.0.1 that runs exec requests with the local shell and serves read-only SFTP."""
+
+    def __init__(self):
+        import paramiko
+
+        self.paramiko = paramiko
+        logging.getLogger('paramiko').setLevel(logging.WARNING)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.running = False
+
+    def _serverInterface(self):
+        paramiko = self.paramiko
+
+        class Interface(paramiko.ServerInterface):
+            def check_auth_password(self, username, password):
+                if (username, password) == (BENCH_USER, BENCH_PASSWORD):
+                    return paramiko.AUTH_SUCCESSFUL
+                return paramiko.AUTH_FAILED
+
+            def get_allowed_auths(self, username):
+                return 'password'
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(target=SSHStandIn._runCommand, args=(channel, command), daemon=True).start()
+                return True
+
+        return Interface()
+
+    def _sftpInterface(self):
+        paramiko = self.paramiko
+
+        class Handle(paramiko.SFTPHandle):
+            def stat(self):
+                return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+        class Interface(paramiko.SFTPServerInterface):
+            def list_folder(self, path):
+                try:
+                    entries = []
+                    for name in os.listdir(path):
+                        attributes = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                        attributes.filename = name
+                        entries.append(attributes)
+                    return entries
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+            def stat(self, path):
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.stat(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+            def lstat(self, path):
+                try:
+                    return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+
+            def open(self, path, flags, attr):
+                try:
+                    handle = Handle(flags)
+                    handle.readfile = open(path, 'rb')
+                except OSError as e:
+                    return paramiko.SFTPServer.convert_errno(e.errno)
+                handle.filename = path
+                return handle
+
+        return Interface
+
+    @staticmethod
+    def _runCommand(channel, command):
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def forwardStderr():
+            for data in iter(lambda: process.stderr.read(65536), b''):
+                channel.sendall_stderr(data)
+
+        stderr_thread = threading.Thread(target=forwardStderr, daemon=True)
+        stderr_thread.start()
+        try:
+            for data in iter(lambda: process.stdout.read(1024 * 1024), b''):
+                channel.sendall(data)
+        except OSError:
+            process.kill()
+        stderr_thread.join()
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                break
+            transport = self.paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', self.paramiko.SFTPServer, self._sftpInterface())
+            transport.start_server(server=self._serverInterface())
+            self.transports.append(transport)
+
+    def start(self):
+        self.running = True
+        self.socket.listen(16)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+FAKE_MYSQLDUMP = '''#!{python}
+import os, random, sys, time
+
+size = int(os.environ['BENCH_DUMP_BYTES'])
+rate = float(os.environ.get('BENCH_DUMP_RATE', '0'))  # bytes per second, 0 = as fast as possible
+
+rng = random.Random(1)
+blocks = []
+for block_index in range(16):
+    rows = []
+    for row in range(8000):
+        rows.append("(%d,'user%d@example.com','%s',%d)" % (block_index * 8000 + row, rng.randrange(10 ** 6),
+                                                           rng.randbytes(24).hex(), rng.randrange(10 ** 9)))
+    blocks.append(("INSERT INTO `users` VALUES " + ",".join(rows) + ";\\n").encode())
+
+output = sys.stdout.buffer
+output.write(b"-- Synthetic benchmark dump\\n")
+written = 0
+started = time.monotonic()
+index = 0
+while written < size:
+    block = blocks[index % len(blocks)][:size - written]
+    output.write(block)
+    written += len(block)
+    index += 1
+    if rate:
+        ahead = written / rate - (time.monotonic() - started)
+        if ahead > 0:
+            time.sleep(ahead)
+'''
+
+FAKE_MYSQL = '''#!{python}
+import os
+print("%s\\t0\\t%d" % (os.environ['BENCH_DUMP_BYTES'], int(os.environ['BENCH_DUMP_BYTES']) // 100))
+'''
+
+
+def writeFakeMysqlClients(directory):
+    """Install fake mysqldump / mysql executables that emit synthetic data; returns the bin directory."""
+
+    bin_dir = os.path.join(directory, 'fakebin')
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, source in (('mysqldump', FAKE_MYSQLDUMP), ('mysql', FAKE_MYSQL)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(source.replace('{python}', sys.executable))
+        os.chmod(path, 0o755)
+    return bin_dir
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda fraction: values[min(len(values) - 1, int(len(values) * fraction))]
+    return {'p50': round(pick(0.50) * 1000, 3), 'p95': round(pick(0.95) * 1000, 3),
+            'max': round(values[-1] * 1000, 3), 'mean': round(sum(values) / len(values) * 1000, 3)}
+
+
+def _directorySize(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def runScenario(spec):
+    """
+        Run one scenario in this (worker) process and return its measurements.
+
+        The stand-in servers live in the parent process, so getrusage here measures only the
+        client side: the backup code and, under child_cpu_seconds, the programs it spawns.
+    """
+
+    from remote_backup_manager import remote_backup_manager
+
+    workload, tree = SCENARIOS[spec['scenario']]
+    output = spec['output']
+    os.makedirs(output, exist_ok=True)
+
+    ftp_config = {'host': '127.0.0.1', 'username': BENCH_USER, 'password': BENCH_PASSWORD, 'port': spec['ftp_port'],
+                  'local_base_path': output, 'host_base_path': '/', 'workers': spec['ftp_workers']}
+    ssh_config = {'host': '127.0.0.1', 'user': BENCH_USER, 'password': BENCH_PASSWORD, 'port': spec['ssh_port'],
+                  'local_base_url': output, 'host_base_url': spec['server_root']}
+    db_config = dict(spec['db'], local_base_path=output, compression=spec['db_compression'])
+
+    # Each file is timed from the start of its transfer to its verified completion
+    latencies = []
+    starts = {}
+    lock = threading.Lock()
+
+    def on_start(remote_path, local_path, entry):
+        with lock:
+            starts[remote_path] = time.perf_counter()
+
+    def on_done(remote_path, local_path, entry):
+        now = time.perf_counter()
+        with lock:
+            latencies.append(now - starts.pop(remote_path))
+
+    result = {}
+    started = time.perf_counter()
+
+    if workload == 'ftp':
+        manager = remote_backup_manager(ftp_config=ftp_config)
+        ok = manager.ftp_downloader.download(tree, on_done=on_done, on_start=on_start)
+    elif workload == 'sftp':
+        manager = remote_backup_manager(sftp_config=dict(ssh_config, workers=spec['ftp_workers']))
+        ok = manager.ftp_downloader.download(tree, on_done=on_done, on_start=on_start)
+    elif workload == 'archive':
+        manager = remote_backup_manager(ftp_config=ftp_config, ssh_config=ssh_config)
+        stages = manager.full_backup(tree, None, website_archive_name=f"bench-{tree}")
+        ok = all(info['status'] in ('ok', 'skipped') for info in stages.values())
+        result['stages'] = {name: round(info['seconds'], 3) for name, info in stages.items()}
+    elif workload == 'stream':
+        manager = remote_backup_manager(ssh_config=ssh_config)
+        ok = bool(manager.stream_remote_archive(tree, f"bench-{tree}"))
+    elif workload == 'mysqldump':
+        manager = remote_backup_manager(db_config=db_config)
+        ok = manager.dump_database('bench')
+    else:
+        manager = remote_backup_manager(ftp_config=ftp_config, ssh_config=ssh_config, db_config=db_config)
+        stages = manager.full_backup(tree, 'bench', website_archive_name=f"bench-{tree}")
+        ok = all(info['status'] in ('ok', 'skipped') for info in stages.values())
+        result['stages'] = {name: round(info['seconds'], 3) for name, info in stages.items()}
+
+    seconds = time.perf_counter() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    source_bytes = spec['tree_bytes'].get(tree, 0) if tree else 0
+    if workload in ('mysqldump', 'full'):
+        source_bytes += spec['dump_bytes']
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+
+    result.update({
+        'scenario': spec['scenario'],
+        'ok': bool(ok),
+        'seconds': round(seconds, 3),
+        'source_bytes': source_bytes,
+        'output_bytes': _directorySize(output),
+        'throughput_mb_s': round(source_bytes / seconds / (1024 * 1024), 3) if seconds > 0 else None,
+        'files': len(latencies) or None,
+        'file_completion_ms': _percentiles(latencies),
+        'cpu_user_seconds': round(usage.ru_utime, 3),
+        'cpu_system_seconds': round(usage.ru_stime, 3),
+        'child_cpu_seconds': round(children.ru_utime + children.ru_stime, 3),
+        'peak_rss_mb': round(usage.ru_maxrss * rss_unit / (1024 * 1024), 1),
+    })
+    return result
+
+
+def _runWorker(spec, env, verbose):
+    """Run one scenario in a fresh interpreter so CPU time and peak RSS belong to that scenario alone."""
+
+    command = [sys.executable, os.path.abspath(__file__), '--worker', json.dumps(spec)]
+    if verbose:
+        command.append('--verbose')
+
+    process = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=None if verbose else subprocess.PIPE,
+                             text=True)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        raise BenchmarkError(f"Scenario {spec['scenario']} crashed:\n{process.stderr or ''}")
+    return json.loads(lines[-1])
+
+
+def runBenchmarks(args):
+    """Start the stand-ins, run every requested scenario `repeat` times and return the JSON report."""
+
+    workdir = os.path.abspath(args.workdir or os.path.join(tempfile.gettempdir(), 'backup-benchmark'))
+    server_root = os.path.join(workdir, 'server')
+    os.makedirs(server_root, exist_ok=True)
+
+    scenarios = args.scenarios.split(',')
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        raise BenchmarkError(f"Unknown scenario(s): {', '.join(unknown)}. Available: {', '.join(SCENARIOS)}")
+
+    tree_bytes = {}
+    for tree in sorted({SCENARIOS[name][1] for name in scenarios if SCENARIOS[name][1]}):
+        _, _, tree_bytes[tree] = generateTree(server_root, tree, args.small_files, args.small_size,
+                                              args.large_files, args.large_mb * 1024 * 1024)
+
+    env = dict(os.environ)
+    dump_bytes = args.dump_mb * 1024 * 1024
+    if args.db_host:
+        db = {'db_name': args.db_name, 'username': args.db_user, 'password': args.db_password,
+              'host': args.db_host, 'port': args.db_port}
+    else:
+        env['PATH'] = writeFakeMysqlClients(workdir) + os.pathsep + env.get('PATH', '')
+        env['BENCH_DUMP_BYTES'] = str(dump_bytes)
+        env['BENCH_DUMP_RATE'] = str(args.dump_rate_mb * 1024 * 1024)
+        db = {'db_name': 'bench', 'username': BENCH_USER, 'password': BENCH_PASSWORD, 'host': '127.0.0.1', 'port': 3306}
+
+    ftp_server = FTPStandIn(server_root, workdir).start()
+    ssh_server = SSHStandIn().start()
+
+    results = []
+    try:
+        for name in scenarios:
+            for run in range(args.repeat):
+                output = os.path.join(workdir, 'output', f"{name}-{run}")
+                shutil.rmtree(output, ignore_errors=True)
+                # Archives from an earlier run would otherwise be overwritten mid-download
+                for archive in os.listdir(server_root):
+                    if archive.startswith('bench-'):
+                        os.remove(os.path.join(server_root, archive))
+
+                spec = {'scenario': name, 'output': output, 'server_root': server_root,
+                        'ftp_port': ftp_server.port, 'ssh_port': ssh_server.port, 'ftp_workers': args.ftp_workers,
+                        'db': db, 'db_compression': args.db_compression, 'tree_bytes': tree_bytes,
+                        'dump_bytes': dump_bytes}
+
+                result = _runWorker(spec, env, args.verbose)
+                result['run'] = run
+                results.append(result)
+                Utils.log(f"{name} run {run}: {result['seconds']}s, {result['throughput_mb_s']} MB/s, "
+                          f"cpu {result['cpu_user_seconds'] + result['cpu_system_seconds']:.2f}s, "
+                          f"peak RSS {result['peak_rss_mb']} MB" + ("" if result['ok'] else " (FAILED)"))
+
+                if not args.keep_output:
+                    shutil.rmtree(output, ignore_errors=True)
+    finally:
+        ftp_server.stop()
+        ssh_server.stop()
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'git_revision': _gitRevision(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('worker', 'output', 'compare', 'db_password')},
+        'results': results,
+    }
+
+
+def _gitRevision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareReports(baseline, current):
+    """Format the median throughput and CPU time change of every scenario present in both reports."""
+
+    def medians(report):
+        grouped = {}
+        for result in report['results']:
+            grouped.setdefault(result['scenario'], []).append(result)
+        summary = {}
+        for name, runs in grouped.items():
+            pick = lambda key: sorted(run[key] or 0 for run in runs)[len(runs) // 2]
+            cpu = sorted(run['cpu_user_seconds'] + run['cpu_system_seconds'] for run in runs)[len(runs) // 2]
+            summary[name] = (pick('throughput_mb_s'), cpu, pick('peak_rss_mb'))
+        return summary
+
+    before, after = medians(baseline), medians(current)
+    lines = [f"{'scenario':<14} {'MB/s before':>12} {'MB/s after':>11} {'change':>8} {'cpu s':>13} {'rss MB':>13}"]
+    for name in after:
+        if name not in before:
+            continue
+        (old_rate, old_cpu, old_rss), (new_rate, new_cpu, new_rss) = before[name], after[name]
+        change = f"{(new_rate / old_rate - 1) * 100:+.1f}%" if old_rate else 'n/a'
+        lines.append(f"{name:<14} {old_rate:>12.2f} {new_rate:>11.2f} {change:>8} {old_cpu:>6.2f}->{new_cpu:<6.2f}"
+                     f" {old_rss:>6.1f}->{new_rss:<6.1f}")
+    return "\n".join(lines)
+
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the backup managers against local FTP, SSH and MySQL stand-ins.")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma separated: " + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument('--compare', help="Earlier JSON report to compare the results with")
+    parser.add_argument('--workdir', help="Where trees and outputs are kept (default: <tmp>/backup-benchmark)")
+    parser.add_argument('--keep-output', action='store_true')
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--large-files', type=int, default=4)
+    parser.add_argument('--large-mb', type=int, default=64)
+    parser.add_argument('--ftp-workers', type=int, default=4, help="FTPS sessions or SFTP channels for the ftp-* and sftp-* scenarios")
+    parser.add_argument('--dump-mb', type=int, default=256, help="Size of the synthetic mysqldump output")
+    parser.add_argument('--dump-rate-mb', type=float, default=0, help="Rate limit of the synthetic mysqldump, 0 = unlimited")
+    parser.add_argument('--db-compression', default=None, choices=['gzip', 'zstd'])
+    parser.add_argument('--db-host', help="Benchmark a real MySQL/MariaDB server instead of the synthetic mysqldump")
+    parser.add_argument('--db-port', type=int, default=3306)
+    parser.add_argument('--db-user', default='root')
+    parser.add_argument('--db-password', default='')
+    parser.add_argument('--db-name', default='bench')
+    parser.add_argument('--verbose', action='store_true', help="Show the backup log of every scenario")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments()
+
+    if args.worker:
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(runScenario(json.loads(args.worker))))
+        sys.exit(0)
+
+    report = runBenchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        Utils.log(f"Benchmark report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compareReports(json.load(f), report))
@@ -0,0 +1,213 @@
+from helpers import Helpers as Utils
+from stream_compressor import ParallelCompressor, openCompressed
+from checksums import HashingWriter
+from encryption import sealing, storedPath
+from metrics import METRICS
+import datetime
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+# Written near the top of a dump taken with --master-data=2 / --source-data=2
+DUMP_POSITION_PATTERN = re.compile(
+    rb"CHANGE (?:MASTER|REPLICATION SOURCE) TO (?:MASTER|SOURCE)_LOG_FILE='([^']+)',\s*(?:MASTER|SOURCE)_LOG_POS=(\d+)"
+)
+
+
+class BinlogChainError(Exception):
+    """Raised when the binary logs since the last backup are no longer available on the server."""
+
+
+def parseDumpPosition(data):
+    """Return {'file', 'position'} from the head of a mysqldump stream, or None."""
+
+    match = DUMP_POSITION_PATTERN.search(data)
+    if match is None:
+        return None
+    return {'file': match.group(1).decode(), 'position': int(match.group(2))}
+
+
+class BinlogBackup:
+    """
+        Incremental MySQL backups made of the binary logs written since a full dump.
+
+        A chain starts with a full dump and the binlog coordinates it was taken at. Each
+        incremental run issues FLUSH BINARY LOGS, so every log before the new current one is
+        closed and immutable, then copies the closed logs it has not seen yet with
+        `mysqlbinlog --read-from-remote-server --raw` and compresses them. A run only
+        transfers what was written since the previous one, and the next run starts at the
+        beginning of the log that FLUSH opened.
+
+        Restores load the full dump, then pipe the logs through `mysqlbinlog --database`,
+        optionally stopping at a point in time.
+
+        Layout under <local_base_path>/<db_name>.binlog/:
+            chain.json                   full dump, current position and fetched segments
+            chain.<timestamp>.json       previous chains, kept when a new full dump starts one
+            <binlog file>.gz             raw binary log, compressed
+    """
+
+    STATE_NAME = 'chain.json'
+
+    def __init__(self, database):
+        self.database = database
+        self.directory = os.path.join(database.local_base_path, f"{database.db_name}.binlog")
+        self.compression = database.compression or 'gzip'
+
+    @property
+    def state_path(self):
+        return os.path.join(self.directory, self.STATE_NAME)
+
+    def loadState(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _saveState(self, state):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def startChain(self, dump_path, kind, position):
+        """Record a finished full dump as the base of a new chain of incrementals."""
+
+        if not position:
+            Utils.log(f"No binlog position recorded for {dump_path}; is binary logging enabled? "
+                      f"Incremental backups need a new full dump first.", level='warning')
+            return None
+
+        previous = self.loadState()
+        if previous is not None:
+            archived = os.path.join(self.directory, f"chain.{previous['full']['created'].replace(':', '')}.json")
+            os.replace(self.state_path, archived)
+
+        state = {
+            'database': self.database.db_name,
+            'full': {
+                'path': dump_path,
+                'kind': kind,  # 'file', 'parallel' or 'chunk_store'
+                'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                'binlog': position,
+            },
+            'position': {'file': position['file'], 'position': position['position']},
+            'segments': [],
+        }
+        self._saveState(state)
+
+        Utils.log(f"Binlog chain started at {position['file']}:{position['position']} for '{self.database.db_name}'.")
+        return state
+
+    def _query(self, statement):
+        """Run statements with the mysql client and return the rows of the last result set."""
+
+        command = self.database._clientCommand('mysql') + ["--batch", "--skip-column-names", "-e", statement]
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        return [line.split('\t') for line in result.stdout.splitlines() if line]
+
+    def _closedLogs(self, start_file):
+        """Rotate the binary log and return the closed logs from start_file on, oldest first."""
+
+        rows = self._query("FLUSH BINARY LOGS; SHOW BINARY LOGS;")
+        names = [row[0] for row in rows]
+
+        if start_file not in names:
+            raise BinlogChainError(f"Binary log {start_file} has been purged from the server; take a new full dump.")
+
+        # The last log is the one FLUSH just opened; everything before it is complete
+        return names[names.index(start_file):-1], names[-1]
+
+    def _storeSegment(self, raw_path):
+        """Compress one fetched binary log into the chain directory; return (path, raw bytes, digest)."""
+
+        output_path = storedPath(os.path.join(self.directory, os.path.basename(raw_path) + ParallelCompressor.extension(self.compression)),
+                                 self.database.cipher)
+
+        with open(raw_path, 'rb') as source, open(output_path, 'wb') as f, sealing(f, self.database.cipher) as sealed:
+            hashing = HashingWriter(sealed, self.database.checksum)
+            with ParallelCompressor(hashing, self.compression, self.database.compression_level,
+                                    self.database.compression_workers) as writer:
+                shutil.copyfileobj(source, writer, 4 * 1024 * 1024)
+
+        return output_path, writer.raw_bytes, hashing.hexdigest()
+
+    def fetch(self):
+        """Copy the binary logs written since the last run; returns the new segments."""
+
+        state = self.loadState()
+        if state is None:
+            raise BinlogChainError(f"No full dump recorded for '{self.database.db_name}'; take a full dump with binlog enabled first.")
+
+        position = state['position']
+        files, current = self._closedLogs(position['file'])
+
+        segments = []
+        started = time.monotonic()
+        with tempfile.TemporaryDirectory(dir=self.directory) as staging:
+            command = self.database._clientCommand('mysqlbinlog') + [
+                "--read-from-remote-server",
+                "--raw",
+                f"--result-file={staging}{os.sep}",
+            ] + files
+            result = subprocess.run(command, capture_output=True)
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, command, stderr=result.stderr)
+
+            for file_name in files:
+                path, size, digest = self._storeSegment(os.path.join(staging, file_name))
+                segments.append({
+                    'file': os.path.basename(path),
+                    'binlog': file_name,
+                    # Events before this offset of the first log are already in the full dump
+                    'start_position': position['position'] if file_name == position['file'] else 4,
+                    'bytes': size,
+                    self.database.checksum: digest,
+                    'fetched': datetime.datetime.now().isoformat(timespec='seconds'),
+                })
+
+        state['segments'].extend(segments)
+        state['position'] = {'file': current, 'position': 4}
+        self._saveState(state)
+
+        METRICS.transfer('binlog', sum(segment['bytes'] for segment in segments), time.monotonic() - started, len(segments))
+
+        return segments
+
+    def replay(self, stop_datetime=None, chunk_size=1024 * 1024):
+        """Apply every fetched segment to the database, stopping before stop_datetime when given."""
+
+        state = self.loadState()
+        if state is None or not state['segments']:
+            Utils.log(f"No binlog segments to replay for '{self.database.db_name}'.")
+            return 0
+
+        segments = state['segments']
+
+        with tempfile.TemporaryDirectory(dir=self.directory) as staging:
+            # mysqlbinlog needs seekable files, so the segments are decompressed first
+            paths = []
+            for segment in segments:
+                path = os.path.join(staging, segment['binlog'])
+                with openCompressed(os.path.join(self.directory, segment['file']), cipher=self.database.cipher) as source, \
+                        open(path, 'wb') as f:
+                    shutil.copyfileobj(source, f, chunk_size)
+                paths.append(path)
+
+            # --start-position only applies to the first file, which is the only one the full dump covers in part
+            decode = ["mysqlbinlog", f"--database={self.database.db_name}",
+                      f"--start-position={segments[0]['start_position']}"]
+            if stop_datetime is not None:
+                decode.append(f"--stop-datetime={stop_datetime}")
+
+            self.database._pipeInto(decode + paths)
+
+        Utils.log(f"Replayed {len(segments)} binlog segment(s) into '{self.database.db_name}'"
+                  + (f" up to {stop_datetime}." if stop_datetime else "."))
+        return len(segments)
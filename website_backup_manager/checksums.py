@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+
+# Command-line tools whose output format matches the sidecar files, for remote and manual checks
+CHECKSUM_TOOLS = {'sha256': 'sha256sum', 'blake2b': 'b2sum'}
+
+
+class HashingWriter:
+    """
+        File-like writer that hashes and counts every byte on its way to the wrapped file.
+
+        algorithm None only counts; initial is the hash of data already in the file (a resumed download).
+    """
+
+    def __init__(self, fileobj, algorithm='sha256', initial=None):
+        self.fileobj = fileobj
+        self.algorithm = algorithm
+        self.hash = initial or (hashlib.new(algorithm) if algorithm else None)
+        self.bytes_written = 0
+
+    def write(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash is not None else None
+
+
+def fileDigest(path, algorithm='sha256', block_size=4 * 1024 * 1024, limit=None):
+    """Hash a local file, or only its first `limit` bytes."""
+
+    digest = hashlib.new(algorithm)
+    remaining = limit
+
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+    return digest
+
+
+def sidecarPath(path, algorithm='sha256'):
+    """Digest file kept next to a backup file or directory, e.g. site.tar.gz.sha256."""
+    return f"{path.rstrip(os.sep)}.{algorithm}"
+
+
+def writeSidecar(path, digests, algorithm='sha256'):
+    """
+        Record {file path: hex digest} next to `path` in sha256sum/b2sum format.
+
+        Paths are written relative to the sidecar's directory, so `sha256sum -c` works from there.
+    """
+
+    sidecar = sidecarPath(path, algorithm)
+    base = os.path.dirname(os.path.abspath(sidecar))
+
+    with open(sidecar, 'w') as f:
+        for file_path in sorted(digests):
+            relative = os.path.relpath(os.path.abspath(file_path), base).replace(os.sep, '/')
+            f.write(f"{digests[file_path]}  {relative}\n")
+
+    return sidecar
+
+
+def readSidecar(sidecar):
+    """Return {absolute file path: hex digest} from a sidecar file."""
+
+    base = os.path.dirname(os.path.abspath(sidecar))
+    digests = {}
+
+    with open(sidecar) as f:
+        for line in f:
+            digest, _, relative = line.rstrip('\n').partition('  ')
+            if relative:
+                digests[os.path.normpath(os.path.join(base, relative))] = digest
+
+    return digests
+
+
+def verifySidecar(path, algorithm='sha256'):
+    """Re-hash the files recorded for `path` and return the ones that are missing or changed."""
+
+    mismatched = []
+    for file_path, expected in readSidecar(sidecarPath(path, algorithm)).items():
+        if not os.path.exists(file_path) or fileDigest(file_path, algorithm).hexdigest() != expected:
+            mismatched.append(file_path)
+
+    return mismatched
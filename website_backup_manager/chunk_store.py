@@ -0,0 +1,423 @@
+from helpers import Helpers as Utils
+from encryption import EXTENSION, EncryptionError
+import collections
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Fixed byte permutation and hash test, so every store and process cuts the same data in the same places
+GEAR_TABLE = bytes(sorted(range(256), key=lambda value: hashlib.sha256(bytes([value])).digest()))
+CUT_TABLE = bytes(0 if value & 0xC0 == 0 else 1 for value in range(256))
+
+
+class ChunkStore:
+    """
+        Local content-addressed store that keeps every unique chunk of backup data once.
+
+        Streams are split at content-defined boundaries so an edit anywhere in a file only
+        changes the chunks around it. Every byte position gets a rolling hash of the `window`
+        bytes ending there: the bytes go through a fixed permutation table and are multiplied,
+        as one big integer, by a fixed odd `window`-byte constant, so each byte of the product
+        mixes the table values of the bytes before it. A cut goes after a run of hash bytes
+        whose top two bits are zero, with normalized chunking as in FastCDC: no cut before
+        min_chunk_size, a longer run (rarer cut) until avg_chunk_size, a shorter one after
+        it, and a forced cut at max_chunk_size. translate(), the multiplication and find()
+        keep the scan at C speed, while SHA-256, zlib and disk writes for each chunk run on
+        a thread pool (all three release the GIL).
+
+        With `cipher` (an encryption.BackupCipher), chunks are named by a keyed HMAC of their
+        plaintext instead of its sha256 and sealed after compression with a key derived from
+        that name, so equal chunks still land on the same file while the store holds no
+        plaintext. Manifests record whether their chunks are encrypted.
+
+        Layout under root:
+            chunks/ab/cd/<sha256 or HMAC>        zlib-compressed (then sealed) chunk
+            manifests/<name>/<timestamp>.json    ordered chunk list that rebuilds one backup file
+    """
+
+    def __init__(self, root, workers=None, avg_chunk_size=1024 * 1024, min_chunk_size=256 * 1024,
+                 max_chunk_size=4 * 1024 * 1024, window=16, compress_level=1, cipher=None):
+        self.root = root
+        self.cipher = cipher
+        self.workers = workers or os.cpu_count() or 1
+        self.avg_chunk_size = avg_chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.window = window
+        self.compress_level = compress_level
+
+        # Each hash byte passes with probability 1/4, so a run of n of them is a 2 * n bit test;
+        # cuts are two bits rarer than the average before it and two bits likelier after
+        bits = max(2, avg_chunk_size.bit_length() - 1)
+        self.strict_run = (bits + 2) // 2
+        self.loose_run = max(1, (bits - 2) // 2)
+        self._multiplier = int.from_bytes(hashlib.sha256(b'chunk-store-rolling-hash').digest()[:window].ljust(window, b'\x01'),
+                                          'little') | 1
+        # Bytes that reach the hash from before a searched range; carries rarely travel past the window
+        self._warmup = window * 2
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        os.makedirs(os.path.join(root, 'chunks'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+
+    def _boundary(self, buffer, low, high, run):
+        """
+            First cut position in [low, high] that follows `run` passing hash bytes, or -1.
+
+            The hash of position i covers buffer[i - window + 1:i + 1] and is only read for
+            positions at least _warmup bytes into the hashed slice, so the result does not
+            depend on where earlier searches started.
+        """
+
+        first = low - run
+        base = max(0, first - self._warmup)
+        product = int.from_bytes(buffer[base:high].translate(GEAR_TABLE), 'little') * self._multiplier
+        hashes = product.to_bytes(high - base + self.window, 'little')[first - base:high - base].translate(CUT_TABLE)
+
+        offset = hashes.find(b'\x00' * run)
+        return -1 if offset == -1 else first + offset + run
+
+    def chunkPath(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest[2:4], digest)
+
+    def _storeChunk(self, data):
+        """Hash and store one chunk unless it is already present; return (digest, size, new stored bytes)."""
+
+        digest = self.cipher.chunkId(data) if self.cipher is not None else hashlib.sha256(data).hexdigest()
+        path = self.chunkPath(digest)
+
+        if os.path.exists(path):
+            try:
+                # A fresh mtime keeps collect() off chunks that a manifest still being written refers to
+                os.utime(path)
+                return digest, len(data), 0
+            except FileNotFoundError:
+                pass  # Collected in the meantime; store it again
+
+        compressed = zlib.compress(data, self.compress_level)
+        if self.cipher is not None:
+            compressed = self.cipher.sealChunk(digest, compressed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename so concurrent writers of the same chunk never expose a partial file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(temp_path, path)
+
+        return digest, len(data), len(compressed)
+
+    def writer(self, name):
+        """Return a file-like ChunkWriter that stores a stream as backup `name`."""
+        return ChunkWriter(self, name)
+
+    def ingestFile(self, name, path, block_size=4 * 1024 * 1024):
+        """
+            Store an existing local file and return its manifest.
+
+            An encrypted file (.enc) is read through the store's cipher: its ciphertext never
+            repeats between runs, so the plaintext is what gets chunked (and sealed again per chunk).
+        """
+
+        if path.endswith(EXTENSION):
+            if self.cipher is None:
+                raise EncryptionError(f"{path} is encrypted; give the chunk store the encryption key to ingest it.")
+            source = self.cipher.open(path)
+        else:
+            source = open(path, 'rb')
+
+        with source as f, self.writer(name) as writer:
+            for block in iter(lambda: f.read(block_size), b''):
+                writer.write(block)
+        return writer.manifest
+
+    def manifestPath(self, name, timestamp):
+        if '..' in name.split('/'):
+            raise ValueError(f"Invalid backup name: {name}")
+        return os.path.join(self.root, 'manifests', name, f"{timestamp}.json")
+
+    def latestManifest(self, name):
+        directory = os.path.join(self.root, 'manifests', name)
+        if not os.path.isdir(directory):
+            return None
+        manifests = sorted(entry for entry in os.listdir(directory) if entry.endswith('.json'))
+        return os.path.join(directory, manifests[-1]) if manifests else None
+
+    def read(self, manifest_path):
+        """
+            Yield the original file of a manifest block by block, verifying every chunk digest and the
+            whole-file sha256 at the end.
+        """
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        cipher = self.cipher if manifest.get('encrypted') else None
+        if manifest.get('encrypted') and cipher is None:
+            raise EncryptionError(f"{manifest['name']} is stored encrypted; give the chunk store the encryption key to read it.")
+
+        digest = hashlib.sha256()
+
+        # Decompression runs ahead on the pool while earlier chunks are handed out in order
+        pending = collections.deque()
+
+        def load(chunk_digest):
+            with open(self.chunkPath(chunk_digest), 'rb') as chunk_file:
+                data = chunk_file.read()
+            if cipher is not None:
+                data = cipher.openChunk(chunk_digest, data)
+            data = zlib.decompress(data)
+            if (cipher.chunkId(data) if cipher is not None else hashlib.sha256(data).hexdigest()) != chunk_digest:
+                raise ValueError(f"Chunk {chunk_digest} is corrupted")
+            return data
+
+        for chunk_digest, _ in manifest['chunks']:
+            pending.append(self._executor.submit(load, chunk_digest))
+            if len(pending) > self.workers * 2:
+                data = pending.popleft().result()
+                digest.update(data)
+                yield data
+        while pending:
+            data = pending.popleft().result()
+            digest.update(data)
+            yield data
+
+        if 'sha256' in manifest and digest.hexdigest() != manifest['sha256']:
+            raise ValueError(f"Restored {manifest['name']} does not match its recorded sha256")
+
+    def restore(self, manifest_path, output_path):
+        """Rebuild the original file of a manifest, verifying every chunk digest and the whole-file sha256."""
+
+        with open(output_path, 'wb') as f:
+            for data in self.read(manifest_path):
+                f.write(data)
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        Utils.log(f"Restored {manifest['name']} ({manifest['size']} bytes) to {output_path}")
+        return output_path
+
+    def stats(self):
+        """Return logical vs stored bytes over all manifests and chunks; dedup_ratio includes chunk compression."""
+
+        logical_bytes = 0
+        manifests = 0
+        for directory, _, files in os.walk(os.path.join(self.root, 'manifests')):
+            for file_name in files:
+                if file_name.endswith('.json'):
+                    with open(os.path.join(directory, file_name)) as f:
+                        logical_bytes += json.load(f)['size']
+                    manifests += 1
+
+        stored_bytes = 0
+        chunks = 0
+        for directory, _, files in os.walk(os.path.join(self.root, 'chunks')):
+            for file_name in files:
+                if not file_name.endswith('.tmp'):
+                    stored_bytes += os.path.getsize(os.path.join(directory, file_name))
+                    chunks += 1
+
+        return {
+            'manifests': manifests,
+            'chunks': chunks,
+            'logical_bytes': logical_bytes,
+            'stored_bytes': stored_bytes,
+            'dedup_ratio': logical_bytes / stored_bytes if stored_bytes else 0.0,
+        }
+
+    @staticmethod
+    def rootOf(manifest_path):
+        """Root of the store a manifest belongs to, or None if it is not inside one."""
+
+        directory = os.path.dirname(os.path.abspath(manifest_path))
+        while os.path.dirname(directory) != directory:
+            parent = os.path.dirname(directory)
+            if os.path.basename(directory) == 'manifests' and os.path.isdir(os.path.join(parent, 'chunks')):
+                return parent
+            directory = parent
+        return None
+
+    def collect(self, grace=24 * 3600, excluded=(), dry_run=False):
+        """
+            Mark and sweep: delete the chunks that no manifest refers to any more.
+
+            Every manifest left in the store is read to mark the chunks in use; the others are
+            removed, except those stored or reused in the last `grace` seconds, which may belong
+            to a backup whose manifest is not written yet. Manifests in `excluded` count as
+            already deleted (to see what a prune would free). Returns {'chunks', 'bytes'} removed,
+            or that would be with dry_run.
+        """
+
+        excluded = {os.path.abspath(path) for path in excluded}
+        referenced = set()
+        for directory, _, files in os.walk(os.path.join(self.root, 'manifests')):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                if file_name.endswith('.json') and os.path.abspath(path) not in excluded:
+                    with open(path) as f:
+                        referenced.update(chunk_digest for chunk_digest, _ in json.load(f)['chunks'])
+
+        cutoff = time.time() - grace
+        removed = {'chunks': 0, 'bytes': 0}
+        for directory, _, files in os.walk(os.path.join(self.root, 'chunks')):
+            for file_name in files:
+                if file_name.endswith('.tmp') or file_name in referenced:
+                    continue
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime > cutoff:
+                        continue
+                    if not dry_run:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed['chunks'] += 1
+                removed['bytes'] += stat.st_size
+
+        if not dry_run and removed['chunks']:
+            Utils.log(f"Collected {removed['chunks']} unreferenced chunk(s) from {self.root}: {removed['bytes']} bytes freed.")
+        return removed
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ChunkWriter:
+    """File-like writer that chunks a stream into a ChunkStore and writes its manifest on close()."""
+
+    COMPACT_THRESHOLD = 16 * 1024 * 1024
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.size = 0
+        self.new_bytes = 0
+        self.manifest = None
+        self.manifest_path = None
+
+        self._buffer = bytearray()
+        self._start = 0  # Start of the current chunk in _buffer
+        self._scan = 0   # Where the boundary search resumes in _buffer
+        self._pending = collections.deque()
+        self._chunks = []
+        self._closed = False
+        self._started = datetime.datetime.now()
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self._digest.update(data)
+        self._buffer += data
+        self._cut()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _emit(self, end):
+        chunk = bytes(self._buffer[self._start:end])
+        self._start = end
+        self._scan = end
+
+        self._pending.append(self.store._executor.submit(self.store._storeChunk, chunk))
+        self._drain(self.store.workers * 4)
+
+    def _drain(self, keep):
+        while len(self._pending) > keep:
+            digest, size, new_bytes = self._pending.popleft().result()
+            self._chunks.append([digest, size])
+            self.new_bytes += new_bytes
+
+    def _cut(self, final=False):
+        store = self.store
+        buffer = self._buffer
+
+        while True:
+            end = len(buffer)
+            normal = self._start + store.avg_chunk_size
+            limit = self._start + store.max_chunk_size
+
+            # _scan is the first cut position not searched yet for the current chunk
+            cut = -1
+            for low, high, run in ((self._start + store.min_chunk_size, normal, store.strict_run),
+                                   (normal + 1, limit, store.loose_run)):
+                low = max(low, self._scan)
+                high = min(high, end)
+                if cut == -1 and low <= high:
+                    cut = store._boundary(buffer, low, high, run)
+                    self._scan = high + 1
+
+            if cut != -1:
+                self._emit(cut)
+                continue
+
+            if end >= limit:
+                self._emit(limit)
+                continue
+
+            if final and end > self._start:
+                self._emit(end)
+            break
+
+        if self._start >= self.COMPACT_THRESHOLD:
+            del buffer[:self._start]
+            self._scan -= self._start
+            self._start = 0
+
+    def close(self):
+        """Store the remaining data and write the manifest; returns the manifest dict."""
+
+        if self._closed:
+            return self.manifest
+        self._closed = True
+
+        self._cut(final=True)
+        self._drain(0)
+        self._buffer = bytearray()
+
+        timestamp = self._started.strftime('%Y%m%d-%H%M%S-%f')
+        self.manifest = {
+            'name': self.name,
+            'created': self._started.isoformat(),
+            'size': self.size,
+            'new_bytes': self.new_bytes,
+            'sha256': self._digest.hexdigest(),
+            'encrypted': self.store.cipher is not None,
+            'chunks': self._chunks,
+        }
+
+        self.manifest_path = self.store.manifestPath(self.name, timestamp)
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f)
+
+        ratio = self.size / self.new_bytes if self.new_bytes else float('inf')
+        Utils.log(f"Stored {self.name} in chunk store: {self.size} bytes in {len(self._chunks)} chunks, "
+                  f"{self.new_bytes} new bytes written (dedup ratio {ratio:.1f}x).")
+
+        return self.manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A failed stream must not leave a manifest that restores to a truncated file
+        if exc_type is None:
+            self.close()
+        else:
+            self._closed = True
+            self._drain(0)
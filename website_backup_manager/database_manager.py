@@ -1,9 +1,21 @@
 from abc import ABC, abstractmethod
 from helpers import Helpers as Utils
+from stream_compressor import ParallelCompressor
+from parallel_dump import ParallelDumper
+from chunk_store import ChunkStore
+from checksums import writeSidecar
+from backup_writer import BackupFileWriter
+from binlog_backup import BinlogBackup, parseDumpPosition
+from metrics import METRICS
+from throttle import priorityCommand
+from progress import PROGRESS
+from restore_manager import DatabaseRestorer
+from encryption import BackupCipher, storedPath
 import subprocess
 import shlex
 import os
-import threading
+import tempfile
+import time
 
 class DatabaseConnectionError(Exception):
     """Custom exception for database connection errors."""
@@ -11,13 +23,22 @@ class DatabaseConnectionError(Exception):
 
 class Database(ABC) :
 
-    def __init__(self, db_name, username, password, host='localhost', port=3306, local_base_path='.'):
+    def __init__(self, db_name, username, password, host='localhost', port=3306, local_base_path='.',
+                 compression=None, compression_level=None, compression_workers=None, chunk_store=None,
+                 checksum='sha256', encryption=None):
         self.db_name = db_name
         self.username = username
         self.password = password
         self.host = host
         self.port = port
         self.local_base_path = local_base_path
+        self.compression = compression or None  # None, 'gzip' or 'zstd'
+        self.compression_level = compression_level
+        self.compression_workers = compression_workers
+        self.chunk_store = chunk_store  # Optional ChunkStore root; dumps are then stored deduplicated
+        self.checksum = checksum or 'sha256'
+        self.cipher = BackupCipher.fromConfig(encryption)  # Optional; dumps and binlogs are then written as <file>.enc
+        self.size_estimate = None  # Cached {'data_length', 'index_length', 'rows'} of the current dump, cleared by each dump
 
     def dump_path(self,output_dump_file_name=None):
 
@@ -27,7 +48,9 @@ class Database(ABC) :
             if '.' in output_dump_file_name:
                 output_dump_file_name = output_dump_file_name.split('.')[0]
         
-        return os.path.join(self.local_base_path, f"{output_dump_file_name}.sql")
+        extension = ParallelCompressor.extension(self.compression)
+
+        return os.path.join(self.local_base_path, f"{output_dump_file_name}.sql{extension}")
     
     @abstractmethod
     def dump(self, output_dump_name='db_backup.sql'):
@@ -48,47 +71,77 @@ class Database(ABC) :
              raise DatabaseConnectionError(f"Connection to {self.__class__.__name__} '{self.db_name}' failed\n\n{e}\n")
         
     def getDatabaseSize(self,command = None) -> int:
+        """
+            Estimate the dump size in bytes from table statistics, cached until the next dump starts.
 
-        if command is None:
-            return Utils.log("Please provide command to get database size.")
+            The command must print one row of DATA_LENGTH, INDEX_LENGTH and TABLE_ROWS sums;
+            the full breakdown is kept in self.size_estimate.
 
-        try:
-            # Estimate structure-only dump size
-            structure_cmd = f"mysqldump -u {self.username} -p{self.password} -h {self.host} -P {self.port} --no-data {self.db_name}"
-            structure_result = subprocess.run(shlex.split(structure_cmd), capture_output=True, text=True, check=True)
-            structure_size = len(structure_result.stdout.encode())  # Convert to bytes
+            Raises:
+                DatabaseConnectionError: If the statistics cannot be read.
+        """
 
+        if self.size_estimate is not None:
+            return self.size_estimate['data_length']
 
+        if command is None:
+            return Utils.log("Please provide command to get database size.")
 
-            result = Utils.retry(lambda: subprocess.run(shlex.split(command), capture_output=True, text=True, check=True), retries=1)
-            total_size = 0
-            for line in result.stdout.splitlines()[1:]:  # Skip the header line
-                columns = line.split("\t")
-                data_length = int(columns[6])  # Data_length column
-                # index_length = int(columns[8])  # Index_length column
-                total_size += data_length 
-
-            return total_size + structure_size
-        except:
-            return 0
+        try:
+            args = shlex.split(command) if isinstance(command, str) else command
+            with METRICS.timer('estimate_seconds', backend='mysql'):
+                result = Utils.retry(lambda: subprocess.run(args, capture_output=True, text=True, check=True), retries=1)
+            data_length, index_length, rows = (int(value) for value in result.stdout.split()[:3])
+        except (RuntimeError, ValueError) as e:
+            raise DatabaseConnectionError(f"Unable to estimate size of {self.__class__.__name__} '{self.db_name}'\n\n{e}\n")
 
-    def monitorProgress(self, file_path=None, interval=0.5):
-        """Monitor the progress of the dump file size periodically."""
-        
-        if file_path is None:
-            file_path = self.dump_path()
+        self.size_estimate = {'data_length': data_length, 'index_length': index_length, 'rows': rows}
+        Utils.log(f"Estimated size of '{self.db_name}': {data_length} bytes of data, {index_length} bytes of indexes, ~{rows} rows.")
 
-        monitorThread = threading.Thread(target=Utils.monitorDownload,args=(file_path,), daemon=True)
+        # Row data is what ends up in the dump; secondary indexes are rebuilt on restore
+        return data_length
 
-        monitorThread.start()
-        
-        return monitorThread
+    def _estimatedDumpSize(self):
+        """Size estimate for progress reporting, or None when it is unavailable."""
+        try:
+            return self.getDatabaseSize() or None
+        except DatabaseConnectionError as e:
+            Utils.log(f"Progress will be reported without a percentage: {e}", level='warning')
+            return None
 
 
 class MySQLDatabase(Database):
 
-    def __init__(self, db_name, username, password, host='localhost', port=3306, local_base_path='.'):
-        super().__init__(db_name, username, password, host, port, local_base_path)
+    def __init__(self, db_name, username, password, host='localhost', port=3306, local_base_path='.',
+                 compression=None, compression_level=None, compression_workers=None, workers=1, chunk_rows=500000,
+                 chunk_store=None, checksum='sha256', binlog=False, nice=None, ionice=None, restore_workers=4,
+                 encryption=None):
+        super().__init__(db_name, username, password, host, port, local_base_path,
+                         compression, compression_level, compression_workers, chunk_store, checksum, encryption)
+        self.workers = max(1, int(workers))
+        self.chunk_rows = chunk_rows
+        self.binlog = binlog  # Record binlog coordinates with full dumps so dumpIncremental() can follow them
+        self.binlog_position = None  # Coordinates of the last full dump, when binlog is enabled
+        self.nice = nice  # Optional CPU / IO priority of mysqldump, for dumps taken on the web server itself
+        self.ionice = ionice
+        self.restore_workers = restore_workers  # Tables loaded at once by restore()
+
+    # Asks mysqldump to write the binlog coordinates of its snapshot as a comment (--source-data=2 on MySQL 8.0.26+)
+    SOURCE_DATA_OPTION = "--master-data=2"
+
+    def _clientCommand(self, program):
+        """Connection arguments shared by the mysql, mysqldump and mysqlbinlog clients."""
+        return [
+            program,
+            "-u", self.username,
+            f"-p{self.password}",
+            "-h", self.host,
+            "-P", str(self.port),
+        ]
+
+    def dump_dir(self, output_dump_name=None):
+        """Directory holding the per-table files of a parallel dump."""
+        return self.dump_path(output_dump_name).split('.sql')[0]
 
     def testConnection(self, command = None):
         """Test Mysql connection."""
@@ -103,54 +156,282 @@ class MySQLDatabase(Database):
 
 
     def getDatabaseSize(self, command = None) -> int:
-        """Estimate the database size by summing up table data and index lengths using subprocess."""
-
-        command = f"mysql -u {self.username} -p{self.password} -h {self.host} -P {self.port} -D {self.db_name} -e 'SHOW TABLE STATUS'"
-
-        return super().getDatabaseSize(command)
-        
-    def dump(self, output_file_name=None):
-        """Take a MySQL dump with robust handling for large databases."""
-        
-        Utils._makeDirs(self.local_base_path)
-
-        dump_path = self.dump_path(output_file_name)
+        """Estimate the database size with a single information_schema.TABLES query."""
 
         command = [
-            "mysqldump",
+            "mysql",
             "-u", self.username,
             f"-p{self.password}",
             "-h", self.host,
             "-P", str(self.port),
+            "--batch",
+            "--skip-column-names",
+            "-e",
+            "SELECT COALESCE(SUM(DATA_LENGTH), 0), COALESCE(SUM(INDEX_LENGTH), 0), COALESCE(SUM(TABLE_ROWS), 0) "
+            f"FROM information_schema.TABLES WHERE TABLE_SCHEMA = '{self.db_name.replace(chr(39), chr(39) * 2)}'"
+        ]
+
+        return super().getDatabaseSize(command)
+        
+    def _dumpCommand(self):
+        """mysqldump arguments for a consistent single-file dump of the database."""
+
+        command = priorityCommand(self.nice, self.ionice) + self._clientCommand('mysqldump') + [
             "--single-transaction",
             "--quick",
             "--max-allowed-packet=512M",
-            self.db_name
         ]
 
+        if self.binlog:
+            command.append(self.SOURCE_DATA_OPTION)
+
+        return command + [self.db_name]
+
+    def dump(self, output_file_name=None):
+        """Take a MySQL dump with robust handling for large databases. Returns True on success."""
+        
+        if self.workers > 1:
+            return self.dumpParallel(output_file_name) is not None
+
+        Utils._makeDirs(self.local_base_path)
+
+        dump_path = self.dump_path(output_file_name)
+        stored_path = storedPath(dump_path, self.cipher)
+
+        command = self._dumpCommand()
+
+        self.binlog_position = None
+        self.size_estimate = None  # Tables grow between runs; never size this dump from an earlier one
         error_message = None
 
         try:
-            Utils.log(f"Starting database dump to {dump_path}...")
+            Utils.log(f"Starting database dump to {stored_path}...")
 
-            """ Start Monitoring the progress of the dump file size periodically."""
-            self.monitorProgress(dump_path)
+            total_size = self._estimatedDumpSize()
 
-            with open(dump_path, 'wb', buffering=16 * 1024 * 1024) as dump_output:
-                process = subprocess.Popen(command, stdout=dump_output, stderr=subprocess.PIPE)
-                _, stderr = process.communicate()
+            if self.chunk_store:
+                process, stderr, manifest_path = self.__dumpToChunkStore(command, dump_path, total_size)
+            else:
+                process, stderr, digest = self.__dumpStreamed(command, dump_path, total_size)
 
             if process.returncode != 0:
                 raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+
+            if not self.chunk_store:
+                # The digest is of the dump as it was before encryption, so it stays comparable everywhere
+                writeSidecar(dump_path, {dump_path: digest}, self.checksum)
+
+            if self.binlog:
+                if self.chunk_store:
+                    BinlogBackup(self).startChain(manifest_path, 'chunk_store', self.binlog_position)
+                else:
+                    BinlogBackup(self).startChain(stored_path, 'file', self.binlog_position)
             
         except KeyboardInterrupt:
             error_message = "Database dump process interrupted by user."
         except subprocess.CalledProcessError as e:
-            error_message = f"Database dump process failed: {e.stderr.decode()}"
+            error_message = f"Database dump process failed: {e.stderr.decode(errors='replace')}"
         except Exception as e:
             error_message = f"Unexpected error during dump: {e}"
         finally:
             if error_message is not None:
                 Utils.log(error_message,level='error')
             else:
-                Utils.log(f"Database dump completed successfully: {dump_path}")
+                Utils.log(f"Database dump completed successfully: {stored_path}")
+            PROGRESS.summary()
+
+        return error_message is None
+
+    def __dumpStreamed(self, command, dump_path, total_size=None, chunk_size=1024 * 1024):
+        """
+            Stream mysqldump output to dump_path, hashing the bytes written on the way.
+
+            With compression set, the stream goes through a parallel compressor first so the raw SQL never
+            reaches disk. With encryption set, the (compressed) stream is sealed on its way to <dump_path>.enc.
+            Returns (process, stderr, hex digest of the dump as it is before encryption).
+        """
+
+        with tempfile.TemporaryFile() as stderr_output:
+            # stderr goes to a file so a chatty mysqldump cannot block on a full pipe while we read stdout
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_output)
+            started = time.monotonic()
+            try:
+                # Progress counts raw SQL bytes, which is what the size estimate measures
+                with BackupFileWriter(dump_path, self.checksum, self.cipher, self.compression, self.compression_level,
+                                      self.compression_workers, host=self.host, total=total_size) as writer:
+                    for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+                        self._recordBinlogPosition(chunk)
+                        writer.write(chunk)
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            stderr_output.seek(0)
+            stderr = stderr_output.read()
+
+        METRICS.transfer('mysql', writer.received, time.monotonic() - started)
+
+        if self.compression:
+            Utils.log(f"Compressed {writer.received} bytes of SQL to {writer.bytes_written} bytes "
+                      f"({self.compression}, {writer.compressor.workers} threads).")
+
+        return process, stderr, writer.hexdigest()
+
+    def __dumpToChunkStore(self, command, dump_path, total_size=None, chunk_size=1024 * 1024):
+        """Stream raw mysqldump output into the deduplicating chunk store instead of a local file."""
+
+        # Chunks are compressed individually, so the stream must stay uncompressed for dedup to work
+        name = os.path.basename(dump_path).split('.sql')[0] + '.sql'
+
+        with ChunkStore(self.chunk_store, cipher=self.cipher) as store, tempfile.TemporaryFile() as stderr_output:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_output)
+            started = time.monotonic()
+
+            try:
+                with BackupFileWriter(name, None, sink=store.writer(name), host=self.host, total=total_size) as writer:
+                    for chunk in iter(lambda: process.stdout.read(chunk_size), b''):
+                        self._recordBinlogPosition(chunk)
+                        writer.write(chunk)
+
+                    # Raise before the manifest is written so a failed dump is never restorable
+                    if process.wait() != 0:
+                        stderr_output.seek(0)
+                        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr_output.read())
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            METRICS.transfer('mysql', writer.received, time.monotonic() - started)
+            Utils.log(f"Database dump stored in chunk store {self.chunk_store}: {writer.sink.manifest_path}")
+
+        return process, b'', writer.sink.manifest_path
+
+    def _recordBinlogPosition(self, chunk):
+        """Pick the binlog coordinates out of the first chunk of a dump taken with SOURCE_DATA_OPTION."""
+        if self.binlog and self.binlog_position is None:
+            self.binlog_position = parseDumpPosition(chunk) or False
+
+    def dumpParallel(self, output_dump_name=None):
+        """Dump tables and primary key ranges concurrently from one consistent snapshot into dump_dir()."""
+
+        Utils._makeDirs(self.local_base_path)
+
+        dump_dir = self.dump_dir(output_dump_name)
+
+        self.size_estimate = None
+        error_message = None
+        metadata = None
+
+        try:
+            Utils.log(f"Starting parallel database dump to {dump_dir} with {self.workers} workers...")
+            metadata = ParallelDumper(self, dump_dir, self.workers, self.chunk_rows).run()
+
+            if self.binlog:
+                self.binlog_position = metadata['binlog']
+                BinlogBackup(self).startChain(dump_dir, 'parallel', metadata['binlog'])
+
+        except KeyboardInterrupt:
+            error_message = "Database dump process interrupted by user."
+        except Exception as e:
+            error_message = f"Unexpected error during parallel dump: {e}"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                Utils.log(f"Database dump completed successfully: {dump_dir}")
+
+        return metadata
+
+    def dumpIncremental(self):
+        """Save the binary logs written since the last full or incremental backup. Returns True on success."""
+
+        error_message = None
+        segments = []
+
+        try:
+            Utils.log(f"Starting incremental binlog backup of '{self.db_name}'...")
+            segments = BinlogBackup(self).fetch()
+
+        except KeyboardInterrupt:
+            error_message = "Incremental backup interrupted by user."
+        except subprocess.CalledProcessError as e:
+            error_message = f"Incremental backup failed: {(e.stderr or b'').decode(errors='replace')}"
+        except Exception as e:
+            error_message = f"Unexpected error during incremental backup: {e}"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                size = sum(segment['bytes'] for segment in segments)
+                Utils.log(f"Incremental backup completed successfully: {len(segments)} binlog file(s), {size} bytes.")
+
+        return error_message is None
+
+    def _importStream(self, source, chunk_size=1024 * 1024):
+        """Feed SQL from a readable file object into the mysql client."""
+
+        command = self._clientCommand('mysql') + [self.db_name]
+        with tempfile.TemporaryFile() as stderr_output:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr_output)
+            try:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    process.stdin.write(chunk)
+            finally:
+                process.stdin.close()
+                process.wait()
+
+            if process.returncode != 0:
+                stderr_output.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr_output.read())
+
+    def _pipeInto(self, producer):
+        """Run a command and import its standard output with the mysql client."""
+
+        process = subprocess.Popen(producer, stdout=subprocess.PIPE)
+        try:
+            self._importStream(process.stdout)
+        finally:
+            process.stdout.close()
+            process.wait()
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, producer)
+
+    def __loadFullDump(self, full):
+        """Import the full dump a binlog chain starts from, several tables at once."""
+
+        if not DatabaseRestorer(self, self.restore_workers).restore(full['path'], full['kind']):
+            raise DatabaseConnectionError(f"Loading the full dump {full['path']} failed.")
+
+    def restore(self, stop_datetime=None):
+        """
+            Restore the latest full dump followed by its binlog incrementals.
+
+            stop_datetime ('YYYY-MM-DD HH:MM:SS', server time) replays the logs only up to that point in time.
+            Returns True on success.
+        """
+
+        error_message = None
+
+        try:
+            state = BinlogBackup(self).loadState()
+            if state is None:
+                raise DatabaseConnectionError(f"No binlog chain recorded for '{self.db_name}'.")
+
+            Utils.log(f"Restoring '{self.db_name}' from {state['full']['path']}...")
+            self.__loadFullDump(state['full'])
+            BinlogBackup(self).replay(stop_datetime)
+
+        except KeyboardInterrupt:
+            error_message = "Restore interrupted by user."
+        except subprocess.CalledProcessError as e:
+            error_message = f"Restore failed: {(e.stderr or b'').decode(errors='replace')}"
+        except Exception as e:
+            error_message = f"Unexpected error during restore: {e}"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                Utils.log(f"Database '{self.db_name}' restored successfully.")
+
+        return error_message is None
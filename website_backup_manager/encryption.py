@@ -0,0 +1,479 @@
+from helpers import Helpers as Utils
+import argparse
+import base64
+import binascii
+import contextlib
+import hashlib
+import hmac
+import io
+import os
+import queue
+import struct
+import threading
+
+
+class EncryptionError(Exception):
+    """Raised when a key cannot be loaded or an encrypted file fails to authenticate."""
+
+
+# Appended to the name of every file written through an EncryptingWriter
+EXTENSION = '.enc'
+
+MAGIC = b'WBMENC'
+VERSION = 1
+ALGORITHMS = {'aes-256-gcm': 1, 'chacha20-poly1305': 2}
+KEY_SIZE = 32
+TAG_SIZE = 16
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+# magic, version, algorithm id, segment size, per-file salt, nonce prefix
+HEADER = struct.Struct(f'>{len(MAGIC)}sBBI{SALT_SIZE}s{NONCE_PREFIX_SIZE}s')
+MAX_SEGMENTS = 2 ** 32
+NONCE_SIZE = 12
+
+
+def _aeadClass(algorithm):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    except ImportError:
+        raise RuntimeError("Encryption requires the 'cryptography' package (pip install cryptography).")
+    return AESGCM if algorithm == 'aes-256-gcm' else ChaCha20Poly1305
+
+
+def storedPath(path, cipher):
+    """Name a backup file has on disk: path itself, or path + '.enc' when it is encrypted."""
+    return path + EXTENSION if cipher is not None and not path.endswith(EXTENSION) else path
+
+
+def sealing(fileobj, cipher):
+    """Context manager for writing a backup file: an EncryptingWriter over fileobj, or fileobj itself without a cipher."""
+    return cipher.writer(fileobj) if cipher is not None else contextlib.nullcontext(fileobj)
+
+
+def plaintextSize(path):
+    """Size of the data in an encrypted file, from its size and header alone."""
+
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) != HEADER.size or not header.startswith(MAGIC):
+        raise EncryptionError(f"{path} is not an encrypted backup file.")
+
+    segment_size = HEADER.unpack(header)[3]
+    sealed = os.path.getsize(path) - HEADER.size
+    segments = max(1, -(-sealed // (segment_size + TAG_SIZE)))
+    return sealed - segments * TAG_SIZE
+
+
+def loadKey(path):
+    """Read a 32-byte key from a key file holding it base64 or hex encoded (as written by generateKey), or raw."""
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    text = content.strip()
+    for decode in (lambda value: base64.b64decode(value, validate=True), binascii.unhexlify):
+        try:
+            key = decode(text)
+        except (ValueError, binascii.Error):
+            continue
+        if len(key) == KEY_SIZE:
+            return key
+
+    if len(content) == KEY_SIZE:
+        return content
+    raise EncryptionError(f"{path} does not hold a {KEY_SIZE}-byte key (base64, hex or raw).")
+
+
+def generateKey(path):
+    """Write a new random key to path, readable by the owner only."""
+
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, 'w') as f:
+        f.write(base64.b64encode(os.urandom(KEY_SIZE)).decode() + '\n')
+    return path
+
+
+class BackupCipher:
+    """
+        Segmented authenticated encryption of backup files with one long-term key.
+
+        A file is a header followed by fixed-size segments, each sealed with AES-256-GCM or
+        ChaCha20-Poly1305 and its own 16-byte tag. Every file gets a fresh key derived from
+        the long-term key and a random salt (HKDF-SHA256), and segment i is sealed with the
+        nonce prefix || i || last-flag and the header as associated data, so segments cannot
+        be altered, reordered, dropped or cut off at the end without decryption failing. Like
+        a gzip member, every segment can be checked on its own: nothing has to be buffered
+        beyond one segment in either direction.
+
+        Chunk store chunks are sealed one by one instead (chunkId, sealChunk, openChunk), with
+        keys and names derived from their content so that deduplication keeps working.
+
+        Build it once per run and share it: writer() and reader() are safe to call from
+        several threads.
+    """
+
+    def __init__(self, key, algorithm='aes-256-gcm', segment_size=1024 * 1024):
+        if algorithm not in ALGORITHMS:
+            raise EncryptionError(f"Unsupported encryption algorithm: {algorithm}; use {' or '.join(ALGORITHMS)}.")
+        if len(key) != KEY_SIZE:
+            raise EncryptionError(f"Encryption keys are {KEY_SIZE} bytes, got {len(key)}.")
+
+        _aeadClass(algorithm)  # Fail at configuration time when cryptography is missing
+        self.key = bytes(key)
+        self.algorithm = algorithm
+        self.segment_size = int(segment_size)
+        # Separate keys for naming and sealing chunk store chunks, so an id reveals nothing about the chunk key
+        self._chunk_id_key = hmac.new(self.key, b'website_backup_manager chunk id', hashlib.sha256).digest()
+        self._chunk_key = hmac.new(self.key, b'website_backup_manager chunk key', hashlib.sha256).digest()
+
+    @classmethod
+    def fromConfig(cls, encryption, algorithm=None):
+        """None, a BackupCipher, or a key file path (the form the manager configs take) to a cipher or None."""
+
+        if encryption is None or encryption == '' or isinstance(encryption, cls):
+            return encryption or None
+        return cls(loadKey(encryption), algorithm or 'aes-256-gcm')
+
+    def _fileKey(self, salt, algorithm):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        key = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=salt,
+                   info=b'website_backup_manager segment key').derive(self.key)
+        return _aeadClass(algorithm)(key)
+
+    @staticmethod
+    def _nonce(prefix, index, last):
+        if index >= MAX_SEGMENTS:
+            raise EncryptionError("Too many segments for one encrypted file; use a larger segment size.")
+        return prefix + struct.pack('>I?', index, last)
+
+    def newHeader(self):
+        """(header bytes, AEAD) for a new file."""
+        salt, prefix = os.urandom(SALT_SIZE), os.urandom(NONCE_PREFIX_SIZE)
+        header = HEADER.pack(MAGIC, VERSION, ALGORITHMS[self.algorithm], self.segment_size, salt, prefix)
+        return header, self._fileKey(salt, self.algorithm), prefix
+
+    def parseHeader(self, header):
+        """(segment size, AEAD, nonce prefix) for an existing file's header."""
+
+        if len(header) != HEADER.size or not header.startswith(MAGIC):
+            raise EncryptionError("Not an encrypted backup file (bad header).")
+        _, version, algorithm_id, segment_size, salt, prefix = HEADER.unpack(header)
+        algorithm = next((name for name, number in ALGORITHMS.items() if number == algorithm_id), None)
+        if version != VERSION or algorithm is None or not segment_size:
+            raise EncryptionError(f"Unsupported encrypted file format (version {version}, algorithm {algorithm_id}).")
+        return segment_size, self._fileKey(salt, algorithm), prefix
+
+    def chunkId(self, data):
+        """
+            Name of a chunk store chunk: HMAC-SHA256 of its plaintext under a key derived from the
+            long-term key. Equal chunks keep equal names, so they still deduplicate, but a name
+            cannot be checked against a guessed plaintext without the key.
+        """
+        return hmac.new(self._chunk_id_key, data, hashlib.sha256).hexdigest()
+
+    def sealChunk(self, chunk_id, data):
+        """
+            Encrypt one chunk: algorithm id, random nonce, then data sealed with a key derived from
+            chunk_id (so from the plaintext) and chunk_id as associated data. A sealed chunk is only
+            accepted under its own name.
+        """
+
+        nonce = os.urandom(NONCE_SIZE)
+        aead = _aeadClass(self.algorithm)(hmac.new(self._chunk_key, chunk_id.encode(), hashlib.sha256).digest())
+        return bytes([ALGORITHMS[self.algorithm]]) + nonce + aead.encrypt(nonce, data, chunk_id.encode())
+
+    def openChunk(self, chunk_id, sealed):
+        """Decrypt a chunk written by sealChunk; raises EncryptionError unless it authenticates as chunk_id."""
+
+        algorithm = next((name for name, number in ALGORITHMS.items() if sealed[:1] == bytes([number])), None)
+        if algorithm is None or len(sealed) < 1 + NONCE_SIZE + TAG_SIZE:
+            raise EncryptionError(f"Chunk {chunk_id} is not an encrypted chunk.")
+
+        aead = _aeadClass(algorithm)(hmac.new(self._chunk_key, chunk_id.encode(), hashlib.sha256).digest())
+        try:
+            return aead.decrypt(sealed[1:1 + NONCE_SIZE], sealed[1 + NONCE_SIZE:], chunk_id.encode())
+        except Exception as e:
+            raise EncryptionError(f"Chunk {chunk_id} failed to authenticate: it is corrupted or encrypted "
+                                  f"with another key.") from e
+
+    def writer(self, fileobj, buffers=4):
+        """File-like writer encrypting into fileobj; see EncryptingWriter."""
+        return EncryptingWriter(self, fileobj, buffers)
+
+    def reader(self, fileobj):
+        """Raw stream decrypting fileobj; see DecryptingReader."""
+        return DecryptingReader(self, fileobj)
+
+    def open(self, path, buffer_size=1024 * 1024):
+        """Open an encrypted file for buffered, streaming reads of its plaintext."""
+        return io.BufferedReader(self.reader(open(path, 'rb')), buffer_size)
+
+    def encryptFile(self, source_path, output_path, block_size=4 * 1024 * 1024):
+        """Encrypt one file to output_path; returns the number of plaintext bytes."""
+
+        with open(source_path, 'rb') as source, open(output_path, 'wb') as f, self.writer(f) as writer:
+            view = memoryview(bytearray(block_size))
+            while True:
+                count = source.readinto(view)
+                if not count:
+                    break
+                writer.write(view[:count])
+        return writer.raw_bytes
+
+    def decryptFile(self, source_path, output_path, block_size=4 * 1024 * 1024):
+        """Decrypt one file to output_path; returns the number of plaintext bytes."""
+
+        written = 0
+        with self.open(source_path) as source, open(output_path, 'wb') as f:
+            view = memoryview(bytearray(block_size))
+            while True:
+                count = source.readinto(view)
+                if not count:
+                    break
+                f.write(view[:count])
+                written += count
+        return written
+
+
+class EncryptingWriter:
+    """
+        File-like writer that seals a stream in fixed-size segments on a worker thread.
+
+        write() only copies the caller's data into one of `buffers` preallocated segment
+        buffers through a memoryview; a full buffer is handed to the worker, which seals it
+        into a preallocated output buffer (encrypt_into, where cryptography has it) and writes
+        that to fileobj, then gives the buffer back. The producer only waits when every buffer
+        is queued, which bounds memory to `buffers` segments. The last segment is held back
+        until close() so it can be flagged as the last one.
+
+        Use it as a context manager: leaving the block with an exception stops the worker
+        without sealing a last segment, so a broken stream can never be decrypted as if it
+        were complete. fileobj is written from the worker thread only, with memoryviews that
+        are reused afterwards.
+    """
+
+    def __init__(self, cipher, fileobj, buffers=4):
+        self.fileobj = fileobj
+        self.segment_size = cipher.segment_size
+        self.raw_bytes = 0
+        self.encrypted_bytes = 0
+
+        header, self._aead, self._prefix = cipher.newHeader()
+        self._header = header
+        self._encrypt_into = getattr(self._aead, 'encrypt_into', None)
+
+        self._buffers = [memoryview(bytearray(self.segment_size)) for _ in range(max(2, int(buffers)))]
+        self._free = queue.Queue()
+        for slot in range(1, len(self._buffers)):
+            self._free.put(slot)
+        self._work = queue.Queue()
+        self._slot, self._fill, self._index = 0, 0, 0
+        self._error = None
+        self._closed = False
+
+        self.fileobj.write(header)
+        self.encrypted_bytes += len(header)
+
+        self._thread = threading.Thread(target=self._run, name='encrypt', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        output = memoryview(bytearray(self.segment_size + TAG_SIZE))
+        while True:
+            item = self._work.get()
+            if item is None:
+                break
+            slot, length, index, last = item
+            try:
+                # After a failure the remaining buffers are only handed back, so the producer never blocks
+                if self._error is None:
+                    nonce = BackupCipher._nonce(self._prefix, index, last)
+                    plaintext = self._buffers[slot][:length]
+                    if self._encrypt_into is not None:
+                        sealed = output[:length + TAG_SIZE]
+                        self._encrypt_into(nonce, plaintext, self._header, sealed)
+                    else:
+                        sealed = self._aead.encrypt(nonce, bytes(plaintext), self._header)
+                    self.fileobj.write(sealed)
+                    self.encrypted_bytes += len(sealed)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._free.put(slot)
+
+    def _raiseError(self):
+        if self._error is not None:
+            raise EncryptionError(f"Encrypting the stream failed: {self._error}") from self._error
+
+    def _dispatch(self, last):
+        self._work.put((self._slot, self._fill, self._index, last))
+        self._index += 1
+        if not last:
+            self._slot, self._fill = self._free.get(), 0
+
+    def write(self, data):
+        self._raiseError()
+        view = memoryview(data).cast('B')
+        length = len(view)
+
+        while view:
+            if self._fill == self.segment_size:
+                self._dispatch(last=False)
+            count = min(len(view), self.segment_size - self._fill)
+            self._buffers[self._slot][self._fill:self._fill + count] = view[:count]
+            self._fill += count
+            view = view[count:]
+
+        self.raw_bytes += length
+        return length
+
+    def flush(self):
+        # Segments are sealed whole, so only close() can push the last bytes out
+        self._raiseError()
+
+    def _stop(self, seal):
+        if self._closed:
+            return
+        self._closed = True
+        if seal:
+            self._dispatch(last=True)
+        self._work.put(None)
+        self._thread.join()
+
+    def close(self):
+        """Seal the last segment and wait until every segment is written to fileobj."""
+        self._stop(seal=self._error is None)
+        self._raiseError()
+        self.fileobj.flush()
+
+    def abort(self):
+        """Stop without sealing the last segment; the output is left incomplete and fails to decrypt."""
+        self._stop(seal=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class DecryptingReader(io.RawIOBase):
+    """
+        Raw stream of the plaintext of an encrypted file, read segment by segment.
+
+        Each segment is read into one preallocated buffer and opened into another
+        (decrypt_into, where cryptography has it), and readinto() copies straight out of
+        that. A segment that fails to authenticate, a missing last segment or data cut off
+        anywhere raises EncryptionError before any of its bytes are returned. Wrap it in
+        io.BufferedReader (or use BackupCipher.open) for read(n) and readline().
+    """
+
+    def __init__(self, cipher, fileobj):
+        self.fileobj = fileobj
+        header = self._readFully(bytearray(HEADER.size))
+        self._header = bytes(header)
+        self.segment_size, self._aead, self._prefix = cipher.parseHeader(self._header)
+        self._decrypt_into = getattr(self._aead, 'decrypt_into', None)
+
+        # One extra byte tells a full segment from the last one without seeking
+        self._sealed = memoryview(bytearray(self.segment_size + TAG_SIZE + 1))
+        self._plain = memoryview(bytearray(self.segment_size))
+        self._carry = 0
+        self._position, self._length = 0, 0
+        self._index = 0
+        self._done = False
+
+    def _readFully(self, buffer, start=0):
+        view = memoryview(buffer)
+        filled = start
+        while filled < len(view):
+            count = self.fileobj.readinto(view[filled:])
+            if not count:
+                break
+            filled += count
+        return view[:filled]
+
+    def _nextSegment(self):
+        sealed = self._readFully(self._sealed, self._carry)
+        last = len(sealed) <= self.segment_size + TAG_SIZE
+        length = len(sealed) if last else self.segment_size + TAG_SIZE
+        if length < TAG_SIZE:
+            raise EncryptionError("Encrypted file is truncated.")
+
+        nonce = BackupCipher._nonce(self._prefix, self._index, last)
+        try:
+            if self._decrypt_into is not None:
+                self._length = self._decrypt_into(nonce, sealed[:length], self._header, self._plain[:length - TAG_SIZE])
+            else:
+                opened = self._aead.decrypt(nonce, bytes(sealed[:length]), self._header)
+                self._plain[:len(opened)] = opened
+                self._length = len(opened)
+        except Exception as e:
+            raise EncryptionError(f"Segment {self._index} failed to authenticate: the file is corrupted, "
+                                  f"truncated or encrypted with another key.") from e
+
+        self._position = 0
+        self._index += 1
+        self._done = last
+        if not last:
+            self._sealed[0] = self._sealed[length]
+            self._carry = 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._position == self._length:
+            if self._done:
+                return 0
+            self._nextSegment()
+
+        count = min(len(buffer), self._length - self._position)
+        buffer[:count] = self._plain[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+        super().close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Manage and use the key that website_backup_manager encrypts backups with.")
+    parser.add_argument('--key', default=os.getenv('ENCRYPTION_KEY_FILE'), help="Key file (default: ENCRYPTION_KEY_FILE)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('keygen', help="Write a new random key to --key")
+
+    encrypt_parser = commands.add_parser('encrypt', help="Encrypt a file to <file>.enc")
+    encrypt_parser.add_argument('source')
+    encrypt_parser.add_argument('--output')
+    encrypt_parser.add_argument('--algorithm', default=os.getenv('ENCRYPTION_ALGORITHM') or 'aes-256-gcm', choices=sorted(ALGORITHMS))
+
+    decrypt_parser = commands.add_parser('decrypt', help="Decrypt a .enc file")
+    decrypt_parser.add_argument('source')
+    decrypt_parser.add_argument('--output', help="Default: the source name without .enc")
+
+    args = parser.parse_args()
+    if not args.key:
+        parser.error("no key file given; use --key or set ENCRYPTION_KEY_FILE")
+
+    if args.command == 'keygen':
+        Utils.log(f"New encryption key written to {generateKey(args.key)}; keep a copy off the backup host.")
+    elif args.command == 'encrypt':
+        output = args.output or args.source + EXTENSION
+        size = BackupCipher(loadKey(args.key), args.algorithm).encryptFile(args.source, output)
+        Utils.log(f"Encrypted {size} bytes to {output}")
+    else:
+        output = args.output or (args.source[:-len(EXTENSION)] if args.source.endswith(EXTENSION) else args.source + '.dec')
+        size = BackupCipher(loadKey(args.key)).decryptFile(args.source, output)
+        Utils.log(f"Decrypted {size} bytes to {output}")
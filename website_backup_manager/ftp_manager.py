@@ -1,48 +1,260 @@
 from helpers import Helpers as Utils
+from manifest_index import ManifestIndex
+from chunk_store import ChunkStore
+from checksums import fileDigest, writeSidecar
+from metrics import METRICS
+from progress import PROGRESS
+from session_manager import SESSIONS
+from encryption import BackupCipher, plaintextSize, storedPath
+from backup_writer import BackupFileWriter
 import os
+import posixpath
+import queue
 import threading
-from ftplib import FTP_TLS, error_perm
+import time
+import datetime
+import json
+from collections import namedtuple
+from contextlib import contextmanager
+from ftplib import FTP_TLS, error_perm, error_temp, error_reply
 
 
 class FTPConnectionError(Exception):
     """Custom exception for FTP connection errors."""    
 
+
+FTPEntry = namedtuple('FTPEntry', ['name', 'type', 'size', 'mtime'])
+"""One directory entry: type is 'file', 'dir' or 'link'; size and mtime (epoch seconds) may be None."""
+
+_MONTHS = {m: i for i, m in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                       'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+
+
+def _parseMlsdEntry(name, facts):
+    """Convert an MLSD (name, facts) pair into an FTPEntry, or None for '.'/'..'."""
+
+    kind = facts.get('type', '').lower()
+    if kind in ('cdir', 'pdir') or name in ('.', '..'):
+        return None
+    if kind not in ('file', 'dir'):
+        kind = 'link' if 'link' in kind else 'file'
+
+    size = facts.get('size') or facts.get('sizd')
+    mtime = None
+    if 'modify' in facts:
+        try:
+            modified = datetime.datetime.strptime(facts['modify'][:14], '%Y%m%d%H%M%S')
+            mtime = modified.replace(tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            pass
+
+    return FTPEntry(name, kind, int(size) if size is not None and kind == 'file' else None, mtime)
+
+
+def _parseListLine(line):
+    """Parse one line of a Unix or DOS style LIST reply into an FTPEntry."""
+
+    parts = line.split(None, 8)
+
+    # Unix: drwxr-xr-x 2 user group 4096 Jan 01 12:00 name
+    if len(parts) == 9 and parts[0][:1] in 'd-l':
+        mode, size, month, day, year_or_time, name = parts[0], parts[4], parts[5], parts[6], parts[7], parts[8]
+        kind = {'d': 'dir', 'l': 'link'}.get(mode[0], 'file')
+        if kind == 'link':
+            name = name.split(' -> ')[0]
+        if name in ('.', '..'):
+            return None
+
+        mtime = None
+        try:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if ':' in year_or_time:
+                hour, minute = (int(x) for x in year_or_time.split(':'))
+                modified = datetime.datetime(now.year, _MONTHS[month.lower()], int(day), hour, minute, tzinfo=datetime.timezone.utc)
+                if modified > now + datetime.timedelta(days=1):
+                    modified = modified.replace(year=now.year - 1)
+            else:
+                modified = datetime.datetime(int(year_or_time), _MONTHS[month.lower()], int(day), tzinfo=datetime.timezone.utc)
+            mtime = modified.timestamp()
+        except (KeyError, ValueError):
+            pass
+
+        return FTPEntry(name, kind, int(size) if kind == 'file' and size.isdigit() else None, mtime)
+
+    # DOS: 01-31-20  12:00PM       <DIR>          name
+    parts = line.split(None, 3)
+    if len(parts) == 4:
+        date, time_of_day, size, name = parts
+        mtime = None
+        try:
+            modified = datetime.datetime.strptime(f"{date} {time_of_day}", '%m-%d-%y %I:%M%p')
+            mtime = modified.replace(tzinfo=datetime.timezone.utc).timestamp()
+        except ValueError:
+            pass
+        if size.upper() == '<DIR>':
+            return FTPEntry(name, 'dir', None, mtime)
+        if size.isdigit():
+            return FTPEntry(name, 'file', int(size), mtime)
+
+    return None
+
+
+class FTPConnectionPool:
+    """
+        Bounded pool of authenticated FTPS sessions shared by download workers.
+
+        closer, when given, receives (session, discard) instead of the session being quit,
+        e.g. to hand sessions back to SESSIONS for later reuse.
+    """
+
+    def __init__(self, factory, size, closer=None):
+        self.factory = factory
+        self.size = size
+        self.closer = closer
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle session, opening a new one while below the pool size."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if not create:
+            return self._idle.get()
+
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def release(self, ftp, discard=False):
+        """Hand a session back to the pool, or drop it if it is no longer usable."""
+        if not discard:
+            self._idle.put(ftp)
+            return
+
+        with self._lock:
+            self._created -= 1
+        if self.closer is not None:
+            self.closer(ftp, True)
+            return
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def session(self):
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except (OSError, EOFError, error_temp):
+            # Broken sockets and 4xx replies leave the session in an unknown state
+            self.release(ftp, discard=True)
+            raise
+        except Exception:
+            self.release(ftp)
+            raise
+        else:
+            self.release(ftp)
+
+    def close(self):
+        """Quit every idle session in the pool."""
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if self.closer is not None:
+                self.closer(ftp, False)
+            else:
+                try:
+                    ftp.quit()
+                except Exception:
+                    ftp.close()
+            with self._lock:
+                self._created -= 1
+
+
 class FTP:
 
-    def __init__(self, host, username, password, local_base_path, host_base_path):
+    MANIFEST_NAME = '.ftp_manifest.sqlite'
+
+    def __init__(self, host, username, password, local_base_path, host_base_path, workers=1, chunk_store=None,
+                 checksum='sha256', port=21, encryption=None):
         self.host = host
+        self.port = int(port)
         self.username = username
         self.password = password
         self.local_base_path = local_base_path
         self.host_base_path = host_base_path
+        self.workers = max(1, int(workers))
+        self.chunk_store = chunk_store  # Optional ChunkStore root that verified downloads are added to
+        self._store = None
+        self.checksum = checksum or None  # 'sha256', 'blake2b' or None to skip hashing
+        self.digests = {}  # local path -> hex digest of the files fetched by the last download()
+        # Optional key file or BackupCipher; downloads are then written as <file>.enc, digests stay those of the plain files
+        self.cipher = BackupCipher.fromConfig(encryption)
+        self._digests_lock = threading.Lock()
         self.connected = False
         self.ftp = None
+        self._mlsd = None  # Unknown until the first listing
+        self._rest = True  # Cleared once the server refuses a REST offset
 
     @property
     def className(self):
         return self.__class__.__name__
 
+    def _openSession(self):
+        """Open and authenticate a new FTPS session."""
+        with METRICS.timer('connect_seconds', backend='ftp'):
+            ftp = FTP_TLS()
+            Utils.retry(lambda: ftp.connect(self.host, self.port), name='ftp_connect')
+            ftp.login(self.username, self.password)
+            ftp.prot_p()
+            ftp.set_pasv(True)
+        return ftp
+
+    @property
+    def _sessionKey(self):
+        return ('ftp', self.host, self.port, self.username)
+
+    def _acquireSession(self):
+        """Check out a logged-in session from SESSIONS, opening one when none is idle."""
+        return SESSIONS.acquireFTP(self._sessionKey, self._openSession)
+
+    def _releaseSession(self, ftp, discard=False):
+        SESSIONS.releaseFTP(self._sessionKey, ftp, discard)
+
     def connect(self):
-        """Establish an FTPS connection with retries."""
+        """Establish an FTPS connection with retries, reusing an idle authenticated session when possible."""
         try:
             Utils.log(f"Connecting to {self.className} host {self.host}...")
-            self.ftp = FTP_TLS()
-            Utils.retry(lambda: self.ftp.connect(self.host))
-            self.ftp.login(self.username, self.password)
-            self.ftp.prot_p()
-            self.ftp.set_pasv(True)
+            self.ftp = self._acquireSession()
             self.connected = True
-            self.__keepSessionAlive()
+            # Kept alive by the single SESSIONS keep-alive thread, not one thread per connection
+            SESSIONS.keepAliveFTP(self.ftp)
             Utils.log("FTPS connection established.")
         except Exception as e:
             raise FTPConnectionError(f"Connection to {self.className} host {self.host} failed\n\n{e}\n")
 
-    def disconnect(self):
-        """Close the FTPS connection safely."""
+    def disconnect(self, discard=False):
+        """Hand the FTPS session back to SESSIONS for the next operation, or close it when discard is set."""
         if self.connected:
             Utils.log(f"Disconnecting to {self.className} host {self.host}...")
             try:
-                self.ftp.quit()
+                if self.ftp is not None:
+                    self._releaseSession(self.ftp, discard)
                 self.ftp = None
             except Exception as e:
                 Utils.log(f"Error disconnecting to {self.className} host {self.host}",level='error')
@@ -51,100 +263,330 @@ class FTP:
         
         self.connected = False
 
-    def __keepSessionAlive(self, interval=60):
-        """Start a new thread to send periodic NOOP commands to keep the connection alive."""
-
-        import time
-        def send_noop():
-            while self.connected:
-                time.sleep(interval)
-                self.ftp.voidcmd("NOOP")
-
-        threading.Thread(target=send_noop, daemon=True).start()
+    def __dropSession(self):
+        """Close a session that a failed transfer may have left broken; the next attempt opens a fresh one."""
+        ftp, self.ftp = self.ftp, None
+        if ftp is not None:
+            self._releaseSession(ftp, discard=True)
 
-    def __verifyFileSize(self, remote_path, local_path):
+    def __verifyFileSize(self, remote_path, local_path, ftp=None, remote_size=None):
         """Ensure the local file size matches the remote file size."""
         
-        remote_size = self.ftp.size(remote_path)
-        local_size = os.path.getsize(local_path)
+        ftp = ftp or self.ftp
+        with METRICS.timer('verify_seconds', backend='ftp'):
+            if remote_size is None:
+                remote_size = ftp.size(remote_path)
+            local_size = self.__localSize(local_path)
 
         if remote_size != local_size:
+            METRICS.increment('verify_failures_total', backend='ftp')
             raise ValueError(f"Size mismatch: {remote_path} (expected {remote_size}, got {local_size})")
-        
-        Utils.log(f"Verified {remote_path}: {local_size} bytes")
 
-    def __downloadWithProgress(self, remote_file, output_file_path):
+    def __localSize(self, local_path):
+        """Size of the downloaded data of local_path (decrypted size when encrypted), or None if it is missing."""
+
+        stored = storedPath(local_path, self.cipher)
+        if not os.path.isfile(stored):
+            return None
+        # Encrypted sizes follow from the header and file size, so nothing has to be decrypted
+        return plaintextSize(stored) if self.cipher else os.path.getsize(stored)
+
+    @staticmethod
+    def _resumeStatePath(local_path):
+        """Sidecar file recording which remote file a partial download belongs to."""
+        return f"{local_path}.resume"
+
+    def __resumeOffset(self, remote_file, output_file_path, total_size, mtime):
+        """Return the byte offset to resume from, or 0 when the partial file cannot be trusted."""
+
+        state_path = self._resumeStatePath(output_file_path)
+        # An encrypted file ends with a sealed last segment, so it cannot be appended to
+        if self.cipher is not None or not self._rest or not os.path.exists(state_path) or not os.path.exists(output_file_path):
+            return 0
+
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+
+        # A changed remote file invalidates whatever was already downloaded
+        if state.get('remote_path') != remote_file or state.get('size') != total_size or state.get('mtime') != mtime:
+            return 0
+
+        offset = os.path.getsize(output_file_path)
+        if total_size is not None and offset > total_size:
+            return 0
+
+        return offset
+
+    def __writeResumeState(self, remote_file, output_file_path, total_size, mtime):
+        with open(self._resumeStatePath(output_file_path), 'w') as f:
+            json.dump({'remote_path': remote_file, 'size': total_size, 'mtime': mtime}, f)
+
+    def __clearResumeState(self, output_file_path):
+        try:
+            os.remove(self._resumeStatePath(output_file_path))
+        except FileNotFoundError:
+            pass
+
+    def __downloadWithProgress(self, remote_file, output_file_path, ftp=None, total_size=None, mtime=None):
         
-        """Handle downloading a file with progress updates."""
+        """Handle downloading a file with progress updates, resuming a partial download when possible."""
         
-        self.ftp.voidcmd("TYPE I")  # Set binary mode
+        ftp = ftp or self.ftp
+        ftp.voidcmd("TYPE I")  # Set binary mode
+
+        if total_size is None:
+            total_size = ftp.size(remote_file)
+
+        offset = self.__resumeOffset(remote_file, output_file_path, total_size, mtime)
+        self.__writeResumeState(remote_file, output_file_path, total_size, mtime)
+
+        if offset and offset == total_size:
+            Utils.log(f"[{os.path.basename(remote_file)}] already fully downloaded to {output_file_path}")
+            self.__clearResumeState(output_file_path)
+            if self.checksum:
+                self.__recordDigest(output_file_path, fileDigest(output_file_path, self.checksum).hexdigest())
+            return
+
+        started = time.perf_counter()
+        if offset:
+            Utils.log(f"Resuming {os.path.basename(remote_file)} at byte {offset} to {output_file_path}")
+
+        # Hashed as the data arrives (only a resumed prefix is read back from disk), counted by PROGRESS and throttled
+        writer = BackupFileWriter(output_file_path, self.checksum, self.cipher, host=self.host, total=total_size,
+                                  offset=offset, name=os.path.basename(remote_file), buffering=-1)
+        try:
+            with writer:
+                ftp.retrbinary(f"RETR {remote_file}", writer.write, blocksize=1024 * 1024, rest=offset or None)  # 1 MB chunks
+        except (error_perm, error_reply) as e:
+            # The REST reply comes before any data, so a refusal there leaves the partial file untouched
+            if not offset or writer.received or str(e)[:3] == '550':
+                raise
+            Utils.log(f"{self.className} host {self.host} refused to resume at byte {offset} ({e}), downloading from scratch.", level='warning')
+            self._rest = False
+            return self.__downloadWithProgress(remote_file, output_file_path, ftp, total_size, mtime)
 
-        total_size = self.ftp.size(remote_file)
-        downloaded = 0
+        self.__clearResumeState(output_file_path)
+        if writer.hexdigest() is not None:
+            self.__recordDigest(output_file_path, writer.hexdigest())
 
-        Utils.log(f"Starting downloading {os.path.basename(remote_file)} to {output_file_path}")
+        METRICS.transfer('ftp', writer.received, time.perf_counter() - started)
+        if offset:
+            METRICS.increment('resumed_bytes_total', offset, backend='ftp')
 
-        with open(output_file_path, 'wb') as f:
-            def progressing(data):
-                nonlocal downloaded
-                f.write(data)
-                downloaded += len(data)
-                percent = (downloaded / total_size) * 100
-                Utils.log(f"{os.path.basename(remote_file)} | {downloaded} of {total_size} bytes downloaded. ({percent:.2f}%)")
+    def __recordDigest(self, local_path, digest):
+        with self._digests_lock:
+            self.digests[local_path] = digest
 
-            self.ftp.retrbinary(f"RETR {remote_file}", progressing, blocksize=1024 * 1024)  # 1 MB chunks
 
-        Utils.log(f"[{os.path.basename(remote_file)}] downloaded successfully to {output_file_path}")
+    def listDir(self, remote_dir, ftp=None):
+        """List a remote directory in a single command, using MLSD with a parsed LIST fallback."""
 
+        ftp = ftp or self.ftp
+
+        with METRICS.timer('list_seconds', backend='ftp'), SESSIONS.holding(ftp):
+            return self.__listDir(remote_dir, ftp)
+
+    def __listDir(self, remote_dir, ftp):
+        if self._mlsd is not False:
+            try:
+                entries = [_parseMlsdEntry(name, facts) for name, facts in ftp.mlsd(remote_dir, facts=['type', 'size', 'modify'])]
+                self._mlsd = True
+                return [entry for entry in entries if entry is not None]
+            except error_perm as e:
+                # 5xx syntax / not implemented replies mean MLSD is unsupported; anything else is a real error
+                if self._mlsd or not str(e)[:3] in ('500', '501', '502', '504'):
+                    raise
+                Utils.log(f"{self.className} host {self.host} does not support MLSD, falling back to LIST.", level='warning')
+                self._mlsd = False
+
+        lines = []
+        ftp.retrlines(f"LIST {remote_dir}", lines.append)
+        entries = [_parseListLine(line) for line in lines]
+        return [entry for entry in entries if entry is not None]
+
+    def stat(self, remote_path, ftp=None):
+        """Return the FTPEntry for a single remote path by listing its parent, or None if absent."""
+
+        parent, name = posixpath.split(remote_path.rstrip('/'))
+        for entry in self.listDir(parent or '/', ftp):
+            if entry.name == name:
+                return entry
+        return None
 
     def isDir(self, remote_path):
         """Check if the remote path is a directory."""
-        current = self.ftp.pwd()
-        try:
-            self.ftp.cwd(remote_path)
-            self.ftp.cwd(current)  # Revert to original directory
-            return True
-        except:
-            return False
+        with SESSIONS.holding(self.ftp):
+            current = self.ftp.pwd()
+            try:
+                self.ftp.cwd(remote_path)
+                self.ftp.cwd(current)  # Revert to original directory
+                return True
+            except:
+                return False
         
 
-    def downloadFile(self, remote_path, local_path, max_retries=3):
+    def downloadFile(self, remote_path, local_path, max_retries=3, size=None, mtime=None):
         """Download a single file with progress tracking and retry logic."""
         
         """ Creating a directories in local path if it doesn't exist """
         Utils._makeDirs(os.path.dirname(local_path))
 
+        def attempt():
+            # After a dropped link the control connection is dead too, so retries resume with REST on a new session
+            if self.ftp is None:
+                self.ftp = self._acquireSession()
+                SESSIONS.keepAliveFTP(self.ftp)
+            try:
+                with SESSIONS.holding(self.ftp):
+                    self.__downloadWithProgress(remote_path, local_path, total_size=size, mtime=mtime)
+            except (OSError, EOFError, error_temp):
+                self.__dropSession()
+                raise
+
         try:
-            Utils.retry(lambda: self.__downloadWithProgress(remote_path, local_path), retries=max_retries)
+            Utils.retry(attempt, retries=max_retries, name='ftp_download')
 
-            self.__verifyFileSize(remote_path, local_path)
+            with SESSIONS.holding(self.ftp):
+                self.__verifyFileSize(remote_path, local_path, remote_size=size)
+            self.__addToChunkStore(local_path)
+            return True
         except Exception as e:
+            METRICS.increment('failures_total', backend='ftp')
             Utils.log(f"Unable to download File {remote_path}.",level='error')
+            return False
 
-    def downloadDir(self, remote_dir, local_dir, max_retries=3):
-        """Recursively download all files and subdirectories."""
+    def walk(self, remote_dir, local_dir):
+        """Recursively yield (remote_path, local_path, entry) for every file under remote_dir."""
 
         """ Creating a directories in local path if it doesn't exist """
         Utils._makeDirs(local_dir)
 
+        for entry in self.listDir(remote_dir):
+            remote_path = posixpath.join(remote_dir, entry.name)
+            local_path = os.path.join(local_dir, entry.name)
+
+            # Listings cannot tell where a symlink points, so only links cost an extra probe
+            if entry.type == 'dir' or (entry.type == 'link' and self.isDir(remote_path)):
+                yield from self.walk(remote_path, local_path)
+            else:
+                yield remote_path, local_path, entry
+
+    def downloadDir(self, remote_dir, local_dir, max_retries=3, files=None, on_done=None, on_start=None):
+        """
+            Recursively download all files and subdirectories. Returns the number of files that failed.
+
+            Args:
+                files (iterable, optional): (remote_path, local_path, entry) items to fetch instead of the full walk.
+                on_done (function, optional): Called with (remote_path, local_path, entry) after each verified file.
+                on_start (function, optional): Called with the same arguments when a file's transfer starts.
+        """
+
+        if self.workers > 1:
+            return self.downloadDirParallel(remote_dir, local_dir, max_retries, files, on_done, on_start)
+
+        if files is None:
+            files = self.walk(remote_dir, local_dir)
+
+        failed = 0
+        for remote_path, local_path, entry in files:
+            if on_start:
+                on_start(remote_path, local_path, entry)
+            if not self.downloadFile(remote_path, local_path, max_retries, entry.size, entry.mtime):
+                failed += 1
+            elif on_done:
+                on_done(remote_path, local_path, entry)
+
+        return failed
+
+    def __downloadPooled(self, pool, remote_path, local_path, max_retries=3, size=None, mtime=None):
+        """Download and verify one file on a pooled session, retrying on a fresh session if needed."""
+
+        def attempt():
+            with pool.session() as ftp:
+                self.__downloadWithProgress(remote_path, local_path, ftp, size, mtime)
+                self.__verifyFileSize(remote_path, local_path, ftp, size)
+
+        Utils.retry(attempt, retries=max_retries, name='ftp_download')
+        self.__addToChunkStore(local_path)
+
+    def __addToChunkStore(self, local_path):
+        """Add a verified download to the chunk store, if one is configured for this run."""
+        if self._store is not None:
+            # Chunked from the plaintext under the plain name, like streamed archives and dumps
+            name = os.path.relpath(local_path, self.local_base_path).replace(os.sep, '/')
+            self._store.ingestFile(name, storedPath(local_path, self.cipher))
+
+    def downloadDirParallel(self, remote_dir, local_dir, max_retries=3, files=None, on_done=None, on_start=None):
+        """Download a directory tree with a pool of FTPS sessions fed by the directory walk."""
+
+        if files is None:
+            files = self.walk(remote_dir, local_dir)
+
+        pool = FTPConnectionPool(self._acquireSession, self.workers, closer=lambda ftp, discard: self._releaseSession(ftp, discard))
+        tasks = queue.Queue(maxsize=self.workers * 64)
+        lock = threading.Lock()
+        stats = {'queued': 0, 'done': 0, 'failed': 0, 'bytes_queued': 0, 'bytes_done': 0}
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+
+                remote_path, local_path, entry = task
+                size = entry.size
+                try:
+                    if on_start:
+                        on_start(remote_path, local_path, entry)
+                    self.__downloadPooled(pool, remote_path, local_path, max_retries, size, entry.mtime)
+                    failed = False
+                    if on_done:
+                        on_done(remote_path, local_path, entry)
+                except Exception:
+                    METRICS.increment('failures_total', backend='ftp')
+                    Utils.log(f"Unable to download File {remote_path}.",level='error')
+                    failed = True
+
+                with lock:
+                    stats['done'] += 1
+                    stats['failed'] += failed
+                    stats['bytes_done'] += size or 0
+
+        Utils.log(f"Downloading {remote_dir} with {self.workers} parallel {self.className} sessions...")
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
         try:
-            self.ftp.cwd(remote_dir)
-            for item in self.ftp.nlst():
-                if item not in ('.', '..'):
-                    item_name = os.path.basename(item)
-                    local_path = os.path.join(local_dir, item_name)
-
-                    if self.isDir(item):
-                        self.downloadDir(item, local_path, max_retries)
-                    else:
-                        self.downloadFile(item, local_path, max_retries)
-            self.ftp.cwd('..')
-        except Exception as e:
-            raise
+            for remote_path, local_path, entry in files:
+                with lock:
+                    stats['queued'] += 1
+                    stats['bytes_queued'] += entry.size or 0
+                tasks.put((remote_path, local_path, entry))
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+            pool.close()
+
+        Utils.log(f"Downloaded {stats['done'] - stats['failed']} of {stats['queued']} files "
+                  f"({stats['bytes_done']} of {stats['bytes_queued']} bytes) from {remote_dir} ({stats['failed']} failed).")
+
+        return stats['failed']
+
 
+    def download(self, remote_dir_name, on_done=None, on_start=None):
+        """
+            Main entry point for downloading files or directories. Returns True when every file was downloaded.
 
-    def download(self, remote_dir_name):
-        """Main entry point for downloading files or directories."""
+            on_done is called with (remote_path, local_path, entry) after each verified file and on_start
+            when each file's transfer starts, as in downloadDir().
+        """
         local_path = os.path.join(self.local_base_path, os.path.basename(remote_dir_name))
 
 
@@ -154,10 +596,26 @@ class FTP:
 
         try:
             self.connect()
-            if self.isDir(remote_path):
-                self.downloadDir(remote_path, local_path)
+            self._store = ChunkStore(self.chunk_store, cipher=self.cipher) if self.chunk_store else None
+            self.digests = {}
+            entry = self.stat(remote_path)
+            if entry is None:
+                raise FileNotFoundError(f"{remote_path} does not exist on FTP host {self.host}")
+
+            if entry.type == 'dir' or (entry.type == 'link' and self.isDir(remote_path)):
+                failed = self.downloadDir(remote_path, local_path, on_done=on_done, on_start=on_start)
             else:
-                self.downloadFile(remote_path, local_path)
+                if on_start:
+                    on_start(remote_path, local_path, entry)
+                failed = 0 if self.downloadFile(remote_path, local_path, size=entry.size, mtime=entry.mtime) else 1
+                if not failed and on_done:
+                    on_done(remote_path, local_path, entry)
+
+            if failed:
+                error_message = f"{failed} file(s) under {remote_path} could not be downloaded from FTP host {self.host}."
+            elif self.digests:
+                sidecar = writeSidecar(local_path, self.digests, self.checksum)
+                Utils.log(f"Recorded {len(self.digests)} {self.checksum} digest(s) in {sidecar}")
 
         except KeyboardInterrupt:
             error_message = f"Downloading {remote_path} from FTP host {self.host} was interrupted by user."
@@ -171,4 +629,105 @@ class FTP:
             else:
                 Utils.log(f"Downloading {remote_path} from FTP host {self.host} completed successfully.")
 
-            self.disconnect()
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+            # A failed run may leave the session mid-transfer, so it is not handed to the next user
+            self.disconnect(discard=error_message is not None)
+            PROGRESS.summary()
+
+        return error_message is None
+
+    def __pruneDeleted(self, manifest, known, seen):
+        """Remove local copies of files that were mirrored before but no longer exist remotely."""
+
+        deleted = [remote_path for remote_path in known if remote_path not in seen]
+        for remote_path in deleted:
+            local_path = storedPath(known[remote_path][0], self.cipher)
+            try:
+                os.remove(local_path)
+                Utils.log(f"Removed {local_path} (deleted on {self.className} host {self.host})")
+            except FileNotFoundError:
+                pass
+        manifest.remove(deleted)
+        return len(deleted)
+
+    def sync(self, remote_dir_name, delete=False):
+        """
+            Incrementally mirror a remote file or directory into local_base_path.
+
+            Only files whose size or modification time differ from the local manifest are transferred.
+
+            Args:
+                remote_dir_name (str): Path relative to host_base_path.
+                delete (bool, optional): Remove local files that were deleted on the remote. Defaults to False.
+        """
+        local_path = os.path.join(self.local_base_path, os.path.basename(remote_dir_name))
+        remote_path = os.path.join(self.host_base_path, remote_dir_name)
+
+        start_time = datetime.datetime.now()
+        manifest = ManifestIndex(os.path.join(self.local_base_path, self.MANIFEST_NAME))
+        lock = threading.Lock()
+        stats = {'transferred': 0, 'skipped': 0, 'skipped_bytes': 0, 'deleted': 0}
+        seen = set()
+
+        error_message = None
+
+        def changed(files, known):
+            for remote_file, local_file, entry in files:
+                seen.add(remote_file)
+                row = known.get(remote_file)
+                if row is not None and row[1:] == (entry.size, entry.mtime) and self.__localSize(local_file) == entry.size:
+                    stats['skipped'] += 1
+                    stats['skipped_bytes'] += entry.size or 0
+                    continue
+                yield remote_file, local_file, entry
+
+        def on_done(remote_file, local_file, entry):
+            manifest.update(remote_file, local_file, entry.size, entry.mtime)
+            with lock:
+                stats['transferred'] += 1
+
+        try:
+            self.connect()
+            self._store = ChunkStore(self.chunk_store, cipher=self.cipher) if self.chunk_store else None
+            entry = self.stat(remote_path)
+            if entry is None:
+                raise FileNotFoundError(f"{remote_path} does not exist on FTP host {self.host}")
+
+            known = manifest.load(remote_path)
+
+            if entry.type == 'dir' or (entry.type == 'link' and self.isDir(remote_path)):
+                files = self.walk(remote_path, local_path)
+            else:
+                files = [(remote_path, local_path, entry)]
+
+            failed = self.downloadDir(remote_path, local_path, files=changed(files, known), on_done=on_done)
+            if failed:
+                Utils.log(f"{failed} changed file(s) could not be synced and will be retried next run.", level='warning')
+
+            # Only prune after a complete walk, otherwise unlisted files would look deleted
+            if delete:
+                stats['deleted'] = self.__pruneDeleted(manifest, known, seen)
+
+        except KeyboardInterrupt:
+            error_message = f"Syncing {remote_path} from FTP host {self.host} was interrupted by user."
+        except FTPConnectionError as e:
+            error_message = str(e)
+        except Exception as e:
+            error_message = f"Unexpected error while syncing {remote_path} from FTP host {self.host} :\n\n{e}\n"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                Utils.log(f"Syncing {remote_path} from FTP host {self.host} completed in {Utils.timeTaken(start_time)}: "
+                          f"{stats['transferred']} transferred, {stats['skipped']} unchanged skipped "
+                          f"({stats['skipped_bytes']} bytes), {stats['deleted']} deleted.")
+
+            manifest.close()
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+            # A failed run may leave the session mid-transfer, so it is not handed to the next user
+            self.disconnect(discard=error_message is not None)
+            PROGRESS.summary()
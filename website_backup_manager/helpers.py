@@ -2,6 +2,7 @@ import os
 import logging
 import datetime
 import time
+from metrics import METRICS
 
 class Helpers:
 
@@ -59,7 +60,7 @@ class Helpers:
             Helpers.log(f"Directory already exists: {path}")
 
     @staticmethod
-    def retry(operation, retries=3, delay=1):
+    def retry(operation, retries=3, delay=1, name=None):
         """
             Retry an operation in case of failure.
 
@@ -67,6 +68,7 @@ class Helpers:
                 operation (function): The operation to be retried.
                 retries (int, optional): The maximum number of retries. Defaults to 3.
                 delay (int, optional): The delay between retries in seconds. Defaults to 1.
+                name (str, optional): Counts failed attempts as retries_total{operation=name} in METRICS.
 
             Returns:
                 The result of the successful operation.
@@ -79,31 +81,22 @@ class Helpers:
                 return operation()
             except Exception as e:
                 Helpers.log(f"Attempt {attempt + 1} failed: {e}", level='error')
+                if name is not None:
+                    METRICS.increment('retries_total', operation=name)
                 time.sleep(delay)
         
         raise RuntimeError("Operation failed after {retries} retries.")
     
     @staticmethod
-    def monitorDownload(filePath: str, interval=0.5, max_stable_checks=10):
-        """Monitor progress of a file being downloaded or created."""
-        
-        last_size = 0
-        stable_checks = 0  # Tracks how many times size remains unchanged
+    def progressLine(name, done, total, elapsed, compressed=None) -> str:
+        """Format a progress line with percentage, throughput and ETA when a total is known."""
 
-        while True:
-            if os.path.exists(filePath):
-                current_size = os.path.getsize(filePath)
-                # {percent:.2f}
-                Helpers.log(f"{os.path.basename(filePath)} | {current_size:.2f} bytes downloaded. (__%)")
+        rate = done / elapsed if elapsed > 0 else 0
+        written = f"{compressed} bytes written ({done} bytes raw)" if compressed is not None else f"{done} bytes downloaded"
 
-                if current_size == last_size:
-                    stable_checks += 1
-                    if stable_checks >= max_stable_checks:
-                        Helpers.log(f"Assuming {os.path.basename(filePath)} downloaded successfully. Final size {current_size:.2f} bytes")
-                        break  # Stop monitoring once size is stable
-                else:
-                    stable_checks = 0  # Reset if size changes
+        if not total:
+            return f"{name} | {written} at {rate / (1024 * 1024):.2f} MB/s. (__%)"
 
-                last_size = current_size  # Update last size
-            
-            time.sleep(interval)
\ No newline at end of file
+        percent = min(done / total * 100, 100.0)
+        eta = datetime.timedelta(seconds=int((total - done) / rate)) if rate > 0 and done < total else datetime.timedelta(0)
+        return f"{name} | {written} of ~{total} at {rate / (1024 * 1024):.2f} MB/s, ETA {eta}. ({percent:.2f}%)"
@@ -0,0 +1,222 @@
+from helpers import Helpers as Utils
+from restore_manager import ArchiveRestorer
+from checksums import readSidecar, sidecarPath
+from encryption import storedPath
+from metrics import METRICS
+import datetime
+import json
+import os
+import posixpath
+import shlex
+import shutil
+
+
+class ArchiveChainError(Exception):
+    """Raised when an incremental archive chain is missing, broken or cannot be restored."""
+
+
+class IncrementalArchive:
+    """
+        Site archives made of a periodic full archive and the changes since, using GNU tar
+        --listed-incremental snapshot files.
+
+        The snapshot file lives on the server next to the archives, under
+        <host_base_url>/.backup-snapshots/<archive_name>.snar. Each run works on a copy of it
+        (.snar.new), so a run that fails to transfer leaves the chain where it was. The copy
+        replaces the snapshot only after the archive is safely stored locally. A full
+        archive (level 0) is taken when there is no chain yet, when the snapshot is missing
+        on the server, or every `full_every` runs (a full archive and `full_every` - 1 increments).
+
+        Restores extract the full archive and then every increment in order, which also
+        removes the files deleted between runs.
+
+        Layout under <local_base_url>/<archive_name>.incremental/:
+            chain.json                    the current chain: full archive and increments, in order
+            chain.<timestamp>.json        previous chains, kept when a new full archive starts one
+            <archive>-<time>-full.tar.gz  level 0 archive (a manifest path when a chunk store is used)
+            <archive>-<time>-inc.tar.gz   changes since the previous archive of the chain
+    """
+
+    STATE_NAME = 'chain.json'
+    SNAPSHOT_DIR = '.backup-snapshots'
+
+    def __init__(self, ssh, archive_name, full_every=7, downloader=None):
+        self.ssh = ssh
+        self.archive_name = archive_name
+        self.full_every = max(0, int(full_every))
+        self.downloader = downloader  # FTP or SFTP; without one the archive is streamed over SSH
+        self.directory = os.path.join(ssh.local_base_url, f"{archive_name}.incremental")
+        self.snapshot = posixpath.join(ssh.host_base_url, self.SNAPSHOT_DIR, f"{archive_name}.snar")
+
+    @property
+    def state_path(self):
+        return os.path.join(self.directory, self.STATE_NAME)
+
+    def loadState(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _saveState(self, state):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{self.state_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_path, self.state_path)
+
+    def _remote(self, command):
+        exit_status, output, error = self.ssh._execute_command(command)
+        if exit_status != 0:
+            raise ArchiveChainError(f"Remote command failed on {self.ssh.host}: {command}\n{error}")
+        return output
+
+    def nextLevel(self, state):
+        """0 for a full archive, 1 for an increment on top of the chain."""
+
+        if state is None or not self.full_every:
+            return 0
+        if len(state['archives']) >= self.full_every:
+            return 0
+        exit_status, _, _ = self.ssh._execute_command(f"test -s {shlex.quote(self.snapshot)}")
+        if exit_status != 0:
+            Utils.log(f"Snapshot {self.snapshot} is missing on {self.ssh.host}; taking a full archive.", level='warning')
+            return 0
+        return 1
+
+    def _prepareSnapshot(self, level):
+        """Create the working copy of the snapshot file that this run's tar updates."""
+
+        working = f"{self.snapshot}.new"
+        command = f"mkdir -p {shlex.quote(posixpath.dirname(self.snapshot))} && rm -f {shlex.quote(working)}"
+        if level:
+            command += f" && cp {shlex.quote(self.snapshot)} {shlex.quote(working)}"
+        self._remote(command)
+        return working
+
+    def _transfer(self, remote_dir_path, name, working):
+        """Archive the changes and bring them into the chain directory; returns (path, digest, bytes, kind)."""
+
+        if self.downloader is None:
+            result = self.ssh.stream_remote_archive(remote_dir_path, name, snapshot=working, output_dir=self.directory)
+            return result + ('chunk_store' if self.ssh.chunk_store else 'file',)
+
+        if not self.ssh.create_remote_archive(remote_dir_path, name, snapshot=working):
+            raise ArchiveChainError(f"Creating archive {name} failed on {self.ssh.host}")
+
+        file_name = f"{name}.tar.gz"
+        remote_archive = posixpath.join(self.ssh.host_base_url, file_name)
+        try:
+            if not self.downloader.download(file_name):
+                raise ArchiveChainError(f"Downloading {file_name} failed")
+
+            downloaded = os.path.join(self.downloader.local_base_path, file_name)
+            algorithm = self.downloader.checksum or self.ssh.checksum
+            sidecar = sidecarPath(downloaded, algorithm)
+            digest = readSidecar(sidecar).get(os.path.normpath(os.path.abspath(downloaded))) if os.path.exists(sidecar) else None
+
+            self.ssh.checksum = algorithm
+            if digest is not None and digest != self.ssh.remote_checksum(remote_archive):
+                raise ArchiveChainError(f"Checksum mismatch for {file_name}")
+
+            # Digests are kept under the plain name; an encrypted download is <name>.enc on disk
+            local_path = storedPath(os.path.join(self.directory, file_name), self.downloader.cipher)
+            downloaded = storedPath(downloaded, self.downloader.cipher)
+            if os.path.abspath(downloaded) != os.path.abspath(local_path):
+                shutil.move(downloaded, local_path)
+                if os.path.exists(sidecar):
+                    shutil.move(sidecar, sidecarPath(os.path.join(self.directory, file_name), algorithm))
+        finally:
+            # Archive names are unique per run, so they would pile up on the server
+            self.ssh._execute_command(f"rm -f {shlex.quote(remote_archive)}")
+
+        return local_path, digest, os.path.getsize(local_path), 'file'
+
+    def run(self, remote_dir_name):
+        """Take the next archive of the chain; returns its chain entry, or False on failure."""
+
+        remote_dir_path = posixpath.join(self.ssh.host_base_url, remote_dir_name)
+        os.makedirs(self.directory, exist_ok=True)
+        error_message = None
+        entry = None
+
+        try:
+            self.ssh.connect()
+            state = self.loadState()
+            level = self.nextLevel(state)
+            created = datetime.datetime.now()
+            name = f"{self.archive_name}-{created.strftime('%Y%m%d-%H%M%S')}-{'full' if level == 0 else 'inc'}"
+
+            working = self._prepareSnapshot(level)
+            with METRICS.timer('archive_seconds', backend='incremental'):
+                path, digest, size, kind = self._transfer(remote_dir_path, name, working)
+
+            # The archive is stored, so the chain may move forward
+            self._remote(f"mv -f {shlex.quote(working)} {shlex.quote(self.snapshot)}")
+
+            entry = {
+                # Chunk store manifests live in the store, so only chain-local files are kept relative
+                'file': os.path.relpath(path, self.directory) if kind == 'file' else path,
+                'kind': kind,
+                'level': level,
+                'created': created.isoformat(timespec='seconds'),
+                'bytes': size,
+                self.ssh.checksum: digest,
+            }
+
+            if level == 0:
+                if state is not None:
+                    archived = os.path.join(self.directory, f"chain.{state['archives'][0]['created'].replace(':', '')}.json")
+                    os.replace(self.state_path, archived)
+                state = {'archive': self.archive_name, 'directory': remote_dir_path, 'archives': []}
+            state['archives'].append(entry)
+            self._saveState(state)
+
+            METRICS.increment('archives_total', level='full' if level == 0 else 'incremental')
+
+        except KeyboardInterrupt:
+            error_message = "Incremental archive interrupted by user."
+        except Exception as e:
+            error_message = f"Incremental archive of {remote_dir_path} failed: {e}"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                kind = 'Full' if entry['level'] == 0 else 'Incremental'
+                Utils.log(f"{kind} archive {entry['file']} stored: {entry['bytes']} bytes "
+                          f"({len(state['archives'])} archive(s) in the chain).")
+            self.ssh.disconnect()
+
+        return entry if error_message is None else False
+
+    def restore(self, target_dir, until=None):
+        """
+            Extract the full archive and its increments into target_dir, in order.
+
+            until ('YYYY-MM-DDTHH:MM:SS') stops after the last archive created at or before that time.
+            Needs GNU tar locally. Returns the number of archives applied.
+        """
+
+        state = self.loadState()
+        if state is None or not state['archives']:
+            raise ArchiveChainError(f"No archive chain recorded in {self.directory}")
+
+        archives = [entry for entry in state['archives'] if until is None or entry['created'] <= until]
+        if not archives:
+            raise ArchiveChainError(f"No archive of {self.archive_name} was created before {until}")
+
+        os.makedirs(target_dir, exist_ok=True)
+        # Increments depend on each other, so a chain is applied in order; chunk store archives stream straight into tar
+        restorer = ArchiveRestorer(chunk_store=self.ssh.chunk_store,
+                                   encryption=getattr(self.downloader, 'cipher', None) or self.ssh.cipher)
+
+        for entry in archives:
+            path = os.path.join(self.directory, entry['file'])
+            try:
+                # --listed-incremental=/dev/null makes tar apply the recorded deletions of each increment
+                restorer.extract(path, target_dir, entry['kind'], ['--listed-incremental=/dev/null'])
+            except Exception as e:
+                raise ArchiveChainError(f"Extracting {entry['file']} failed: {e}")
+            Utils.log(f"Applied {entry['file']} (level {entry['level']}) to {target_dir}")
+
+        return len(archives)
@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class ManifestIndex:
+    """Persistent SQLite index of mirrored files: remote path, local path, size and mtime."""
+
+    def __init__(self, db_path, commit_every=500):
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                remote_path TEXT PRIMARY KEY,
+                local_path  TEXT NOT NULL,
+                size        INTEGER,
+                mtime       REAL,
+                synced_at   REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+
+    @staticmethod
+    def _prefixRange(prefix):
+        """Bounds selecting every path below prefix with an index range scan instead of LIKE."""
+        prefix = prefix.rstrip('/') + '/'
+        return prefix, prefix[:-1] + '0'  # '0' sorts right after '/'
+
+    def load(self, prefix):
+        """Return {remote_path: (local_path, size, mtime)} for every entry below prefix."""
+        low, high = self._prefixRange(prefix)
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT remote_path, local_path, size, mtime FROM files WHERE remote_path = ? OR (remote_path >= ? AND remote_path < ?)",
+                (prefix.rstrip('/'), low, high)
+            ).fetchall()
+        return {remote_path: (local_path, size, mtime) for remote_path, local_path, size, mtime in rows}
+
+    def update(self, remote_path, local_path, size, mtime):
+        """Record a file as mirrored; writes are batched into one commit per commit_every rows."""
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files (remote_path, local_path, size, mtime, synced_at) VALUES (?, ?, ?, ?, ?)",
+                (remote_path, local_path, size, mtime, time.time())
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self.db.commit()
+                self._pending = 0
+
+    def remove(self, remote_paths):
+        with self._lock:
+            self.db.executemany("DELETE FROM files WHERE remote_path = ?", ((path,) for path in remote_paths))
+            self.db.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,196 @@
+import bisect
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Throughput buckets in MB/s, seconds buckets for timers exported as histograms
+THROUGHPUT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+@contextmanager
+def _disabledTimer():
+    yield
+
+
+class Metrics:
+    """
+        Thread-safe registry of counters, gauges, timers and histograms for one backup run.
+
+        Managers record at their hot points through the shared METRICS instance. It starts
+        disabled, and every recording method then returns right after one attribute check,
+        so instrumented code costs next to nothing unless a run enables it.
+
+        Series are identified by a name plus keyword labels, e.g.
+            METRICS.increment('bytes_total', 4096, backend='ftp')
+    """
+
+    PREFIX = 'website_backup_'
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.constant_labels = {}  # Added to every exported series, e.g. {'site': 'shop'} in batch runs
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}      # key -> [count, sum, max]
+            self.histograms = {}  # key -> (buckets, [bucket counts], [count, sum])
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def record(self, name, seconds, **labels):
+        """Add one duration to a timer."""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def timer(self, name, **labels):
+        """Context manager that records the duration of its block under `name`."""
+        if not self.enabled:
+            return _disabledTimer()
+        return self._timed(name, labels)
+
+    @contextmanager
+    def _timed(self, name, labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, **labels)
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = (buckets, [0] * (len(buckets) + 1), [0, 0.0])
+            histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+            histogram[2][0] += 1
+            histogram[2][1] += value
+
+    def transfer(self, backend, nbytes, seconds, files=1):
+        """Record one finished transfer: byte and file counters plus a throughput observation."""
+        if not self.enabled:
+            return
+        self.increment('bytes_total', nbytes, backend=backend)
+        self.increment('files_total', files, backend=backend)
+        self.record('transfer_seconds', seconds, backend=backend)
+        if seconds > 0:
+            self.observe('throughput_mb_per_second', nbytes / seconds / (1024 * 1024), THROUGHPUT_BUCKETS, backend=backend)
+
+    def report(self):
+        """Return every series as a JSON-serialisable dict."""
+
+        def series(items, value):
+            return [dict(name=name, labels=dict(labels), **value(data)) for (name, labels), data in sorted(items, key=str)]
+
+        with self._lock:
+            return {
+                'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                'counters': series(self.counters.items(), lambda value: {'value': value}),
+                'gauges': series(self.gauges.items(), lambda value: {'value': value}),
+                'timers': series(self.timers.items(), lambda timer: {
+                    'count': timer[0], 'sum': round(timer[1], 6), 'max': round(timer[2], 6),
+                    'mean': round(timer[1] / timer[0], 6) if timer[0] else 0.0}),
+                'histograms': series(self.histograms.items(), lambda histogram: {
+                    'buckets': dict(zip([str(bound) for bound in histogram[0]] + ['+Inf'], histogram[1])),
+                    'count': histogram[2][0], 'sum': round(histogram[2][1], 6)}),
+            }
+
+    @staticmethod
+    def _atomicWrite(path, text):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # The textfile collector may read at any moment, so never expose a half-written file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+        return path
+
+    def writeJson(self, path, extra=None):
+        report = self.report()
+        if extra:
+            report.update(extra)
+        return self._atomicWrite(path, json.dumps(report, indent=2, default=str))
+
+    def _labels(self, labels, extra=()):
+        pairs = list(self.constant_labels.items()) + list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+    def prometheus(self):
+        """Format the registry in the Prometheus text exposition format."""
+
+        families = {}
+
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items(), key=str):
+                families.setdefault((name, 'counter'), []).append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+
+            for (name, labels), value in sorted(self.gauges.items(), key=str):
+                families.setdefault((name, 'gauge'), []).append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+
+            for (name, labels), (count, total, maximum) in sorted(self.timers.items(), key=str):
+                lines = families.setdefault((name, 'summary'), [])
+                lines.append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {total:.6f}")
+                lines.append(f"{self.PREFIX}{name}_count{self._labels(labels)} {count}")
+                families.setdefault((f"{name}_max", 'gauge'), []).append(
+                    f"{self.PREFIX}{name}_max{self._labels(labels)} {maximum:.6f}")
+
+            for (name, labels), (buckets, counts, (count, total)) in sorted(self.histograms.items(), key=str):
+                lines = families.setdefault((name, 'histogram'), [])
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.PREFIX}{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {total:.6f}")
+                lines.append(f"{self.PREFIX}{name}_count{self._labels(labels)} {count}")
+
+        output = []
+        for (name, kind), lines in sorted(families.items()):
+            output.append(f"# TYPE {self.PREFIX}{name} {kind}")
+            output.extend(lines)
+        return "\n".join(output) + "\n"
+
+    def writePrometheus(self, path):
+        """Write a textfile-collector file (node_exporter --collector.textfile.directory); path should end in .prom."""
+        return self._atomicWrite(path, self.prometheus())
+
+
+# Shared registry the managers record into; enabled per run by remote_backup_manager
+METRICS = Metrics()
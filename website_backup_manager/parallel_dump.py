@@ -0,0 +1,412 @@
+from helpers import Helpers as Utils
+from stream_compressor import ParallelCompressor
+from checksums import HashingWriter
+from encryption import sealing, storedPath
+from metrics import METRICS
+from throttle import THROTTLE
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint')
+
+FILE_HEADER = (
+    "SET NAMES utf8mb4;\n"
+    "SET TIME_ZONE='+00:00';\n"
+    "SET FOREIGN_KEY_CHECKS=0;\n"
+    "SET UNIQUE_CHECKS=0;\n\n"
+)
+
+
+def quoteIdentifier(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+class ParallelDumper:
+    """
+        Dump a MySQL database one table (or primary key range) per file over several
+        connections that all read from the same consistent InnoDB snapshot.
+
+        The snapshot is synchronised the way mydumper does it: FLUSH TABLES WITH READ LOCK on a
+        coordinator connection, START TRANSACTION WITH CONSISTENT SNAPSHOT on every worker
+        connection, then UNLOCK TABLES. The global read lock is only held while the workers
+        open their transactions and the binlog position is read.
+    """
+
+    def __init__(self, database, output_dir, workers=4, chunk_rows=500000, insert_bytes=1024 * 1024):
+        self.database = database
+        self.output_dir = output_dir
+        self.workers = max(1, int(workers))
+        self.chunk_rows = chunk_rows
+        self.insert_bytes = insert_bytes
+        self.consistent = True
+        self.binlog = None
+        self.columns = {}  # table -> columns to dump, in order, without generated ones
+
+    def _connect(self):
+        try:
+            import pymysql
+        except ImportError:
+            raise RuntimeError("Parallel dumps require the 'PyMySQL' package (pip install pymysql).")
+
+        connection = pymysql.connect(
+            host=self.database.host,
+            port=int(self.database.port),
+            user=self.database.username,
+            password=self.database.password,
+            database=self.database.db_name,
+            charset='utf8mb4',
+            autocommit=False
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("SET SESSION TIME_ZONE='+00:00'")
+        return connection
+
+    def _openSnapshots(self):
+        """Open the worker connections inside one shared snapshot and record the binlog position."""
+
+        import pymysql
+
+        coordinator = self._connect()
+        connections = [self._connect() for _ in range(self.workers)]
+        locked = False
+
+        try:
+            with coordinator.cursor() as cursor:
+                try:
+                    cursor.execute("FLUSH TABLES WITH READ LOCK")
+                    locked = True
+                except pymysql.err.OperationalError as e:
+                    # Without RELOAD privilege, separate snapshots could see different data, so use just one
+                    Utils.log(f"FLUSH TABLES WITH READ LOCK not permitted ({e}); dumping over a single snapshot connection.", level='warning')
+                    for connection in connections[1:]:
+                        connection.close()
+                    connections = connections[:1]
+                    self.consistent = False
+
+                for connection in connections:
+                    with connection.cursor() as worker_cursor:
+                        worker_cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                        worker_cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
+                self.binlog = self._binlogPosition(cursor)
+
+                if locked:
+                    cursor.execute("UNLOCK TABLES")
+        except Exception:
+            for connection in connections:
+                connection.close()
+            raise
+        finally:
+            coordinator.close()
+
+        return connections
+
+    @staticmethod
+    def _binlogPosition(cursor):
+        row = None
+        # MySQL 8.4 renamed SHOW MASTER STATUS
+        for statement in ("SHOW MASTER STATUS", "SHOW BINARY LOG STATUS"):
+            try:
+                cursor.execute(statement)
+                row = cursor.fetchone()
+                break
+            except Exception:
+                continue
+
+        if not row:
+            return None
+
+        return {'file': row[0], 'position': int(row[1]), 'gtid_set': row[4] if len(row) > 4 else None}
+
+    def _listTables(self, connection):
+        """Return ([(table, rows, pk_column or None)], [views]) for the database."""
+
+        schema = self.database.db_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT TABLE_NAME, TABLE_TYPE, COALESCE(TABLE_ROWS, 0) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s",
+                (schema,)
+            )
+            rows = cursor.fetchall()
+
+            cursor.execute(
+                "SELECT k.TABLE_NAME, k.COLUMN_NAME, c.DATA_TYPE FROM information_schema.KEY_COLUMN_USAGE k "
+                "JOIN information_schema.COLUMNS c ON c.TABLE_SCHEMA = k.TABLE_SCHEMA "
+                "AND c.TABLE_NAME = k.TABLE_NAME AND c.COLUMN_NAME = k.COLUMN_NAME "
+                "WHERE k.TABLE_SCHEMA = %s AND k.CONSTRAINT_NAME = 'PRIMARY'",
+                (schema,)
+            )
+            primary_keys = {}
+            for table, column, data_type in cursor.fetchall():
+                primary_keys.setdefault(table, []).append((column, data_type.lower()))
+
+            # Generated columns cannot be inserted into, so the restore recomputes them instead
+            cursor.execute(
+                "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = %s AND EXTRA NOT LIKE '%%GENERATED%%' ORDER BY TABLE_NAME, ORDINAL_POSITION",
+                (schema,)
+            )
+            self.columns = {}
+            for table, column in cursor.fetchall():
+                self.columns.setdefault(table, []).append(column)
+
+        tables, views = [], []
+        for table, table_type, table_rows in rows:
+            if table_type == 'VIEW':
+                views.append(table)
+                continue
+
+            # Only a single integer primary key can be split into cheap index range scans
+            pk = primary_keys.get(table, [])
+            pk_column = pk[0][0] if len(pk) == 1 and pk[0][1] in INTEGER_TYPES else None
+            tables.append((table, int(table_rows), pk_column))
+
+        # Largest tables first so the longest chunks start early
+        tables.sort(key=lambda item: item[1], reverse=True)
+        return tables, views
+
+    def _planChunks(self, connection, tables):
+        """Split every table into (table, index, where, params) chunks of about chunk_rows rows."""
+
+        chunks = []
+        for table, table_rows, pk_column in tables:
+            if pk_column is None or table_rows <= self.chunk_rows:
+                chunks.append((table, None, '', ()))
+                continue
+
+            column = quoteIdentifier(pk_column)
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT MIN({column}), MAX({column}) FROM {quoteIdentifier(table)}")
+                low, high = cursor.fetchone()
+
+            if low is None:
+                chunks.append((table, None, '', ()))
+                continue
+
+            step = max(1, (high - low + 1) * self.chunk_rows // table_rows)
+            index = 0
+            for start in range(low, high + 1, step):
+                end = start + step
+                if end > high:
+                    chunks.append((table, index, f" WHERE {column} >= %s", (start,)))
+                else:
+                    chunks.append((table, index, f" WHERE {column} >= %s AND {column} < %s", (start, end)))
+                index += 1
+
+        return chunks
+
+    def _chunkFileName(self, table, index):
+        name = table if index is None else f"{table}.{index:05d}"
+        return storedPath(f"{name}.sql{ParallelCompressor.extension(self.database.compression)}", self.database.cipher)
+
+    def _writeSchema(self, connection, tables, views):
+        path = os.path.join(self.output_dir, storedPath(f"schema.sql{ParallelCompressor.extension(self.database.compression)}",
+                                                        self.database.cipher))
+
+        with open(path, 'wb') as output, sealing(output, self.database.cipher) as f, connection.cursor() as cursor:
+            writer = self._writer(f)
+            writer.write(FILE_HEADER.encode())
+            for table, _, _ in tables:
+                cursor.execute(f"SHOW CREATE TABLE {quoteIdentifier(table)}")
+                writer.write(f"DROP TABLE IF EXISTS {quoteIdentifier(table)};\n{cursor.fetchone()[1]};\n\n".encode())
+            for view in views:
+                cursor.execute(f"SHOW CREATE VIEW {quoteIdentifier(view)}")
+                writer.write(f"DROP VIEW IF EXISTS {quoteIdentifier(view)};\n{cursor.fetchone()[1]};\n\n".encode())
+            if writer is not f:
+                writer.close()
+
+        return os.path.basename(path)
+
+    @staticmethod
+    def _showCreate(cursor, kind, name, column):
+        """The CREATE statement and sql_mode of a trigger, routine or event, or None without the privilege to see it."""
+        cursor.execute(f"SHOW CREATE {kind} {quoteIdentifier(name)}")
+        row = dict(zip((description[0] for description in cursor.description), cursor.fetchone()))
+        if not row.get(column):
+            Utils.log(f"Not allowed to read the definition of {kind.lower()} `{name}`; it is left out of the dump.", level='warning')
+            return None
+        return row[column], row.get('sql_mode') or ''
+
+    def _writeObjects(self, connection):
+        """
+            Write the triggers, stored routines and events to objects.sql, as mysqldump does with
+            --triggers --routines --events. Returns the file name, or None when there are none.
+
+            They are kept out of the schema so the restore creates them once the data is in:
+            triggers would otherwise fire for every restored row.
+        """
+
+        schema = self.database.db_name
+        statements = []
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT TRIGGER_NAME FROM information_schema.TRIGGERS WHERE TRIGGER_SCHEMA = %s "
+                           "ORDER BY EVENT_OBJECT_TABLE, ACTION_ORDER", (schema,))
+            objects = [('TRIGGER', name, 'SQL Original Statement') for name, in cursor.fetchall()]
+            cursor.execute("SELECT ROUTINE_TYPE, ROUTINE_NAME FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = %s "
+                           "ORDER BY ROUTINE_TYPE, ROUTINE_NAME", (schema,))
+            objects += [(kind, name, f"Create {kind.title()}") for kind, name in cursor.fetchall()]
+            cursor.execute("SELECT EVENT_NAME FROM information_schema.EVENTS WHERE EVENT_SCHEMA = %s ORDER BY EVENT_NAME",
+                           (schema,))
+            objects += [('EVENT', name, 'Create Event') for name, in cursor.fetchall()]
+
+            for kind, name, column in objects:
+                definition = self._showCreate(cursor, kind, name, column)
+                if definition is None:
+                    continue
+                create, sql_mode = definition
+                statements.append(f"DROP {kind} IF EXISTS {quoteIdentifier(name)};\n"
+                                  f"SET SESSION sql_mode = {connection.escape(sql_mode)};\n"
+                                  f"DELIMITER ;;\n{create} ;;\nDELIMITER ;\n\n")
+
+        if not statements:
+            return None
+
+        path = os.path.join(self.output_dir, storedPath(f"objects.sql{ParallelCompressor.extension(self.database.compression)}",
+                                                        self.database.cipher))
+        with open(path, 'wb') as output, sealing(output, self.database.cipher) as f:
+            writer = self._writer(f)
+            writer.write(FILE_HEADER.encode())
+            for statement in statements:
+                writer.write(statement.encode('utf-8', 'surrogateescape'))
+            if writer is not f:
+                writer.close()
+
+        Utils.log(f"Dumped {len(statements)} trigger(s), routine(s) and event(s) to {os.path.basename(path)}.")
+        return os.path.basename(path)
+
+    def _writer(self, fileobj):
+        if self.database.compression:
+            # Chunks already run in parallel, so each file gets a single compression thread
+            return ParallelCompressor(fileobj, self.database.compression, self.database.compression_level, workers=1)
+        return fileobj
+
+    def _dumpChunk(self, connection, chunk):
+        """Write one table or key range as extended INSERT statements; return (file, rows, bytes)."""
+
+        import pymysql.cursors
+
+        table, index, where, params = chunk
+        file_name = self._chunkFileName(table, index)
+        path = os.path.join(self.output_dir, file_name)
+        rows = 0
+        started = time.monotonic()
+
+        with open(path, 'wb', buffering=1024 * 1024) as output, sealing(output, self.database.cipher) as sealed:
+            f = HashingWriter(sealed, self.database.checksum)
+            writer = self._writer(f)
+            writer.write(FILE_HEADER.encode())
+
+            cursor = connection.cursor(pymysql.cursors.SSCursor)
+            try:
+                columns = ', '.join(quoteIdentifier(column) for column in self.columns[table])
+                cursor.execute(f"SELECT {columns} FROM {quoteIdentifier(table)}{where}", params)
+                prefix = f"INSERT INTO {quoteIdentifier(table)} ({columns}) VALUES\n"
+
+                batch, batch_size = [], 0
+                while True:
+                    fetched = cursor.fetchmany(1000)
+                    if not fetched:
+                        break
+                    for row in fetched:
+                        values = '(' + ','.join(connection.escape(value) for value in row) + ')'
+                        batch.append(values)
+                        batch_size += len(values)
+                        rows += 1
+                        if batch_size >= self.insert_bytes:
+                            # surrogateescape restores the raw bytes of BLOB values escaped by PyMySQL
+                            data = (prefix + ',\n'.join(batch) + ';\n').encode('utf-8', 'surrogateescape')
+                            writer.write(data)
+                            THROTTLE.consume(self.database.host, len(data))
+                            batch, batch_size = [], 0
+
+                if batch:
+                    writer.write((prefix + ',\n'.join(batch) + ';\n').encode('utf-8', 'surrogateescape'))
+            finally:
+                cursor.close()
+
+            if writer is not f:
+                writer.close()
+
+        METRICS.transfer('mysql', f.bytes_written, time.monotonic() - started)
+        METRICS.increment('rows_total', rows, backend='mysql')
+
+        return file_name, rows, f.bytes_written, f.hexdigest()
+
+    def run(self):
+        """Run the dump and return the metadata written to metadata.json."""
+
+        start_time = datetime.datetime.now()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        connections = self._openSnapshots()
+        pool = queue.Queue()
+        for connection in connections:
+            pool.put(connection)
+
+        try:
+            tables, views = self._listTables(connections[0])
+            schema_file = self._writeSchema(connections[0], tables, views)
+            objects_file = self._writeObjects(connections[0])
+            chunks = self._planChunks(connections[0], tables)
+
+            Utils.log(f"Dumping {len(tables)} tables in {len(chunks)} chunks with {len(connections)} snapshot connections...")
+
+            lock = threading.Lock()
+            files = {table: [] for table, _, _ in tables}
+            done = 0
+
+            def dumpChunk(chunk):
+                connection = pool.get()
+                try:
+                    return chunk[0], self._dumpChunk(connection, chunk)
+                finally:
+                    pool.put(connection)
+
+            with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+                futures = [executor.submit(dumpChunk, chunk) for chunk in chunks]
+                try:
+                    for future in as_completed(futures):
+                        table, (file_name, rows, size, digest) = future.result()
+                        with lock:
+                            done += 1
+                            files[table].append({'file': file_name, 'rows': rows, 'bytes': size, self.database.checksum: digest})
+                        Utils.log(f"[{done}/{len(chunks)}] {file_name}: {rows} rows, {size} bytes")
+                except BaseException:
+                    # One failed chunk fails the whole dump, so the chunks that have not started are dropped
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+
+        finally:
+            for connection in connections:
+                try:
+                    connection.rollback()
+                    connection.close()
+                except Exception:
+                    pass
+
+        metadata = {
+            'database': self.database.db_name,
+            'started': start_time.isoformat(),
+            'finished': datetime.datetime.now().isoformat(),
+            'consistent': self.consistent,
+            'binlog': self.binlog,
+            'compression': self.database.compression,
+            'schema': schema_file,
+            'objects': objects_file,
+            'views': views,
+            'tables': {table: sorted(entries, key=lambda entry: entry['file']) for table, entries in files.items()},
+        }
+
+        with open(os.path.join(self.output_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        Utils.log(f"Parallel dump of '{self.database.db_name}' finished in {Utils.timeTaken(start_time)}.")
+
+        return metadata
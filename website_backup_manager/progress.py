@@ -0,0 +1,281 @@
+from helpers import Helpers as Utils
+import datetime
+import json
+import sys
+import threading
+import time
+
+
+class ProgressConfigError(ValueError):
+    """Raised when a progress sink specification cannot be parsed."""
+
+
+class Transfer:
+    """
+        Byte counter of one file, archive or dump stream, handed out by Progress.transfer().
+
+        advance() is the only call on the hot path: it adds to a counter and compares the
+        clock with the aggregator's next report time, so it can be called for every block.
+        Use it as a context manager, or call finish() when the transfer ends.
+    """
+
+    __slots__ = ('progress', 'name', 'total', 'done', 'initial', 'started', 'finished')
+
+    def __init__(self, progress, name, total=None, done=0):
+        self.progress = progress
+        self.name = name
+        self.total = total or None
+        self.done = done        # Includes a resumed prefix, for the percentage
+        self.initial = done     # Bytes already there before this run, left out of the throughput
+        self.started = time.monotonic()
+        self.finished = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(failed=exc_type is not None)
+
+    def advance(self, nbytes):
+        self.done += nbytes
+        if time.monotonic() >= self.progress._next_report:
+            self.progress.report()
+
+    def finish(self, failed=False):
+        if not self.finished:
+            self.finished = True
+            self.progress._finish(self, failed)
+
+
+class Progress:
+    """
+        Aggregates the byte counts of every running transfer and reports them at most once
+        per `interval` seconds to a set of sinks.
+
+        Transfers report by advancing their counter; whichever transfer first notices that
+        the interval has passed builds one snapshot (total bytes, throughput since the last
+        report, ETA, per-file status) and hands it to the sinks. No thread polls files or
+        timers. Top-level operations (a directory download, an archive stream, a dump) call
+        summary() when they end; once nothing is running any more, a final snapshot
+        summarises everything transferred since the last summary and the counters start over.
+
+        Snapshots are dicts:
+            {'time', 'elapsed', 'bytes', 'total', 'rate', 'average_rate', 'eta',
+             'completed', 'failed', 'active': [{'name', 'bytes', 'total', 'elapsed'}], 'final', **labels}
+        'total' and 'eta' are None while any transfer has an unknown size.
+    """
+
+    def __init__(self, sinks=None, interval=2.0):
+        self.labels = {}  # Added to every snapshot, e.g. {'site': 'shop'} in batch runs
+        self._lock = threading.Lock()
+        self._report_lock = threading.Lock()
+        self.configure(sinks, interval)
+
+    def configure(self, sinks=None, interval=None):
+        """Set the sinks (default: a LogSink) and the reporting interval in seconds; an empty list disables reporting."""
+
+        with self._lock:
+            self.sinks = [LogSink()] if sinks is None else list(sinks)
+            if interval is not None:
+                self.interval = float(interval)
+            self._reset()
+            self._next_report = time.monotonic() + self.interval if self.sinks else float('inf')
+
+    def _reset(self):
+        self._active = {}
+        self._started = None
+        self._completed = 0
+        self._failed = 0
+        self._completed_bytes = 0
+        self._completed_moved = 0
+        self._completed_total = 0
+        self._unknown_total = False
+        self._last_moved = 0
+        self._last_time = None
+
+    def transfer(self, name, total=None, done=0):
+        """Register a transfer of `total` bytes (None if unknown), `done` of which are already there."""
+
+        transfer = Transfer(self, name, total, done)
+        with self._lock:
+            if self._started is None:
+                self._started = self._last_time = transfer.started
+            self._active[id(transfer)] = transfer
+        return transfer
+
+    def _finish(self, transfer, failed):
+        with self._lock:
+            if self._active.pop(id(transfer), None) is None:
+                return
+            self._completed += 1
+            self._failed += failed
+            self._completed_bytes += transfer.done
+            self._completed_moved += transfer.done - transfer.initial
+            if transfer.total is None:
+                self._unknown_total = True
+            else:
+                self._completed_total += transfer.total
+
+    def summary(self):
+        """Report the final snapshot of the transfers since the last summary, unless some are still running."""
+
+        with self._lock:
+            if self._active or self._started is None or not self.sinks:
+                return
+        self.report(final=True)
+
+    def _snapshot(self, now, final):
+        active = list(self._active.values())
+        done = self._completed_bytes + sum(transfer.done for transfer in active)
+        moved = self._completed_moved + sum(transfer.done - transfer.initial for transfer in active)
+
+        total = None
+        if not self._unknown_total and all(transfer.total is not None for transfer in active):
+            total = self._completed_total + sum(transfer.total for transfer in active)
+
+        elapsed = now - self._started if self._started is not None else 0.0
+        average_rate = moved / elapsed if elapsed > 0 else 0.0
+        window = now - self._last_time if self._last_time is not None else 0.0
+        rate = (moved - self._last_moved) / window if window > 0 and not final else average_rate
+        self._last_moved, self._last_time = moved, now
+
+        eta = None
+        if total is not None:
+            eta = max(total - done, 0) / rate if rate > 0 else (0.0 if done >= total else None)
+
+        return dict(self.labels, **{
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'elapsed': round(elapsed, 3),
+            'bytes': done,
+            'total': total,
+            'rate': round(rate, 1),
+            'average_rate': round(average_rate, 1),
+            'eta': round(eta, 1) if eta is not None else None,
+            'completed': self._completed,
+            'failed': self._failed,
+            'active': [{'name': transfer.name, 'bytes': transfer.done, 'total': transfer.total,
+                        'elapsed': round(now - transfer.started, 3)} for transfer in active],
+            'final': final,
+        })
+
+    def report(self, final=False):
+        """Send a snapshot to the sinks; a report already in progress on another thread is not repeated."""
+
+        if not self._report_lock.acquire(blocking=final):
+            return
+        try:
+            now = time.monotonic()
+            with self._lock:
+                if not final and now < self._next_report:
+                    return
+                self._next_report = now + self.interval
+                if self._started is None or (final and self._active):
+                    return
+                snapshot = self._snapshot(now, final)
+                if final:
+                    self._reset()
+
+            for sink in self.sinks:
+                try:
+                    sink.update(snapshot)
+                except Exception as e:
+                    # Progress output must never break a transfer
+                    Utils.log(f"Progress sink {type(sink).__name__} failed: {e}", level='warning')
+        finally:
+            self._report_lock.release()
+
+
+class LogSink:
+    """Reports through Helpers.log: one line per running transfer (up to max_files) and a total line."""
+
+    def __init__(self, max_files=5):
+        self.max_files = max_files
+
+    def update(self, snapshot):
+        if snapshot['final']:
+            failed = f", {snapshot['failed']} failed" if snapshot['failed'] else ''
+            Utils.log(f"Transferred {snapshot['bytes']} bytes in {snapshot['completed']} transfer(s){failed} "
+                      f"in {datetime.timedelta(seconds=int(snapshot['elapsed']))} "
+                      f"at {snapshot['average_rate'] / (1024 * 1024):.2f} MB/s.")
+            return
+
+        active = snapshot['active']
+        for item in active[:self.max_files]:
+            Utils.log(Utils.progressLine(item['name'], item['bytes'], item['total'], item['elapsed']))
+        if len(active) > 1 or snapshot['completed']:
+            Utils.log(f"Total: {formatStatus(snapshot)}")
+
+
+class TTYSink:
+    """Redraws a single progress bar line on a terminal."""
+
+    def __init__(self, stream=None, width=30):
+        self.stream = stream or sys.stderr
+        self.width = width
+
+    def update(self, snapshot):
+        total = snapshot['total']
+        filled = int(self.width * min(snapshot['bytes'] / total, 1.0)) if total else 0
+        bar = '#' * filled + '-' * (self.width - filled) if total else '?' * self.width
+        names = ', '.join(item['name'] for item in snapshot['active'][:2])
+        line = f"[{bar}] {formatStatus(snapshot)}" + (f" {names}" if names else '')
+
+        self.stream.write('\r' + line[:160].ljust(160) + ('\n' if snapshot['final'] else ''))
+        self.stream.flush()
+
+
+class JSONLinesSink:
+    """Appends every snapshot as one JSON object per line to a file or stream."""
+
+    def __init__(self, path=None, stream=None):
+        self.path = path
+        self.stream = stream or (sys.stdout if path is None else None)
+        self._lock = threading.Lock()
+
+    def update(self, snapshot):
+        line = json.dumps(snapshot) + '\n'
+        with self._lock:
+            if self.stream is not None:
+                self.stream.write(line)
+                self.stream.flush()
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(line)
+
+
+def formatStatus(snapshot):
+    """'3.50 MB of ~10.00 MB at 1.20 MB/s, ETA 0:00:05 (2 running, 4 done)' from a snapshot."""
+
+    megabytes = 1024 * 1024
+    text = f"{snapshot['bytes'] / megabytes:.2f} MB"
+    if snapshot['total']:
+        text += f" of ~{snapshot['total'] / megabytes:.2f} MB ({min(snapshot['bytes'] / snapshot['total'] * 100, 100.0):.2f}%)"
+    text += f" at {snapshot['rate'] / megabytes:.2f} MB/s"
+    if snapshot['eta'] is not None:
+        text += f", ETA {datetime.timedelta(seconds=int(snapshot['eta']))}"
+    return text + f" ({len(snapshot['active'])} running, {snapshot['completed']} done)"
+
+
+def parseSinks(spec):
+    """
+        Build sinks from a comma separated spec: 'log', 'tty', 'json' (stdout), 'json:<path>' or 'none'.
+    """
+
+    if spec is None or spec == '':
+        return None
+    sinks = []
+    for part in str(spec).split(','):
+        kind, _, argument = part.strip().partition(':')
+        if kind == 'log':
+            sinks.append(LogSink())
+        elif kind == 'tty':
+            sinks.append(TTYSink())
+        elif kind == 'json':
+            sinks.append(JSONLinesSink(argument or None))
+        elif kind != 'none':
+            raise ProgressConfigError(f"Invalid progress sink '{part}'; use log, tty, json, json:<path> or none.")
+    return sinks
+
+
+# Shared aggregator every transfer path reports to; configured per run by remote_backup_manager
+PROGRESS = Progress()
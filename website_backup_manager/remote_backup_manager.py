@@ -1,20 +1,56 @@
 from ftp_manager import FTP
 from ssh_manager import SSH
+from sftp_manager import SFTP
+from incremental_archive import IncrementalArchive
 from database_manager import MySQLDatabase
+from stage_pipeline import StagePipeline
+from checksums import readSidecar, sidecarPath, writeSidecar
+from metrics import METRICS
+from throttle import THROTTLE
+from progress import PROGRESS, parseSinks
+from restore_manager import DatabaseRestorer, ArchiveRestorer
+from encryption import BackupCipher, storedPath
+from chunk_store import ChunkStore
+from backup_catalog import BackupCatalog, parseRetention
 import os
+import json
 import datetime
 
 from helpers import Helpers as Utils
 
 class remote_backup_manager:
-    def __init__(self, ftp_config = None, ssh_config = None, db_config = None):
+    PROMETHEUS_FILE_NAME = 'website_backup.prom'
+
+    def __init__(self, ftp_config = None, ssh_config = None, db_config = None, metrics_dir = None, sftp_config = None,
+                 bandwidth = None, progress = None, progress_interval = None, catalog = None, retention = None):
 
         self.ftp_downloader = None
         self.ssh_manager = None
         self.database_downloader = None
 
+        # With a metrics directory, full_backup writes a JSON run report and a Prometheus textfile there
+        self.metrics_dir = metrics_dir
+        if metrics_dir:
+            METRICS.enabled = True
+
+        # Bandwidth limits shared by every transfer: {'rate': ..., 'per_host': ..., 'host_rates': {...}}, see Throttle.configure
+        if bandwidth:
+            THROTTLE.configure(**bandwidth)
+
+        # Progress sinks: 'log' (default), 'tty', 'json:<path>' or 'none', comma separated; see progress.parseSinks
+        if progress is not None or progress_interval is not None:
+            PROGRESS.configure(parseSinks(progress), progress_interval)
+
+        # With a catalog database, full_backup records every run and its files there and then
+        # prunes the site's old runs by the retention policy ("daily=7,weekly=4,monthly=12", see parseRetention)
+        self.catalog = catalog
+        self.retention = parseRetention(retention)
+
         if ftp_config is not None:
             self.ftp_downloader = FTP(**ftp_config)
+        elif sftp_config is not None:
+            # Hosts without (fast) FTP: files come over SFTP, with the same download() semantics
+            self.ftp_downloader = SFTP(**sftp_config)
         if ssh_config is not None:
             self.ssh_manager = SSH(**ssh_config)
         if db_config is not None:
@@ -28,9 +64,21 @@ class remote_backup_manager:
             return
         try:
             Utils.log(f"Starting FTP download for: {remote_path}")
-            self.ftp_downloader.download(remote_path)
+            return self.ftp_downloader.download(remote_path)
         except Exception as e:
             Utils.log(f"Error during FTP download: {e}",level='error')
+            return False
+
+    def sync_from_ftp(self, remote_path, delete=False):
+        """Incrementally mirror files or directories from the FTP server, skipping unchanged files."""
+        if not self.ftp_downloader:
+            Utils.log("No FTP downloader configured. Skipping FTP sync.")
+            return
+        try:
+            Utils.log(f"Starting FTP sync for: {remote_path}")
+            self.ftp_downloader.sync(remote_path, delete)
+        except Exception as e:
+            Utils.log(f"Error during FTP sync: {e}",level='error')
 
     def create_remote_archive(self, remote_dir_name, archive_name = None):
         """Create a remote archive using SSH."""
@@ -39,9 +87,109 @@ class remote_backup_manager:
             return
         try:
             Utils.log(f"Creating archive for {remote_dir_name}...")
-            self.ssh_manager.make_archive(remote_dir_name, archive_name)
+            return self.ssh_manager.make_archive(remote_dir_name, archive_name)
         except Exception as e:
             Utils.log(f"Error during remote archiving: {e}",level='error')
+            return False
+
+    def stream_remote_archive(self, remote_dir_name, archive_name = None, local_compression=None):
+        """Stream a tar archive of the remote directory over SSH directly to local storage."""
+        if not self.ssh_manager:
+            Utils.log("No SSH manager configured. Skipping archive streaming.")
+            return
+        try:
+            Utils.log(f"Streaming archive for {remote_dir_name}...")
+            return self.ssh_manager.stream_archive(remote_dir_name, archive_name, local_compression)
+        except Exception as e:
+            Utils.log(f"Error during archive streaming: {e}",level='error')
+            return False
+
+    def incremental_archive(self, remote_dir_name, archive_name = None, stream_archive = False, full_every = 7):
+        """Take the next archive of the site's incremental chain: a full archive, or only the files changed since the last one."""
+        if not self.ssh_manager:
+            Utils.log("No SSH manager configured. Skipping incremental archiving.")
+            return
+        try:
+            archive = IncrementalArchive(self.ssh_manager, archive_name or remote_dir_name, full_every,
+                                         downloader=None if stream_archive else self.ftp_downloader)
+            entry = archive.run(remote_dir_name)
+            if not entry:
+                return False
+            # The stored path and the chain it belongs to (its full archive), for the backup catalog
+            chain = archive.loadState()['archives'][0]
+            resolve = lambda item: item['file'] if item['kind'] == 'chunk_store' else os.path.join(archive.directory, item['file'])
+            return dict(entry, path=resolve(entry), chain=resolve(chain))
+        except Exception as e:
+            Utils.log(f"Error during incremental archiving: {e}",level='error')
+            return False
+
+    def restore_archive(self, archive_name, target_dir, until = None):
+        """Rebuild a site directory from its incremental chain, optionally as it was at `until`."""
+        if not self.ssh_manager:
+            Utils.log("No SSH manager configured. Skipping archive restore.")
+            return
+        try:
+            return IncrementalArchive(self.ssh_manager, archive_name).restore(target_dir, until) > 0
+        except Exception as e:
+            Utils.log(f"Error during archive restore: {e}",level='error')
+            return False
+
+    def restore_site_archives(self, archives, target_dir, workers = 4):
+        """Extract downloaded or streamed site archives into target_dir, several at once; one subdirectory per archive when given more than one."""
+        if not archives:
+            Utils.log("No archives given. Skipping site restore.")
+            return
+        try:
+            restorer = ArchiveRestorer(workers, self.ssh_manager.chunk_store if self.ssh_manager else None,
+                                       encryption=next((manager.cipher for manager in (self.ssh_manager, self.ftp_downloader)
+                                                        if manager is not None and manager.cipher is not None), None))
+            return restorer.extractAll(restorer.plan(archives, target_dir)) == 0
+        except Exception as e:
+            Utils.log(f"Error during site restore: {e}",level='error')
+            return False
+
+    def verify_downloaded_archive(self, archive_name):
+        """Compare the digest recorded while downloading an archive with the digest computed on the server."""
+        if not self.ssh_manager or not self.ftp_downloader:
+            Utils.log("Verification needs both SSH and FTP configured. Skipping archive verification.")
+            return
+        try:
+            file_name = f"{archive_name}.tar.gz"
+            algorithm = self.ftp_downloader.checksum
+            local_path = os.path.join(self.ftp_downloader.local_base_path, file_name)
+
+            sidecar = sidecarPath(local_path, algorithm) if algorithm else None
+            if sidecar is None or not os.path.exists(sidecar):
+                # Archives kept in the chunk store are checked on restore instead
+                Utils.log(f"No {algorithm} sidecar for {file_name}. Skipping archive verification.")
+                return
+
+            expected = readSidecar(sidecar).get(os.path.normpath(os.path.abspath(local_path)))
+            self.ssh_manager.checksum = algorithm
+            return self.ssh_manager.verify_checksum(file_name, expected)
+        except Exception as e:
+            Utils.log(f"Error during archive verification: {e}",level='error')
+            return False
+
+    def verify_downloaded_directory(self, remote_dir_name):
+        """Compare the digests recorded while downloading a directory with a checksum listing streamed from the server."""
+        if not self.ssh_manager or not self.ftp_downloader:
+            Utils.log("Verification needs both SSH and FTP configured. Skipping directory verification.")
+            return
+        try:
+            algorithm = self.ftp_downloader.checksum
+            local_path = os.path.join(self.ftp_downloader.local_base_path, os.path.basename(remote_dir_name))
+
+            sidecar = sidecarPath(local_path, algorithm) if algorithm else None
+            if sidecar is None or not os.path.exists(sidecar):
+                Utils.log(f"No {algorithm} sidecar for {remote_dir_name}. Skipping directory verification.")
+                return
+
+            self.ssh_manager.checksum = algorithm
+            return self.ssh_manager.verify_directory(remote_dir_name, readSidecar(sidecar), local_path) == 0
+        except Exception as e:
+            Utils.log(f"Error during directory verification: {e}",level='error')
+            return False
 
     def dump_database(self, dump_name):
         """Take a MySQL database dump."""
@@ -52,36 +200,253 @@ class remote_backup_manager:
         
         try:
             Utils.log(f"Initiating database dump: {dump_name}")
-            self.database_downloader.dump(dump_name)
+            return self.database_downloader.dump(dump_name)
         except Exception as e:
             Utils.log(f"Error during database dump: {e}",level='error')
+            return False
+
+    def dump_database_incremental(self):
+        """Save the MySQL binary logs written since the last full or incremental dump."""
+
+        if not self.database_downloader:
+            Utils.log("No database downloader configured. Skipping incremental dump.")
+            return
 
-    def full_backup(self, website_dir_name, website_database_name, website_archive_name = None):
-        """Perform a complete backup: FTP download, archive, and database dump."""
         try:
-            Utils.log("**** Full backup process started ****")
-            
-            start_time = datetime.datetime.now()
+            Utils.log("Initiating incremental database dump")
+            return self.database_downloader.dumpIncremental()
+        except Exception as e:
+            Utils.log(f"Error during incremental database dump: {e}",level='error')
+            return False
 
+    def restore_dump(self, source, target_db = None, workers = 4, defer_indexes = True):
+        """Load a dump file, parallel dump directory or chunk store manifest into target_db (default: the configured database)."""
+
+        if not self.database_downloader:
+            Utils.log("No database downloader configured. Skipping dump restore.")
+            return
+
+        try:
+            return DatabaseRestorer(self.database_downloader, workers, target_db, defer_indexes).restore(source)
+        except Exception as e:
+            Utils.log(f"Error during dump restore: {e}",level='error')
+            return False
 
-            # Step 1: Create an archive of remote files
-            self.create_remote_archive(website_dir_name, website_archive_name)
+    def restore_database(self, stop_datetime=None):
+        """Restore the last full dump and replay its binlog incrementals, up to stop_datetime when given."""
 
+        if not self.database_downloader:
+            Utils.log("No database downloader configured. Skipping database restore.")
+            return
 
-            if website_archive_name is None:
-                website_archive_name = website_dir_name
+        try:
+            Utils.log("Initiating database restore")
+            return self.database_downloader.restore(stop_datetime)
+        except Exception as e:
+            Utils.log(f"Error during database restore: {e}",level='error')
+            return False
+
+    def backup_stages(self, website_dir_name, website_database_name, website_archive_name = None, stream_archive = False,
+                      incremental = False, full_every = 7, run_stamp = None):
+        """
+            Build the stage graph of a full backup: archive -> download -> verify, with the database dump independent.
+
+            With run_stamp, the streamed archive and the dump are written as <name>-<run_stamp>, so each
+            run keeps its own files instead of overwriting the previous run's.
+        """
+
+        pipeline = StagePipeline()
+        if run_stamp:
+            website_database_name = f"{website_database_name}-{run_stamp}"
+
+        if incremental:
+            # The chain commits its snapshot only after the archive is stored, so transfer and verify stay in one stage
+            pipeline.add('archive', lambda: self.incremental_archive(website_dir_name, website_archive_name, stream_archive, full_every))
+        elif stream_archive:
+            # Archive and download in one pass: stream the remote tar straight to local storage
+            stream_name = website_archive_name
+            if run_stamp:
+                stream_name = f"{website_archive_name if website_archive_name is not None else website_dir_name.lower()}-{run_stamp}"
+            pipeline.add('archive', lambda: self.stream_remote_archive(website_dir_name, stream_name))
+        else:
+            archive_name = website_archive_name if website_archive_name is not None else website_dir_name
+
+            pipeline.add('archive', lambda: self.create_remote_archive(website_dir_name, website_archive_name))
+            pipeline.add('download', lambda: self.download_website_archive(archive_name), depends=['archive'])
+            pipeline.add('verify', lambda: self.verify_downloaded_archive(archive_name), depends=['download'])
+
+        # The dump does not depend on the site files, so it overlaps with the archive stages
+        pipeline.add('database', lambda: self.download_database_dump(website_database_name))
+
+        return pipeline
+
+    def full_backup(self, website_dir_name, website_database_name, website_archive_name = None, stream_archive = False,
+                    incremental = False, full_every = 7):
+        """
+            Perform a complete backup: FTP download, archive, and database dump.
+
+            Independent stages run concurrently; the download waits for the archive. With
+            stream_archive=True the archive is streamed over SSH instead of being written on
+            the server and downloaded again over FTP. With incremental=True only the files changed
+            since the previous run are archived, with a full archive every `full_every` runs.
+
+            With a backup catalog, every run's archive and dump get their own timestamped names
+            and the catalog's retention policy decides when they are deleted.
+
+            Returns the per-stage results of StagePipeline.run().
+        """
+        results = {}
+        failed = None
+        start_time = datetime.datetime.now()
+        run_stamp = start_time.strftime('%Y%m%d-%H%M%S') if self.catalog else None
+        METRICS.reset()
+        try:
+            Utils.log("**** Full backup process started ****")
 
-            # Step 2: Download files from FTP server
-            self.download_website_archive(website_archive_name)
+            results = self.backup_stages(website_dir_name, website_database_name, website_archive_name, stream_archive,
+                                         incremental, full_every, run_stamp).run()
 
-            # Step 3: Take a database dump
-            self.download_database_dump(website_database_name)
+            failed = [name for name, info in results.items() if info['status'] in ('failed', 'blocked')]
+            level = 'error' if failed else 'info'
+            outcome = f"with failed stages: {', '.join(failed)}" if failed else "completed"
 
-            Utils.log(f"**** Backup completed in {Utils.timeTaken(start_time)} ****")
+            Utils.log(f"**** Backup {outcome} in {Utils.timeTaken(start_time)} ****\n{StagePipeline.summary(results)}", level=level)
 
         except Exception as e:
             Utils.log(f"Backup Interrupted with this error:\n{e}\n",level='error')
 
+        self.write_run_report(website_dir_name, start_time, results, failed == [])
+        self.record_run(website_dir_name, website_database_name, website_archive_name, start_time, results, failed == [], run_stamp)
+
+        return results
+
+    def write_run_report(self, site_name, start_time, results, success):
+        """Write the collected metrics as <metrics_dir>/backup-report-<time>.json and a Prometheus textfile."""
+
+        if not self.metrics_dir:
+            return
+
+        try:
+            METRICS.set('run_seconds', (datetime.datetime.now() - start_time).total_seconds())
+            METRICS.set('last_run_timestamp_seconds', int(start_time.timestamp()))
+            METRICS.set('last_run_success', int(bool(success)))
+
+            stages = {name: {'status': info['status'], 'seconds': round(info['seconds'], 3), 'error': info['error']}
+                      for name, info in results.items()}
+            # Batch runs label every series with their site and keep one report and textfile per site
+            site = METRICS.constant_labels.get('site')
+            prefix = f"{site}-" if site else ''
+            prometheus_name = f"website_backup_{site}.prom" if site else self.PROMETHEUS_FILE_NAME
+
+            report_path = os.path.join(self.metrics_dir, f"backup-report-{prefix}{start_time.strftime('%Y%m%d-%H%M%S')}.json")
+            METRICS.writeJson(report_path, {'site': site or site_name, 'success': bool(success), 'stages': stages})
+            METRICS.writePrometheus(os.path.join(self.metrics_dir, prometheus_name))
+
+            Utils.log(f"Run report written to {report_path}")
+        except OSError as e:
+            Utils.log(f"Unable to write the run report: {e}",level='error')
+
+    def record_run(self, website_dir_name, website_database_name, website_archive_name, start_time, results, success,
+                   run_stamp = None):
+        """Add the run, its stages and the files they stored to the backup catalog, then apply the retention policy."""
+
+        if not self.catalog:
+            return
+
+        site = METRICS.constant_labels.get('site') or website_dir_name
+        try:
+            stages = {}
+            for name, info in results.items():
+                outputs = self.stage_outputs(name, info['result'], website_dir_name, website_database_name,
+                                             website_archive_name, run_stamp) if info['status'] == 'ok' else []
+                stages[name] = {'status': info['status'], 'seconds': round(info['seconds'], 3), 'error': info['error'],
+                                'outputs': outputs}
+
+            with BackupCatalog(self.catalog) as catalog:
+                catalog.record(f"{site}-{start_time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}", site, start_time.timestamp(),
+                               (datetime.datetime.now() - start_time).total_seconds(), 'ok' if success else 'failed', stages)
+                Utils.log(f"Run recorded in backup catalog {self.catalog}")
+
+                if self.retention and success:
+                    catalog.prune(site, **self.retention)
+        except Exception as e:
+            Utils.log(f"Unable to record the run in the backup catalog: {e}",level='error')
+
+    def prune_backups(self, site, dry_run = False):
+        """Delete the catalogued runs of a site, and their files, that the retention policy does not keep."""
+
+        if not self.catalog or not self.retention:
+            Utils.log("No backup catalog or retention policy configured. Skipping pruning.")
+            return
+        try:
+            with BackupCatalog(self.catalog) as catalog:
+                return catalog.prune(site, dry_run=dry_run, **self.retention)
+        except Exception as e:
+            Utils.log(f"Error while pruning backups: {e}",level='error')
+            return False
+
+    def stage_outputs(self, stage, result, website_dir_name, website_database_name, website_archive_name = None,
+                      run_stamp = None):
+        """
+            The files a successful stage stored locally, as backup catalog outputs.
+
+            The downloaded archive keeps the server's archive name, so with run_stamp it is moved to
+            <archive>-<run_stamp>.tar.gz here, with its sidecar; everything else was written per run.
+        """
+
+        archive_name = website_archive_name if website_archive_name is not None else website_dir_name
+        manager = self.ssh_manager or self.ftp_downloader
+        algorithm = getattr(manager, 'checksum', None)
+
+        if stage == 'archive' and isinstance(result, dict):
+            # Incremental archive: one link of a chain
+            return [self.catalog_output(result['path'], result['kind'], result.get(algorithm), algorithm, result['chain'])]
+        if stage == 'archive' and isinstance(result, tuple):
+            # Streamed archive: (stored path or chunk store manifest, digest, bytes)
+            path, digest, _ = result
+            return [self.catalog_output(path, 'chunk_store' if self.ssh_manager.chunk_store else 'file', digest, algorithm)]
+        if stage == 'download':
+            downloader = self.ftp_downloader
+            local_path = os.path.join(downloader.local_base_path, f"{archive_name}.tar.gz")
+            algorithm = downloader.checksum
+            digest = downloader.digests.get(local_path)
+            if run_stamp:
+                run_path = os.path.join(downloader.local_base_path, f"{archive_name}-{run_stamp}.tar.gz")
+                os.replace(storedPath(local_path, downloader.cipher), storedPath(run_path, downloader.cipher))
+                if algorithm and digest:
+                    writeSidecar(run_path, {run_path: digest}, algorithm)
+                    if os.path.exists(sidecarPath(local_path, algorithm)):
+                        os.remove(sidecarPath(local_path, algorithm))
+                local_path = run_path
+            return [self.catalog_output(storedPath(local_path, downloader.cipher), 'file', digest, algorithm)]
+        if stage == 'database':
+            database = self.database_downloader
+            if run_stamp:
+                website_database_name = f"{website_database_name}-{run_stamp}"
+            if database.workers > 1:
+                return [self.catalog_output(database.dump_dir(website_database_name), 'directory')]
+            dump_path = database.dump_path(website_database_name)
+            if database.chunk_store:
+                with ChunkStore(database.chunk_store, cipher=database.cipher) as store:
+                    manifest = store.latestManifest(os.path.basename(dump_path).split('.sql')[0] + '.sql')
+                return [self.catalog_output(manifest, 'chunk_store')] if manifest else []
+            sidecar = sidecarPath(dump_path, database.checksum)
+            digest = readSidecar(sidecar).get(os.path.normpath(os.path.abspath(dump_path))) if os.path.exists(sidecar) else None
+            return [self.catalog_output(storedPath(dump_path, database.cipher), 'file', digest, database.checksum)]
+        return []
+
+    @staticmethod
+    def catalog_output(path, kind, digest = None, algorithm = None, chain = None):
+        path = os.path.abspath(path)
+        if kind == 'directory':
+            size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+        elif kind == 'chunk_store':
+            with open(path) as f:
+                size = json.load(f)['size']
+        else:
+            size = os.path.getsize(path)
+        return {'kind': kind, 'path': path, 'size': size, 'digest': digest, 'algorithm': algorithm, 'chain': chain}
+
 
     def create_website_archive_on_server(self,remote_dir, archive_name):    
         # Create an archive of remote files
@@ -90,11 +455,11 @@ class remote_backup_manager:
 
     def download_website_archive(self,archive_name = 'backup'):    
         # Download files from FTP server
-        self.download_from_ftp(f"{archive_name}.tar.gz")
+        return self.download_from_ftp(f"{archive_name}.tar.gz")
 
     def download_database_dump(self,db_dump_name = 'database'):    
         # Take a database dump
-        self.dump_database(db_dump_name)
+        return self.dump_database(db_dump_name)
         
 
 
@@ -112,6 +477,9 @@ if __name__ == "__main__":
 
     # Local path where website backup will be downloaded
     local_base_path = "/Users/your_user_name"
+
+    # One cipher shared by every manager when ENCRYPTION_KEY_FILE is set; outputs are then written as <file>.enc
+    encryption = BackupCipher.fromConfig(os.getenv('ENCRYPTION_KEY_FILE'), os.getenv('ENCRYPTION_ALGORITHM'))
     
 
 
@@ -121,15 +489,31 @@ if __name__ == "__main__":
         'password': os.getenv('SSH_PASS', 'sshpassword'),
         'port': os.getenv('SSH_PORT', 22),
         'local_base_url': local_base_path,
-        'host_base_url': 'path_on_server'  
+        'host_base_url': 'path_on_server',
+        'chunk_store': os.getenv('CHUNK_STORE'),
+        'checksum': os.getenv('CHECKSUM', 'sha256'),
+        'nice': os.getenv('REMOTE_NICE'),
+        'ionice': os.getenv('REMOTE_IONICE'),
+        'encryption': encryption
+    }
+
+    # Pass as sftp_config instead of ftp_config to download over the SSH login rather than FTPS
+    sftp_config = {
+        **ssh_config,
+        'workers': os.getenv('SFTP_WORKERS', 4),
     }
 
     ftp_config = {
         'host': os.getenv('FTP_HOST', 'ftp.example.com'),
         'username': os.getenv('FTP_USER', 'ftpuser'),
         'password': os.getenv('FTP_PASS', 'ftppassword'),
+        'port': os.getenv('FTP_PORT', 21),
         'local_base_path': local_base_path,
-        'host_base_path': 'path_on_server'
+        'host_base_path': 'path_on_server',
+        'workers': os.getenv('FTP_WORKERS', 1),
+        'chunk_store': os.getenv('CHUNK_STORE'),
+        'checksum': os.getenv('CHECKSUM', 'sha256'),
+        'encryption': encryption
     }
 
     db_config = {
@@ -138,10 +522,29 @@ if __name__ == "__main__":
         'password': os.getenv('DB_PASS', 'dbpassword'),
         'host': os.getenv('DB_HOST', 'localhost'),
         'port': os.getenv('DB_PORT', 3306),
-        'local_base_path': local_base_path
+        'local_base_path': local_base_path,
+        'compression': os.getenv('DB_COMPRESSION'),
+        'workers': os.getenv('DB_WORKERS', 1),
+        'chunk_store': os.getenv('CHUNK_STORE'),
+        'checksum': os.getenv('CHECKSUM', 'sha256'),
+        'binlog': os.getenv('DB_BINLOG', '').lower() in ('1', 'true', 'yes'),
+        'nice': os.getenv('DB_NICE'),
+        'ionice': os.getenv('DB_IONICE'),
+        'restore_workers': os.getenv('RESTORE_WORKERS', 4),
+        'encryption': encryption
+    }
+
+    # Rates like "10M", or schedules like "08:00-20:00=2M,20M" (2 MB/s by day, 20 MB/s otherwise)
+    bandwidth = {
+        'rate': os.getenv('BANDWIDTH_LIMIT'),
+        'per_host': os.getenv('BANDWIDTH_PER_HOST'),
     }
 
     
-    manager = remote_backup_manager(db_config=db_config)
+    manager = remote_backup_manager(db_config=db_config, metrics_dir=os.getenv('METRICS_DIR'), bandwidth=bandwidth,
+                                    progress=os.getenv('PROGRESS'), progress_interval=os.getenv('PROGRESS_INTERVAL'),
+                                    catalog=os.getenv('BACKUP_CATALOG'), retention=os.getenv('RETENTION'))
 
-    manager.full_backup(website_dir_name, database_name)
\ No newline at end of file
+    manager.full_backup(website_dir_name, database_name,
+                        incremental=os.getenv('ARCHIVE_INCREMENTAL', '').lower() in ('1', 'true', 'yes'),
+                        full_every=int(os.getenv('ARCHIVE_FULL_EVERY', 7)))
\ No newline at end of file
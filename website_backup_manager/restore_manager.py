@@ -0,0 +1,598 @@
+from helpers import Helpers as Utils
+from stream_compressor import openCompressed
+from encryption import BackupCipher, EXTENSION, EncryptionError, plaintextSize
+from chunk_store import ChunkStore
+from metrics import METRICS
+from progress import PROGRESS
+import argparse
+import contextlib
+import io
+import json
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RestoreError(Exception):
+    """Raised when a dump or an archive cannot be restored."""
+
+
+# Every loader session turns these off for the bulk load; they only last as long as the session
+BULK_LOAD_SETTINGS = (
+    "SET SESSION foreign_key_checks=0;\n"
+    "SET SESSION unique_checks=0;\n"
+)
+
+# Section markers mysqldump writes as "-- <marker> `name`" comments
+TABLE_STRUCTURE = re.compile(rb'^-- Table structure for table `((?:[^`]|``)+)`')
+TABLE_DATA = re.compile(rb'^-- Dumping data for table `((?:[^`]|``)+)`')
+TAIL_SECTION = re.compile(rb'^-- (?:Temporary (?:view|table) structure for view|Final view structure for view|'
+                          rb'Dumping routines for database|Dumping events for database|Dump completed)')
+
+SECONDARY_INDEX = re.compile(r'^\s*(?:FULLTEXT |SPATIAL )?(?:KEY|INDEX) ')
+FOREIGN_KEY = re.compile(r'FOREIGN KEY \(([^)]*)\)')
+AUTO_INCREMENT_COLUMN = re.compile(r'^\s*`((?:[^`]|``)+)`\s.*\bAUTO_INCREMENT\b')
+IDENTIFIER = re.compile(r'`((?:[^`]|``)+)`')
+
+
+def _indexColumns(definition):
+    """Column names of a KEY definition, or None for functional indexes that cannot be deferred safely."""
+
+    start = definition.index('(')
+    if definition[start + 1:].lstrip().startswith('('):
+        return None
+
+    depth = 0
+    for end in range(start, len(definition)):
+        if definition[end] == '(':
+            depth += 1
+        elif definition[end] == ')':
+            depth -= 1
+            if depth == 0:
+                break
+    return IDENTIFIER.findall(definition[start:end])
+
+
+def deferIndexes(create_statement):
+    """
+        Split the secondary indexes out of a CREATE TABLE statement as written by SHOW CREATE TABLE.
+
+        Returns (statement without them, list of ALTER TABLE statements adding them back). PRIMARY
+        and UNIQUE keys stay, as do indexes on the AUTO_INCREMENT column and indexes a FOREIGN KEY
+        may depend on. FULLTEXT indexes get an ALTER each, since InnoDB builds one at a time.
+    """
+
+    lines = create_statement.split('\n')
+    start = next((i for i, line in enumerate(lines) if line.startswith('CREATE TABLE')), None)
+    end = next((i for i, line in enumerate(lines) if start is not None and i > start and line.startswith(')')), None)
+    if start is None or end is None:
+        return create_statement, []
+
+    table = IDENTIFIER.search(lines[start]).group(0)
+    definitions = [line.rstrip().rstrip(',') for line in lines[start + 1:end]]
+
+    auto_increment = next((match.group(1) for match in map(AUTO_INCREMENT_COLUMN.match, definitions) if match), None)
+    foreign_keys = [IDENTIFIER.findall(columns) for line in definitions for columns in FOREIGN_KEY.findall(line)]
+
+    kept, deferred, fulltext = [], [], []
+    for definition in definitions:
+        columns = _indexColumns(definition) if SECONDARY_INDEX.match(definition) else None
+        if columns is None or (columns and columns[0] == auto_increment) or \
+                any(columns[:len(foreign)] == foreign for foreign in foreign_keys):
+            kept.append(definition)
+        elif definition.lstrip().startswith('FULLTEXT'):
+            fulltext.append(definition.strip())
+        else:
+            deferred.append(definition.strip())
+
+    if not deferred and not fulltext:
+        return create_statement, []
+
+    statement = '\n'.join(lines[:start + 1] + [',\n'.join(kept)] + lines[end:])
+    alters = []
+    if deferred:
+        alters.append(f"ALTER TABLE {table} " + ', '.join(f"ADD {definition}" for definition in deferred) + ";\n")
+    alters += [f"ALTER TABLE {table} ADD {definition};\n" for definition in fulltext]
+    return statement, alters
+
+
+def deferSchemaIndexes(sql):
+    """Apply deferIndexes to every CREATE TABLE of a SQL script; returns (script, {table: [ALTER statements]})."""
+
+    output, indexes = [], {}
+    statement = None
+    for line in sql.split('\n'):
+        if statement is None and line.startswith('CREATE TABLE '):
+            statement = [line]
+            continue
+        if statement is not None:
+            statement.append(line)
+            if not line.startswith(')'):
+                continue
+            text, alters = deferIndexes('\n'.join(statement))
+            if alters:
+                indexes[IDENTIFIER.search(statement[0]).group(1).replace('``', '`')] = alters
+            output.append(text)
+            statement = None
+            continue
+        output.append(line)
+
+    if statement is not None:
+        output += statement
+    return '\n'.join(output), indexes
+
+
+class _IterReader(io.RawIOBase):
+    """Readable file object over an iterator of bytes blocks, e.g. ChunkStore.read()."""
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = next(self._blocks, b'')
+            if not self._pending:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+class DatabaseRestorer:
+    """
+        Load the dumps written by MySQLDatabase.dump into a MySQL / MariaDB server, several
+        tables at once.
+
+        Every table is loaded on its own mysql client session with foreign key and unique
+        checks off. Secondary indexes are taken out of CREATE TABLE and added back with one
+        ALTER TABLE per table once its rows are in, which builds each index in a single sorted
+        pass instead of updating it row by row. Views, routines and events are created last.
+
+        Accepted sources:
+            <name>.sql[.gz|.zst][.enc]
+                                    single-file mysqldump output; split per table on the fly into a
+                                    spool directory, and each table is loaded as soon as it is complete
+            <name>/ (metadata.json) parallel dump; every chunk file is loaded concurrently
+            chunk store manifest    a single-file dump kept in the chunk store
+    """
+
+    def __init__(self, database, workers=4, target_db=None, defer_indexes=True, skip_binlog=False,
+                 spool_dir=None, chunk_size=1024 * 1024):
+        self.database = database
+        self.workers = max(1, int(workers))
+        self.target_db = target_db or database.db_name
+        self.defer_indexes = defer_indexes
+        self.skip_binlog = skip_binlog  # SET sql_log_bin=0 needs SUPER / BINLOG ADMIN on the target
+        self.spool_dir = spool_dir or database.local_base_path
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self.stats = {'tables': 0, 'files': 0, 'bytes': 0, 'failed': []}
+
+    def _clientCommand(self, database=True):
+        command = self.database._clientCommand('mysql') + ["--max-allowed-packet=1G"]
+        return command + [self.target_db] if database else command
+
+    def _settings(self):
+        return BULK_LOAD_SETTINGS + ("SET SESSION sql_log_bin=0;\n" if self.skip_binlog else "")
+
+    def execute(self, parts, name=None, total=None, database=True):
+        """
+            Feed SQL to one mysql client session. parts are SQL as str / bytes, or pathlib.Path files to stream.
+
+            Bytes streamed from files are reported to PROGRESS under `name`.
+        """
+
+        command = self._clientCommand(database)
+        started = time.monotonic()
+        moved = 0
+
+        with tempfile.TemporaryFile() as stderr_output:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr_output)
+            progress = PROGRESS.transfer(name, total) if name else None
+            try:
+                for part in parts:
+                    if isinstance(part, str):
+                        process.stdin.write(part.encode())
+                    elif isinstance(part, bytes):
+                        process.stdin.write(part)
+                    else:
+                        with openCompressed(str(part), cipher=self.database.cipher) as source:
+                            for chunk in iter(lambda: source.read(self.chunk_size), b''):
+                                process.stdin.write(chunk)
+                                moved += len(chunk)
+                                if progress is not None:
+                                    progress.advance(len(chunk))
+            except BrokenPipeError:
+                pass  # mysql stopped reading because of an error; its exit status and stderr tell why
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+                process.wait()
+                if progress is not None:
+                    progress.finish(failed=process.returncode != 0)
+
+            if process.returncode != 0:
+                stderr_output.seek(0)
+                raise RestoreError(f"mysql failed{f' on {name}' if name else ''}: "
+                                   f"{stderr_output.read().decode(errors='replace').strip()}")
+
+        METRICS.transfer('mysql_restore', moved, time.monotonic() - started)
+        with self._lock:
+            self.stats['bytes'] += moved
+        return moved
+
+    def _createDatabase(self):
+        name = self.target_db.replace('`', '``')
+        self.execute([f"CREATE DATABASE IF NOT EXISTS `{name}`;\n"], database=False)
+
+    def _loadTable(self, table, header, schema, data_path, size):
+        """Create one table without its secondary indexes, load its rows, then build the indexes."""
+
+        indexes = []
+        if self.defer_indexes:
+            schema, found = deferSchemaIndexes(schema)
+            indexes = found.get(table, [])
+
+        parts = [self._settings(), header, schema]
+        if data_path is not None:
+            parts.append(pathlib.Path(data_path))
+        self.execute(parts, table, size)
+
+        if indexes:
+            with METRICS.timer('restore_index_seconds', backend='mysql'):
+                self.execute([self._settings(), header] + indexes)
+            Utils.log(f"Built {sum(alter.count(' ADD ') for alter in indexes)} deferred index(es) on `{table}`.")
+
+        METRICS.increment('tables_restored_total', backend='mysql')
+        with self._lock:
+            self.stats['tables'] += 1
+
+    def _submit(self, executor, futures, name, function, *args):
+        def run():
+            try:
+                function(*args)
+            except Exception as e:
+                Utils.log(f"Restoring {name} failed: {e}", level='error')
+                with self._lock:
+                    self.stats['failed'].append(name)
+
+        futures.append(executor.submit(run))
+
+    def _restoreStream(self, source):
+        """Split single-file mysqldump output per table and load the tables while the split goes on."""
+
+        header, tail = [], []
+        table, schema, data, data_path = None, [], None, None
+        section = 'header'
+
+        spool = tempfile.mkdtemp(prefix='.restore-', dir=self.spool_dir)
+        futures = []
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+                def flush():
+                    nonlocal table, schema, data, data_path
+                    if table is not None:
+                        if data is not None:
+                            data.close()
+                        size = os.path.getsize(data_path) if data_path else None
+                        self._submit(executor, futures, table, self._loadTable, table, header_text,
+                                     b''.join(schema).decode('utf-8', 'surrogateescape'), data_path, size)
+                    table, schema, data, data_path = None, [], None, None
+
+                header_text = ''
+                for line in source:
+                    structure = TABLE_STRUCTURE.match(line)
+                    if structure or TABLE_DATA.match(line) or TAIL_SECTION.match(line):
+                        if section == 'header':
+                            header_text = b''.join(header).decode('utf-8', 'surrogateescape')
+
+                        if structure:
+                            flush()
+                            section = 'schema'
+                            table = structure.group(1).decode().replace('``', '`')
+                        elif TABLE_DATA.match(line) and table is not None:
+                            section = 'data'
+                            data_path = os.path.join(spool, f"{len(futures):06d}.sql")
+                            data = open(data_path, 'wb', buffering=self.chunk_size)
+                        else:
+                            flush()
+                            section = 'tail'
+
+                    if section == 'header':
+                        header.append(line)
+                    elif section == 'schema':
+                        schema.append(line)
+                    elif section == 'data':
+                        data.write(line)
+                    else:
+                        tail.append(line)
+                flush()
+
+                if section == 'header':
+                    # No table markers at all, e.g. a bare INSERT script; load it as it is
+                    tail = header
+                    header_text = ''
+
+            with self._lock:
+                failed = list(self.stats['failed'])
+            if failed:
+                raise RestoreError(f"{len(failed)} table(s) could not be restored: {', '.join(failed)}")
+
+            # Views, routines and events may refer to any table, so they come last
+            if tail:
+                self.execute([self._settings(), header_text, b''.join(tail)])
+
+        finally:
+            shutil.rmtree(spool, ignore_errors=True)
+
+    def _restoreParallel(self, directory):
+        """Load a parallel dump: schema first, then every chunk concurrently and each table's indexes, then triggers, routines and events."""
+
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+
+        with openCompressed(os.path.join(directory, metadata['schema']), cipher=self.database.cipher) as source:
+            schema = source.read().decode('utf-8', 'surrogateescape')
+
+        indexes = {}
+        if self.defer_indexes:
+            schema, indexes = deferSchemaIndexes(schema)
+        self.execute([self._settings(), schema])
+
+        remaining = {table: len(entries) for table, entries in metadata['tables'].items()}
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def loadChunk(table, entry):
+                self.execute([self._settings(), pathlib.Path(directory, entry['file'])], entry['file'], entry.get('bytes'))
+                with self._lock:
+                    self.stats['files'] += 1
+                    remaining[table] -= 1
+                    last = remaining[table] == 0
+                if last:
+                    finishTable(table)
+
+            def finishTable(table):
+                if indexes.get(table):
+                    with METRICS.timer('restore_index_seconds', backend='mysql'):
+                        self.execute([self._settings()] + indexes[table])
+                    Utils.log(f"Built the deferred indexes of `{table}`.")
+                METRICS.increment('tables_restored_total', backend='mysql')
+                with self._lock:
+                    self.stats['tables'] += 1
+
+            # Largest chunks first, so the longest loads overlap with everything else
+            chunks = sorted(((table, entry) for table, entries in metadata['tables'].items() for entry in entries),
+                            key=lambda item: item[1].get('bytes') or 0, reverse=True)
+            for table, entry in chunks:
+                self._submit(executor, futures, entry['file'], loadChunk, table, entry)
+            for table, entries in metadata['tables'].items():
+                if not entries:
+                    self._submit(executor, futures, table, finishTable, table)
+
+        if self.stats['failed']:
+            raise RestoreError(f"{len(self.stats['failed'])} file(s) could not be restored: {', '.join(self.stats['failed'])}")
+
+        # Triggers, routines and events come last, so no trigger fires for the restored rows
+        if metadata.get('objects'):
+            self.execute([self._settings(), pathlib.Path(directory, metadata['objects'])])
+
+    def restore(self, source, kind=None):
+        """
+            Restore a dump into target_db, creating the database if needed. Returns True on success.
+
+            kind is 'file', 'parallel' or 'chunk_store'; by default it is inferred from source.
+        """
+
+        if kind is None:
+            kind = 'parallel' if os.path.isdir(source) else \
+                'chunk_store' if self.database.chunk_store and os.path.abspath(source).startswith(
+                    os.path.abspath(os.path.join(self.database.chunk_store, 'manifests'))) else 'file'
+
+        error_message = None
+        self.stats = {'tables': 0, 'files': 0, 'bytes': 0, 'failed': []}
+        start_time = time.monotonic()
+
+        try:
+            Utils.log(f"Restoring {source} into '{self.target_db}' on {self.database.host} with {self.workers} workers...")
+            self._createDatabase()
+
+            with METRICS.timer('restore_seconds', backend='mysql'):
+                if kind == 'parallel':
+                    self._restoreParallel(source)
+                elif kind == 'chunk_store':
+                    with ChunkStore(self.database.chunk_store, cipher=self.database.cipher) as store:
+                        self._restoreStream(io.BufferedReader(_IterReader(store.read(source)), self.chunk_size))
+                else:
+                    with openCompressed(source, cipher=self.database.cipher) as stream:
+                        # Lines are read one at a time, so zstd readers get a buffer in front of them
+                        self._restoreStream(stream if isinstance(stream, io.BufferedReader) else
+                                            io.BufferedReader(stream, self.chunk_size))
+
+        except KeyboardInterrupt:
+            error_message = "Restore interrupted by user."
+        except Exception as e:
+            error_message = f"Restoring {source} failed: {e}"
+        finally:
+            seconds = time.monotonic() - start_time
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                Utils.log(f"Restored {self.stats['tables']} table(s), {self.stats['bytes']} bytes of SQL into "
+                          f"'{self.target_db}' in {seconds:.1f}s ({self.stats['bytes'] / max(seconds, 1e-6) / (1024 * 1024):.2f} MB/s).")
+            PROGRESS.summary()
+
+        return error_message is None
+
+
+class ArchiveRestorer:
+    """
+        Extract site archives (tar, tar.gz, tar.zst, as files or chunk store manifests) with
+        GNU tar, several at once.
+
+        Each extraction is a pipeline: archive bytes are read here (straight out of the chunk
+        store for manifests, with no temporary copy), decompressed by pigz / gzip / zstd in
+        tar's child process, and written out by tar, so reading, decompression and file
+        creation overlap. A single compressed stream cannot be split, so independent archives
+        are what run in parallel. Encrypted archives (.enc) are decrypted on the way into tar
+        with `encryption` (a key file path or BackupCipher).
+    """
+
+    def __init__(self, workers=4, chunk_store=None, block_size=1024 * 1024, encryption=None):
+        self.workers = max(1, int(workers))
+        self.chunk_store = chunk_store
+        self.block_size = block_size
+        self.cipher = BackupCipher.fromConfig(encryption)
+
+    @staticmethod
+    def _decompressOption(name):
+        if name.endswith(('.tar.gz', '.tgz')):
+            # pigz decompresses on separate read / write / check threads
+            return ['-I', 'pigz'] if shutil.which('pigz') else ['-z']
+        if name.endswith('.tar.zst'):
+            return ['--zstd']
+        if name.endswith('.tar.xz'):
+            return ['-J']
+        return []
+
+    def extract(self, archive, target_dir, kind='file', tar_options=()):
+        """Extract one archive into target_dir; returns the number of archive bytes read."""
+
+        store = None
+        if kind == 'chunk_store':
+            with open(archive) as f:
+                manifest = json.load(f)
+            name, total = manifest['name'], manifest['size']
+            store = ChunkStore(self.chunk_store, cipher=self.cipher)
+            blocks = store.read(archive)
+        elif archive.endswith(EXTENSION):
+            if self.cipher is None:
+                raise EncryptionError(f"{archive} is encrypted; configure the encryption key to restore it.")
+            name, total = os.path.basename(archive)[:-len(EXTENSION)], plaintextSize(archive)
+            blocks = None
+        else:
+            name, total = os.path.basename(archive), os.path.getsize(archive)
+            blocks = None
+
+        os.makedirs(target_dir, exist_ok=True)
+        command = ['tar', '--extract', '-f', '-', '-C', target_dir] + self._decompressOption(name) + list(tar_options)
+        started = time.monotonic()
+        moved = 0
+
+        try:
+            if blocks is not None:
+                source = contextlib.nullcontext()
+            elif archive.endswith(EXTENSION):
+                source = self.cipher.open(archive, self.block_size)
+            else:
+                source = open(archive, 'rb')
+
+            with source, tempfile.TemporaryFile() as stderr_output, PROGRESS.transfer(name, total) as progress:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr_output)
+                try:
+                    if blocks is None:
+                        blocks = iter(lambda: source.read(self.block_size), b'')
+                    for block in blocks:
+                        process.stdin.write(block)
+                        moved += len(block)
+                        progress.advance(len(block))
+                except BrokenPipeError:
+                    pass
+                finally:
+                    try:
+                        process.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                    process.wait()
+
+                if process.returncode != 0:
+                    stderr_output.seek(0)
+                    raise RestoreError(f"tar failed: {stderr_output.read().decode(errors='replace').strip()}")
+        finally:
+            if store is not None:
+                store.close()
+
+        METRICS.transfer('archive_restore', moved, time.monotonic() - started)
+        return moved
+
+    def plan(self, archives, target_dir):
+        """(archive, target, kind) items for extractAll: archives under the chunk store are manifests, and
+        several archives each get a subdirectory of target_dir named after them."""
+
+        manifests = os.path.abspath(os.path.join(self.chunk_store, 'manifests')) if self.chunk_store else None
+        items = []
+        for archive in archives:
+            kind = 'chunk_store' if manifests and os.path.abspath(archive).startswith(manifests) else 'file'
+            name = os.path.basename(os.path.dirname(archive) if kind == 'chunk_store' else archive).split('.tar')[0]
+            items.append((archive, os.path.join(target_dir, name) if len(archives) > 1 else target_dir, kind))
+        return items
+
+    def extractAll(self, archives):
+        """
+            Extract (archive, target_dir[, kind]) items concurrently. Returns the number that failed.
+        """
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.extract, *item): item[0] for item in archives}
+            for future, archive in futures.items():
+                try:
+                    future.result()
+                    Utils.log(f"Extracted {archive}")
+                except Exception as e:
+                    failed += 1
+                    Utils.log(f"Extracting {archive} failed: {e}", level='error')
+
+        PROGRESS.summary()
+        return failed
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from database_manager import MySQLDatabase
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Restore database dumps and site archives made by website_backup_manager.")
+    parser.add_argument('--key', default=os.getenv('ENCRYPTION_KEY_FILE') or None, help="Key file for encrypted (.enc) backups (default: ENCRYPTION_KEY_FILE)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    database_parser = commands.add_parser('db', help="Load a dump (file, parallel dump directory or chunk store manifest)")
+    database_parser.add_argument('source')
+    database_parser.add_argument('--target-db', help="Database to restore into (default: DB_NAME)")
+    database_parser.add_argument('--workers', type=int, default=int(os.getenv('RESTORE_WORKERS', 4)))
+    database_parser.add_argument('--keep-indexes', action='store_true', help="Create secondary indexes before loading rows")
+    database_parser.add_argument('--skip-binlog', action='store_true', help="Do not write the load to the target's binary log")
+
+    files_parser = commands.add_parser('files', help="Extract site archives")
+    files_parser.add_argument('archives', nargs='+')
+    files_parser.add_argument('--target', required=True, help="Directory to extract into; one subdirectory per archive when several are given")
+    files_parser.add_argument('--workers', type=int, default=int(os.getenv('RESTORE_WORKERS', 4)))
+
+    args = parser.parse_args()
+
+    if args.command == 'db':
+        database = MySQLDatabase(os.getenv('DB_NAME', 'test_db'), os.getenv('DB_USER', 'dbuser'), os.getenv('DB_PASS', 'dbpassword'),
+                                 os.getenv('DB_HOST', 'localhost'), os.getenv('DB_PORT', 3306),
+                                 local_base_path=os.getenv('DB_LOCAL_PATH', '.'), chunk_store=os.getenv('CHUNK_STORE'),
+                                 encryption=args.key)
+        restorer = DatabaseRestorer(database, args.workers, args.target_db, not args.keep_indexes, args.skip_binlog)
+        raise SystemExit(0 if restorer.restore(args.source) else 1)
+
+    restorer = ArchiveRestorer(args.workers, os.getenv('CHUNK_STORE'), encryption=args.key)
+    raise SystemExit(1 if restorer.extractAll(restorer.plan(args.archives, args.target)) else 0)
@@ -0,0 +1,274 @@
+from helpers import Helpers as Utils
+from metrics import METRICS
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SessionManager:
+    """
+        Process-wide cache of authenticated SSH transports and FTPS sessions, keyed by
+        (protocol, host, port, user).
+
+        An SSH transport is shared: any number of SSH managers can hold it at once, each
+        opening its own exec or SFTP channels on it. An FTPS control connection carries one
+        command at a time, so FTPS sessions are checked out exclusively and handed back
+        afterwards. Sessions that were idle for `check_after` seconds are health-checked
+        (SSH ignore message, FTP NOOP) before they are handed out, and dead ones are
+        replaced with a fresh login. A reaper thread closes sessions idle for longer than
+        `idle_timeout`.
+
+        A session checked out for a long operation can be registered with keepAliveFTP():
+        a single keep-alive thread then sends NOOP on every registered session that has
+        been idle for its interval, instead of one thread per connection. Commands on a
+        registered session go through holding(), so a NOOP never interleaves with them.
+
+        With enabled=False every acquire opens a new session and every release closes it,
+        which is the behaviour of the managers before sessions were reused.
+    """
+
+    def __init__(self, idle_timeout=300, check_after=15, enabled=True):
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._ssh = {}   # key -> {'client', 'users', 'last_used'}
+        self._ftp = {}   # key -> [(session, last_used)] of idle sessions
+        self._reaper = None
+        self._kept = {}  # id(session) -> {'session', 'lock', 'interval', 'last_used'} of FTP sessions kept alive
+        self._keeper = None
+
+    def _startReaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self.__reap, daemon=True)
+            self._reaper.start()
+
+    def __reap(self):
+        while True:
+            time.sleep(max(1, self.idle_timeout / 4))
+            self.expire()
+
+    # SSH
+
+    @staticmethod
+    def _sshAlive(client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def acquireSSH(self, key, factory):
+        """Return a connected paramiko SSHClient for key, shared with other holders."""
+
+        if not self.enabled:
+            return factory()
+
+        with self._lock:
+            entry = self._ssh.get(key)
+            if entry is not None:
+                idle = time.monotonic() - entry['last_used']
+                transport = entry['client'].get_transport()
+                alive = transport is not None and transport.is_active() and \
+                    (entry['users'] or idle < self.check_after or self._sshAlive(entry['client']))
+                if alive:
+                    entry['users'] += 1
+                    entry['last_used'] = time.monotonic()
+                    METRICS.increment('sessions_reused_total', protocol='ssh')
+                    Utils.log(f"Reusing SSH session to {key[1]}.")
+                    return entry['client']
+
+                Utils.log(f"SSH session to {key[1]} is no longer alive; reconnecting.", level='warning')
+                del self._ssh[key]
+                self._close(entry['client'])
+
+        client = factory()
+        METRICS.increment('sessions_opened_total', protocol='ssh')
+
+        with self._lock:
+            if key in self._ssh:
+                # Another thread connected at the same time; keep the first one
+                entry = self._ssh[key]
+                entry['users'] += 1
+                self._close(client)
+                return entry['client']
+            self._ssh[key] = {'client': client, 'users': 1, 'last_used': time.monotonic()}
+            self._startReaper()
+        return client
+
+    def releaseSSH(self, key, client, discard=False):
+        """Stop holding an SSH client; the transport stays open for reuse unless discard is set."""
+
+        if not self.enabled:
+            self._close(client)
+            return
+
+        with self._lock:
+            entry = self._ssh.get(key)
+            if entry is None or entry['client'] is not client:
+                self._close(client)
+                return
+            entry['users'] = max(0, entry['users'] - 1)
+            entry['last_used'] = time.monotonic()
+            if discard:
+                # Other holders keep their reference; the next acquire opens a new transport
+                del self._ssh[key]
+                if not entry['users']:
+                    self._close(client)
+
+    # FTP
+
+    def acquireFTP(self, key, factory):
+        """Check out an authenticated FTPS session for key, opening one if none is idle."""
+
+        if not self.enabled:
+            return factory()
+
+        while True:
+            with self._lock:
+                idle = self._ftp.get(key)
+                if not idle:
+                    break
+                session, last_used = idle.pop()
+
+            if time.monotonic() - last_used < self.check_after:
+                METRICS.increment('sessions_reused_total', protocol='ftp')
+                return session
+            try:
+                session.voidcmd("NOOP")
+                METRICS.increment('sessions_reused_total', protocol='ftp')
+                return session
+            except Exception:
+                Utils.log(f"Dropping a dead FTP session to {key[1]}.", level='warning')
+                self._close(session)
+
+        session = factory()
+        METRICS.increment('sessions_opened_total', protocol='ftp')
+        with self._lock:
+            self._startReaper()
+        return session
+
+    def releaseFTP(self, key, session, discard=False):
+        """Hand an FTPS session back for reuse, or close it when discard is set or reuse is disabled."""
+
+        self.unregisterFTP(session)
+        if discard or not self.enabled:
+            self._close(session, quit=not discard)
+            return
+
+        with self._lock:
+            self._ftp.setdefault(key, []).append((session, time.monotonic()))
+
+    def keepAliveFTP(self, session, interval=60):
+        """Send NOOP on a checked-out session whenever it has been idle for `interval` seconds, until it is released."""
+
+        with self._lock:
+            self._kept[id(session)] = {'session': session, 'lock': threading.RLock(), 'interval': interval,
+                                       'last_used': time.monotonic()}
+            if self._keeper is None:
+                self._keeper = threading.Thread(target=self.__keepAlive, daemon=True)
+                self._keeper.start()
+
+    def unregisterFTP(self, session):
+        with self._lock:
+            entry = self._kept.pop(id(session), None)
+        if entry is not None:
+            # Wait for a NOOP that is still on the wire
+            with entry['lock']:
+                pass
+
+    @contextmanager
+    def holding(self, session):
+        """Use a session kept alive by keepAliveFTP() without the keep-alive thread sending NOOP in between."""
+
+        with self._lock:
+            entry = self._kept.get(id(session))
+        if entry is None:
+            yield session
+            return
+
+        with entry['lock']:
+            try:
+                yield session
+            finally:
+                entry['last_used'] = time.monotonic()
+
+    def __keepAlive(self):
+        while True:
+            with self._lock:
+                entries = list(self._kept.values())
+            time.sleep(max(1, min([entry['interval'] for entry in entries], default=60) / 4))
+
+            for entry in entries:
+                if time.monotonic() - entry['last_used'] < entry['interval']:
+                    continue
+                # A session in use is alive anyway
+                if not entry['lock'].acquire(blocking=False):
+                    continue
+                try:
+                    with self._lock:
+                        if self._kept.get(id(entry['session'])) is not entry:
+                            continue
+                    entry['session'].voidcmd("NOOP")
+                    entry['last_used'] = time.monotonic()
+                except Exception as e:
+                    # The next command on it fails and the owner reconnects
+                    Utils.log(f"Keep-alive NOOP failed: {e}", level='warning')
+                    with self._lock:
+                        self._kept.pop(id(entry['session']), None)
+                finally:
+                    entry['lock'].release()
+
+    # Housekeeping
+
+    @staticmethod
+    def _close(session, quit=False):
+        try:
+            if quit and hasattr(session, 'quit'):
+                session.quit()
+            else:
+                session.close()
+        except Exception:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def expire(self):
+        """Close sessions that have been idle for longer than idle_timeout."""
+
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for key, entry in list(self._ssh.items()):
+                if not entry['users'] and now - entry['last_used'] > self.idle_timeout:
+                    expired.append((entry['client'], False))
+                    del self._ssh[key]
+            for key, idle in list(self._ftp.items()):
+                expired += [(session, True) for session, last_used in idle if now - last_used > self.idle_timeout]
+                self._ftp[key] = [(session, last_used) for session, last_used in idle if now - last_used <= self.idle_timeout]
+
+        for session, quit in expired:
+            self._close(session, quit)
+        return len(expired)
+
+    def closeAll(self):
+        """Close every cached session."""
+
+        with self._lock:
+            sessions = [(entry['client'], False) for entry in self._ssh.values()]
+            sessions += [(session, True) for idle in self._ftp.values() for session, _ in idle]
+            self._ssh = {}
+            self._ftp = {}
+
+        for session, quit in sessions:
+            self._close(session, quit)
+
+
+# Shared cache the SSH and FTP managers take their sessions from
+SESSIONS = SessionManager()
+atexit.register(SESSIONS.closeAll)
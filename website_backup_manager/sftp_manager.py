@@ -0,0 +1,278 @@
+import paramiko
+import os
+import posixpath
+import queue
+import stat
+import threading
+import time
+
+from helpers import Helpers as Utils
+from ssh_manager import SSH, SSHConnectionError
+from ftp_manager import FTPEntry, FTPConnectionPool
+from chunk_store import ChunkStore
+from checksums import writeSidecar
+from metrics import METRICS
+from progress import PROGRESS
+from encryption import storedPath
+from backup_writer import BackupFileWriter
+
+
+class SFTP(SSH):
+    """
+        SFTP downloader over the SSH session of ssh_manager.SSH, for hosts with slow or no FTP.
+
+        Reads are pipelined: each file is prefetched with up to `prefetch_requests` READ
+        requests in flight, so a high-latency link stays full instead of waiting one round
+        trip per 32 KB block. Every worker gets its own SFTP channel with a large window on
+        the shared transport. download() behaves like FTP.download: same local layout,
+        size checks, digests recorded in a sidecar, encryption and the on_done callback.
+    """
+
+    WINDOW_SIZE = 64 * 1024 * 1024
+    MAX_PACKET_SIZE = 32 * 1024
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, host, user, password, local_base_url, host_base_url, port=22, workers=4, chunk_store=None,
+                 checksum='sha256', prefetch_requests=128, nice=None, ionice=None, encryption=None):
+        super().__init__(host, user, password, local_base_url, host_base_url, port, chunk_store, checksum, nice, ionice,
+                         encryption)
+        self.workers = max(1, int(workers))
+        self.prefetch_requests = max(1, int(prefetch_requests))
+        self.sftp = None
+        self.digests = {}
+        self._digests_lock = threading.Lock()
+        self._store = None
+
+    @property
+    def local_base_path(self):
+        # Same attribute name as FTP, so the two downloaders are interchangeable
+        return self.local_base_url
+
+    @property
+    def host_base_path(self):
+        return self.host_base_url
+
+    def _openSession(self):
+        """Open a new SFTP channel with a large window on the shared SSH transport."""
+        return paramiko.SFTPClient.from_transport(self.ssh.get_transport(), window_size=self.WINDOW_SIZE,
+                                                  max_packet_size=self.MAX_PACKET_SIZE)
+
+    def connect(self):
+        super().connect()
+        if self.sftp is None:
+            self.ssh.get_transport().set_keepalive(60)
+            self.sftp = self._openSession()
+
+    def disconnect(self, discard=False):
+        if self.sftp is not None:
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+            self.sftp = None
+        super().disconnect(discard)
+
+    @staticmethod
+    def _entry(attributes):
+        """Convert SFTPAttributes into an FTPEntry."""
+        mode = attributes.st_mode or 0
+        if stat.S_ISDIR(mode):
+            kind = 'dir'
+        elif stat.S_ISLNK(mode):
+            kind = 'link'
+        else:
+            kind = 'file'
+        return FTPEntry(attributes.filename, kind, attributes.st_size if kind == 'file' else None, attributes.st_mtime)
+
+    def listDir(self, remote_dir, sftp=None):
+        """List a remote directory with its sizes and modification times in one READDIR pass."""
+
+        sftp = sftp or self.sftp
+        with METRICS.timer('list_seconds', backend='sftp'):
+            return [self._entry(attributes) for attributes in sftp.listdir_attr(remote_dir)]
+
+    def stat(self, remote_path, sftp=None):
+        """Return the FTPEntry for a single remote path, following symlinks, or None if absent."""
+
+        sftp = sftp or self.sftp
+        try:
+            attributes = sftp.stat(remote_path)
+        except FileNotFoundError:
+            return None
+        attributes.filename = posixpath.basename(remote_path.rstrip('/'))
+        return self._entry(attributes)
+
+    def walk(self, remote_dir, local_dir):
+        """Recursively yield (remote_path, local_path, entry) for every file under remote_dir."""
+
+        for entry in self.listDir(remote_dir):
+            remote_path = posixpath.join(remote_dir, entry.name)
+            local_path = os.path.join(local_dir, entry.name)
+
+            if entry.type == 'link':
+                # READDIR reports the link itself; resolve it to find out what it points at
+                target = self.stat(remote_path)
+                if target is None:
+                    Utils.log(f"Skipping dangling symlink {remote_path}", level='warning')
+                    continue
+                entry = target._replace(name=entry.name)
+
+            if entry.type == 'dir':
+                yield from self.walk(remote_path, local_path)
+            else:
+                yield remote_path, local_path, entry
+
+    def __downloadWithPrefetch(self, sftp, remote_file, output_file_path, total_size=None):
+        """Download one file with pipelined reads, hashing it as the data arrives (and encrypting it, if configured)."""
+
+        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+        started = time.perf_counter()
+
+        with sftp.open(remote_file, 'rb', bufsize=self.BLOCK_SIZE) as remote:
+            if total_size is None:
+                total_size = remote.stat().st_size
+            remote.prefetch(total_size, max_concurrent_requests=self.prefetch_requests)
+
+            with BackupFileWriter(output_file_path, self.checksum, self.cipher, host=self.host, total=total_size,
+                                  name=os.path.basename(remote_file), buffering=self.BLOCK_SIZE) as writer:
+                while True:
+                    data = remote.read(self.BLOCK_SIZE)
+                    if not data:
+                        break
+                    writer.write(data)
+
+        if writer.received != total_size:
+            METRICS.increment('verify_failures_total', backend='sftp')
+            raise ValueError(f"Size mismatch: {remote_file} (expected {total_size}, got {writer.received})")
+
+        if writer.hexdigest() is not None:
+            with self._digests_lock:
+                self.digests[output_file_path] = writer.hexdigest()
+
+        METRICS.transfer('sftp', writer.received, time.perf_counter() - started)
+
+    def __addToChunkStore(self, local_path):
+        """Add a verified download to the chunk store, if one is configured for this run."""
+        if self._store is not None:
+            # Chunked from the plaintext under the plain name, like streamed archives and dumps
+            name = os.path.relpath(local_path, self.local_base_path).replace(os.sep, '/')
+            self._store.ingestFile(name, storedPath(local_path, self.cipher))
+
+    def __downloadPooled(self, pool, remote_path, local_path, max_retries=3, size=None):
+        """Download one file on a pooled SFTP channel, retrying on a fresh channel if needed."""
+
+        def attempt():
+            with pool.session() as sftp:
+                self.__downloadWithPrefetch(sftp, remote_path, local_path, size)
+
+        Utils.retry(attempt, retries=max_retries, name='sftp_download')
+        self.__addToChunkStore(local_path)
+
+    def downloadDir(self, remote_dir, local_dir, max_retries=3, files=None, on_done=None, on_start=None):
+        """
+            Download a directory tree with `workers` SFTP channels fed by the directory walk.
+
+            Returns the number of files that failed; arguments are the same as FTP.downloadDir.
+        """
+
+        if files is None:
+            files = self.walk(remote_dir, local_dir)
+
+        pool = FTPConnectionPool(self._openSession, self.workers)
+        tasks = queue.Queue(maxsize=self.workers * 64)
+        lock = threading.Lock()
+        stats = {'queued': 0, 'done': 0, 'failed': 0}
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+
+                remote_path, local_path, entry = task
+                try:
+                    if on_start:
+                        on_start(remote_path, local_path, entry)
+                    self.__downloadPooled(pool, remote_path, local_path, max_retries, entry.size)
+                    failed = False
+                    if on_done:
+                        on_done(remote_path, local_path, entry)
+                except Exception as e:
+                    METRICS.increment('failures_total', backend='sftp')
+                    Utils.log(f"Unable to download File {remote_path}: {e}",level='error')
+                    failed = True
+
+                with lock:
+                    stats['done'] += 1
+                    stats['failed'] += failed
+
+        Utils.log(f"Downloading {remote_dir} with {self.workers} parallel SFTP channels...")
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for remote_path, local_path, entry in files:
+                with lock:
+                    stats['queued'] += 1
+                tasks.put((remote_path, local_path, entry))
+        finally:
+            for _ in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+            pool.close()
+
+        Utils.log(f"Downloaded {stats['done'] - stats['failed']} of {stats['queued']} files from {remote_dir} ({stats['failed']} failed).")
+
+        return stats['failed']
+
+    def download(self, remote_dir_name, on_done=None, on_start=None):
+        """
+            Download a remote file or directory into local_base_url. Returns True when every file was downloaded.
+
+            on_done and on_start are called with (remote_path, local_path, entry), as in FTP.download.
+        """
+
+        local_path = os.path.join(self.local_base_path, os.path.basename(remote_dir_name))
+        remote_path = posixpath.join(self.host_base_url, remote_dir_name)
+        error_message = None
+
+        try:
+            self.connect()
+            self._store = ChunkStore(self.chunk_store, cipher=self.cipher) if self.chunk_store else None
+            self.digests = {}
+            entry = self.stat(remote_path)
+            if entry is None:
+                raise FileNotFoundError(f"{remote_path} does not exist on SFTP host {self.host}")
+
+            # A single file goes through the same pooled, retried path as a directory with one entry
+            files = None if entry.type == 'dir' else [(remote_path, local_path, entry)]
+            failed = self.downloadDir(remote_path, local_path, files=files, on_done=on_done, on_start=on_start)
+
+            if failed:
+                error_message = f"{failed} file(s) under {remote_path} could not be downloaded from SFTP host {self.host}."
+            elif self.digests:
+                sidecar = writeSidecar(local_path, self.digests, self.checksum)
+                Utils.log(f"Recorded {len(self.digests)} {self.checksum} digest(s) in {sidecar}")
+
+        except KeyboardInterrupt:
+            error_message = f"Downloading {remote_path} from SFTP host {self.host} was interrupted by user."
+        except SSHConnectionError as e:
+            error_message = str(e)
+        except Exception as e:
+            error_message = f"Unexpected error while downloading {remote_path} from SFTP host {self.host} :\n\n{e}\n"
+        finally:
+            if error_message is not None:
+                Utils.log(error_message,level='error')
+            else:
+                Utils.log(f"Downloading {remote_path} from SFTP host {self.host} completed successfully.")
+
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+            self.disconnect()
+            PROGRESS.summary()
+
+        return error_message is None
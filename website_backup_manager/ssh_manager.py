@@ -1,105 +1,466 @@
 import paramiko
 import os
+import posixpath
+import select
+import shlex
+import time
 
 from helpers import Helpers as Utils
+from checksums import CHECKSUM_TOOLS, writeSidecar
+from backup_writer import BackupFileWriter
+from stream_compressor import ParallelCompressor
+from chunk_store import ChunkStore
+from metrics import METRICS
+from throttle import prioritizeShell
+from progress import PROGRESS
+from session_manager import SESSIONS
+from encryption import BackupCipher
 
 class SSHConnectionError(Exception):
     """Custom exception for SSH connection errors."""
     pass
 
+class SSHCommandTimeout(SSHConnectionError):
+    """Raised when a remote command runs longer than its timeout."""
+
+
+class RemoteCommand:
+    """
+        A command running on an SSH channel, read incrementally while it runs.
+
+        Output is consumed in chunks of at most `chunk_size` bytes from a channel whose
+        window is `window_size`, so neither side ever holds more than that: a command that
+        writes faster than it is read simply waits on the window. stdout and stderr are
+        drained together, so a chatty stderr cannot stall stdout. The last `tail_size`
+        bytes of stderr are always kept for error messages.
+
+        Use it as a context manager, so the channel is closed even if iteration stops early:
+
+            with ssh.exec_stream("find /var/www -type f") as process:
+                for line in process.lines():
+                    ...
+            process.exit_status
+    """
+
+    def __init__(self, channel, command, timeout=None, chunk_size=64 * 1024, tail_size=64 * 1024, max_line=1024 * 1024):
+        self.channel = channel
+        self.command = command
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.tail_size = tail_size
+        self.max_line = max_line
+        self.exit_status = None
+        self._stderr_tail = bytearray()
+        self._deadline = time.monotonic() + timeout if timeout else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.channel.close()
+
+    @property
+    def stderr(self):
+        """The last tail_size bytes of stderr, decoded."""
+        return self._stderr_tail.decode(errors='replace')
+
+    def _remaining(self):
+        """Seconds left before the timeout, or None without one; raises SSHCommandTimeout once it has passed."""
+        if self._deadline is None:
+            return None
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            self.close()
+            raise SSHCommandTimeout(f"Remote command timed out after {self.timeout}s: {self.command}")
+        return remaining
+
+    def _waitReady(self):
+        remaining = self._remaining()
+        wait = 0.1 if remaining is None else min(0.1, remaining)
+        # The channel is only selectable for stdout, so stderr is polled at this interval
+        select.select([self.channel], [], [], wait)
+
+    def chunks(self):
+        """Yield ('stdout' | 'stderr', bytes) as the command writes them; sets exit_status at the end."""
+
+        channel = self.channel
+        while True:
+            # Checked on every chunk too, since a command that never stops writing never waits
+            self._remaining()
+            if channel.recv_ready():
+                data = channel.recv(self.chunk_size)
+                if data:
+                    yield 'stdout', data
+                    continue
+            if channel.recv_stderr_ready():
+                data = channel.recv_stderr(self.chunk_size)
+                if data:
+                    self._stderr_tail += data
+                    del self._stderr_tail[:-self.tail_size]
+                    yield 'stderr', data
+                    continue
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            self._waitReady()
+
+        self.exit_status = channel.recv_exit_status()
+
+    def lines(self, stream='stdout', encoding='utf-8'):
+        """Yield the lines of one stream as text; the other stream is drained and only its tail is kept."""
+
+        pending = b''
+        for name, data in self.chunks():
+            if name != stream:
+                continue
+            pending += data
+            *complete, pending = pending.split(b'\n')
+            for line in complete:
+                yield line.decode(encoding, errors='replace')
+            if len(pending) > self.max_line:
+                # A line without an end would otherwise grow without bound
+                yield pending.decode(encoding, errors='replace')
+                pending = b''
+        if pending:
+            yield pending.decode(encoding, errors='replace')
+
+    def wait(self):
+        """Drain the remaining output and return the exit status."""
+        for _ in self.chunks():
+            pass
+        return self.exit_status
+
 class SSH:
-    def __init__(self, host, user, password, local_base_url, host_base_url, port=22):
+
+    STREAM_WINDOW_SIZE = 16 * 1024 * 1024
+    STREAM_CHUNK_SIZE = 1024 * 1024
+    MISSING_DIRECTORY_STATUS = 66  # Exit status of _guardDirectory when the directory does not exist
+    MAX_LOGGED_WARNINGS = 50
+
+    def __init__(self, host, user, password, local_base_url, host_base_url, port=22, chunk_store=None, checksum='sha256',
+                 nice=None, ionice=None, encryption=None):
         self.host = host
         self.user = user
         self.password = password
         self.port = port
         self.local_base_url = local_base_url
         self.host_base_url = host_base_url
+        self.chunk_store = chunk_store  # Optional ChunkStore root for deduplicated streamed archives
+        self.checksum = checksum or 'sha256'
+        # Optional key file or BackupCipher; streamed archives are then written as <archive>.enc
+        self.cipher = BackupCipher.fromConfig(encryption)
+        # Optional CPU / IO priority of tar on the server, so archiving does not starve the live site
+        self.nice = nice
+        self.ionice = ionice
         self.ssh = None
         self.connected = False
 
+    @property
+    def _sessionKey(self):
+        return ('ssh', self.host, int(self.port), self.user)
+
+    def __openClient(self):
+        Utils.log("Establishing SSH connection...")
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        with METRICS.timer('connect_seconds', backend='ssh'):
+            client.connect(self.host, username=self.user, password=self.password, port=self.port)
+        Utils.log("SSH connection established.")
+        return client
+
     def connect(self):
-        """Establish an SSH connection to the server."""
+        """Take an SSH connection to the server, reusing a live transport from SESSIONS when there is one."""
         if self.connected:
             Utils.log("Already connected to the server.")
             return
 
         try:
-            Utils.log("Establishing SSH connection...")
-            self.ssh = paramiko.SSHClient()
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh.connect(self.host, username=self.user, password=self.password, port=self.port)
+            self.ssh = SESSIONS.acquireSSH(self._sessionKey, self.__openClient)
             self.connected = True
-            Utils.log("SSH connection established.")
         except Exception as e:
             Utils.log(f"Error establishing SSH connection: {e}",level='error')
             raise SSHConnectionError(f"Failed to connect to {self.host}")
 
-    def disconnect(self):
-        """Close the SSH connection."""
+    def disconnect(self, discard=False):
+        """Release the SSH connection; SESSIONS keeps the transport open for the next operation."""
         if not self.connected:
             Utils.log("No active SSH connection to close.")
             return
 
         try:
-            Utils.log("Closing SSH connection...")
             if self.ssh:
-                self.ssh.close()
+                SESSIONS.releaseSSH(self._sessionKey, self.ssh, discard)
+            self.ssh = None
             self.connected = False
-            Utils.log("SSH connection closed.")
+            Utils.log("SSH connection released.")
         except Exception as e:
             Utils.log(f"Error closing connection: {e}",level='error')
 
-    def _execute_command(self, command):
-        """Execute a command on the remote server and return the output."""
+    def exec_stream(self, command, timeout=None, window_size=2 * 1024 * 1024, chunk_size=64 * 1024):
+        """Start a command and return a RemoteCommand to read its output incrementally."""
         if not self.connected:
             raise SSHConnectionError("Not connected to the server.")
 
-        stdin, stdout, stderr = self.ssh.exec_command(command)
-        exit_status = stdout.channel.recv_exit_status()
-        output = stdout.read().decode()
-        error = stderr.read().decode()
-        return exit_status, output, error
+        try:
+            channel = self.ssh.get_transport().open_session(window_size=window_size)
+        except (paramiko.SSHException, EOFError, OSError, AttributeError) as e:
+            # The shared transport died since the last health check; reconnect once and run the command again
+            Utils.log(f"SSH session to {self.host} failed ({e}); reconnecting.", level='warning')
+            self.disconnect(discard=True)
+            self.connect()
+            channel = self.ssh.get_transport().open_session(window_size=window_size)
 
-    def create_remote_archive(self, remote_dir_path, archive_name):
+        channel.exec_command(command)
+        return RemoteCommand(channel, command, timeout, chunk_size)
+
+    def _execute_command(self, command, timeout=None):
+        """Execute a command on the remote server and return (exit status, stdout, stderr) for small outputs."""
+
+        output, error = [], []
+        with self.exec_stream(command, timeout) as process:
+            for name, data in process.chunks():
+                (output if name == 'stdout' else error).append(data)
+        return process.exit_status, b''.join(output).decode(), b''.join(error).decode()
+
+    @staticmethod
+    def _snapshotOption(snapshot):
+        """GNU tar option for an incremental archive against the snapshot file, or '' for a plain one."""
+        return f' --listed-incremental={shlex.quote(snapshot)}' if snapshot else ''
+
+    def create_remote_archive(self, remote_dir_path, archive_name, snapshot=None):
         """
         Create a tar.gz archive of the specified remote directory.
         :param remote_dir_path: Directory to be archived.
         :param archive_name: Name of the output archive file.
+        :param snapshot: Optional remote tar snapshot file; only files changed since it was written are archived.
         """
 
-        self._validate_remote_directory(remote_dir_path)
-        
         archive_path = os.path.join(self.host_base_url, f"{archive_name}.tar.gz")
-        command = f'tar -czf {archive_path} -C {remote_dir_path} . --ignore-failed-read --warning=no-file-changed'
+        command = prioritizeShell(f'tar -czf {archive_path}{self._snapshotOption(snapshot)} -C {remote_dir_path} . '
+                                  f'--ignore-failed-read --warning=no-file-changed', self.nice, self.ionice)
         Utils.log(f"Creating archive: {archive_path}...")
 
-        exit_status, _, error = self._execute_command(command)
+        warnings = 0
+        with METRICS.timer('archive_seconds', backend='ssh'), \
+                self.exec_stream(self._guardDirectory(remote_dir_path, command)) as process:
+            # tar warnings are logged as they arrive instead of being collected for the whole run
+            for line in process.lines('stderr'):
+                warnings += 1
+                if warnings <= self.MAX_LOGGED_WARNINGS:
+                    Utils.log(f"Archive warning: {line}", level='warning')
+        exit_status, error = process.exit_status, process.stderr
+
+        if warnings > self.MAX_LOGGED_WARNINGS:
+            Utils.log(f"tar reported {warnings} warnings in total; only the first {self.MAX_LOGGED_WARNINGS} were logged.", level='warning')
+
+        if exit_status == self.MISSING_DIRECTORY_STATUS:
+            raise FileNotFoundError(f"{error.strip()} or SSH may be inactive on server.")
 
         if exit_status == 0:
             Utils.log(f"Archive {archive_name}.tar.gz created successfully at {archive_path}.")
         else:
             Utils.log(f"Error creating archive: {error}",level='error')
 
-    def _validate_remote_directory(self, remote_dir_path):
-        """Ensure the specified remote directory exists."""
-        command = f'ls {remote_dir_path}'
-        exit_status, _, error = self._execute_command(command)
-        if exit_status != 0:
-            raise FileNotFoundError(f"{error} or SSH may be inactive on server.")
+        return exit_status == 0
+
+    def _guardDirectory(self, remote_dir_path, command):
+        """Prefix command with a check that remote_dir_path exists, so validating it costs no extra round trip."""
+        message = shlex.quote(f"{remote_dir_path}: No such directory")
+        return f"test -d {shlex.quote(remote_dir_path)} || {{ echo {message} >&2; exit {self.MISSING_DIRECTORY_STATUS}; }}; {command}"
        
 
     def make_archive(self, remote_dir_name, archive_name = None):
-        """Public method to create a remote archive with connection management."""
+        """Public method to create a remote archive with connection management. Returns True on success."""
+        try:
+            self.connect()
+            remote_path = os.path.join(self.host_base_url, remote_dir_name)
+            if archive_name is None:
+                archive_name = remote_dir_name.lower()
+            return self.create_remote_archive(remote_path, archive_name)
+        except KeyboardInterrupt:
+            Utils.log("Process interrupted by user.",level='error')
+        except Exception as e:
+            Utils.log(f"An error occurred: {e}",level='error')
+        finally:
+            self.disconnect()
+
+        return False
+
+    def stream_remote_archive(self, remote_dir_path, archive_name, local_compression=None, snapshot=None, output_dir=None):
+        """
+        Stream a tar archive of the remote directory straight into a local file.
+
+        tar writes to stdout, so nothing is staged on the server's disk and no separate FTP
+        download is needed. The stream is hashed as it is written locally and the digest is
+        recorded in a sidecar file next to the archive. With encryption configured, the archive
+        is sealed on its way to <archive>.enc; the digest stays that of the unencrypted archive,
+        so it can still be compared with the server. Chunk store contents are not encrypted.
+
+        :param remote_dir_path: Directory to be archived.
+        :param archive_name: Name of the local archive file, without extension.
+        :param local_compression: None to let the server gzip the stream (tar -z), or 'gzip' / 'zstd'
+                                  to receive a plain tar and compress it locally on several cores.
+        :param snapshot: Optional remote tar snapshot file for an incremental archive, as in create_remote_archive.
+        :param output_dir: Local directory for the archive, local_base_url by default.
+        :return: (local_path, hex digest, bytes written); the path is the file on disk (.enc when encrypted),
+                 or the manifest with a chunk store.
+        """
+
+        store = ChunkStore(self.chunk_store, cipher=self.cipher) if self.chunk_store else None
+
+        if store is not None:
+            # A compressed stream would change entirely between runs and defeat deduplication
+            tar_flags, extension = '-cf', '.tar'
+        elif local_compression:
+            tar_flags, extension = '-cf', '.tar' + ParallelCompressor.extension(local_compression)
+        else:
+            tar_flags, extension = '-czf', '.tar.gz'
+
+        output_dir = output_dir or self.local_base_url
+        local_path = os.path.join(output_dir, f"{archive_name}{extension}")
+        Utils._makeDirs(output_dir)
+
+        command = prioritizeShell(f'tar {tar_flags} -{self._snapshotOption(snapshot)} -C {shlex.quote(remote_dir_path)} . '
+                                  f'--ignore-failed-read --warning=no-file-changed', self.nice, self.ionice)
+        Utils.log(f"Streaming archive of {remote_dir_path} to {local_path}...")
+
+        process = self.exec_stream(self._guardDirectory(remote_dir_path, command), window_size=self.STREAM_WINDOW_SIZE,
+                                   chunk_size=self.STREAM_CHUNK_SIZE)
+
+        started = time.monotonic()
+
+        # A chunk store seals each chunk itself; sealing the stream would make every run's chunks unique
+        writer = BackupFileWriter(local_path, self.checksum, self.cipher if store is None else None,
+                                  local_compression if store is None else None, host=self.host,
+                                  sink=store.writer(f"{archive_name}{extension}") if store is not None else None,
+                                  buffering=self.STREAM_CHUNK_SIZE)
+        try:
+            with writer:
+                try:
+                    for name, data in process.chunks():
+                        if name != 'stdout':
+                            continue
+                        # Not reading (while throttled) lets the channel window fill, which pauses tar on the server
+                        writer.write(data)
+
+                    # Fail inside the with block so a broken stream never gets a chunk store manifest
+                    exit_status = process.exit_status
+                    if exit_status == self.MISSING_DIRECTORY_STATUS:
+                        raise FileNotFoundError(f"{process.stderr.strip()} or SSH may be inactive on server.")
+                    if exit_status not in (0, 1):
+                        raise RuntimeError(f"Error streaming archive: {process.stderr}")
+                finally:
+                    process.close()
+        finally:
+            if store is not None:
+                store.close()
+
+        # GNU tar exits with 1 when files changed while being read; the archive is still usable
+        if exit_status == 1:
+            Utils.log(f"tar reported changed files while archiving {remote_dir_path}: {process.stderr}", level='warning')
+
+        if store is not None:
+            local_path = writer.sink.manifest_path
+        else:
+            writeSidecar(local_path, {local_path: writer.hexdigest()}, self.checksum)
+            local_path = writer.stored_path
+
+        METRICS.transfer('ssh', writer.received, time.monotonic() - started)
+
+        Utils.log(f"Archive {os.path.basename(local_path)} streamed successfully: {writer.bytes_written} bytes in "
+                  f"{time.monotonic() - started:.1f}s, {self.checksum} {writer.hexdigest()}.")
+
+        return local_path, writer.hexdigest(), writer.bytes_written
+
+    def stream_archive(self, remote_dir_name, archive_name = None, local_compression=None):
+        """Public method to stream a remote archive to local_base_url with connection management."""
         try:
             self.connect()
             remote_path = os.path.join(self.host_base_url, remote_dir_name)
             if archive_name is None:
                 archive_name = remote_dir_name.lower()
-            self.create_remote_archive(remote_path, archive_name)
+            return self.stream_remote_archive(remote_path, archive_name, local_compression)
         except KeyboardInterrupt:
             Utils.log("Process interrupted by user.",level='error')
         except Exception as e:
             Utils.log(f"An error occurred: {e}",level='error')
         finally:
             self.disconnect()
+            PROGRESS.summary()
+
+        return False
+
+    def remote_checksum(self, remote_path):
+        """Hash a file on the server with sha256sum / b2sum and return the hex digest."""
+
+        tool = CHECKSUM_TOOLS[self.checksum]
+        with METRICS.timer('verify_seconds', backend='ssh'):
+            exit_status, output, error = self._execute_command(f"{tool} {shlex.quote(remote_path)}")
+        if exit_status != 0:
+            raise RuntimeError(f"{tool} failed on {remote_path}: {error}")
+
+        return output.split()[0]
+
+    def remote_checksums(self, remote_dir_path, timeout=None):
+        """
+            Yield (relative path, hex digest) for every file under remote_dir_path, hashed on the server.
+
+            The listing is read line by line while sha256sum / b2sum runs, so memory stays flat
+            however many files the directory holds.
+        """
+
+        tool = CHECKSUM_TOOLS[self.checksum]
+        command = f"cd {shlex.quote(remote_dir_path)} && find . -type f -print0 | xargs -0 -r {tool}"
+        with self.exec_stream(command, timeout) as process:
+            for line in process.lines():
+                digest, _, path = line.partition('  ')
+                if path:
+                    yield posixpath.normpath(path), digest
+        if process.exit_status != 0:
+            raise RuntimeError(f"{tool} listing failed on {remote_dir_path}: {process.stderr}")
+
+    def verify_directory(self, remote_dir_name, local_digests, local_dir):
+        """
+            Compare digests recorded while downloading a directory with the server-side digests.
+
+            local_digests maps local absolute paths to digests, as read from the download's
+            sidecar. Returns the number of files that are missing locally or differ.
+        """
+        mismatches = 0
+        try:
+            self.connect()
+            remote_path = posixpath.join(self.host_base_url, remote_dir_name)
+            with METRICS.timer('verify_seconds', backend='ssh'):
+                for relative_path, remote_digest in self.remote_checksums(remote_path):
+                    local_path = os.path.normpath(os.path.join(os.path.abspath(local_dir), relative_path))
+                    if local_digests.get(local_path) != remote_digest:
+                        mismatches += 1
+                        Utils.log(f"Checksum mismatch for {posixpath.join(remote_path, relative_path)}", level='error')
+        finally:
+            self.disconnect()
+
+        if not mismatches:
+            Utils.log(f"Checksums verified for every file under {remote_dir_name}.")
+        return mismatches
+
+    def verify_checksum(self, remote_file_name, expected_digest):
+        """Compare a local digest with the server-side digest of the same file. Returns True when they match."""
+        try:
+            self.connect()
+            remote_path = os.path.join(self.host_base_url, remote_file_name)
+            remote_digest = self.remote_checksum(remote_path)
+
+            if remote_digest != expected_digest:
+                Utils.log(f"Checksum mismatch for {remote_path}: local {expected_digest}, remote {remote_digest}",level='error')
+                return False
+
+            Utils.log(f"Checksum verified for {remote_path}: {remote_digest}")
+            return True
+        except Exception as e:
+            Utils.log(f"An error occurred: {e}",level='error')
+        finally:
+            self.disconnect()
+
+        return False
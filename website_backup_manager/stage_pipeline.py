@@ -0,0 +1,83 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from helpers import Helpers as Utils
+from metrics import METRICS
+
+
+class StagePipeline:
+    """
+        Run named backup stages on a thread pool, starting each one as soon as its dependencies succeed.
+
+        A stage fails when it raises or returns False, and it is skipped when it returns None
+        (nothing configured for it). Stages whose dependencies failed are not run; everything
+        else carries on, so one failing stage never blocks unrelated work.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.stages = {}
+
+    def add(self, name, operation, depends=()):
+        for dependency in depends:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = (operation, tuple(depends))
+
+    @staticmethod
+    def _timed(operation):
+        started = time.monotonic()
+        try:
+            return operation(), None, time.monotonic() - started
+        except Exception as e:
+            return False, e, time.monotonic() - started
+
+    def run(self):
+        """Run every stage and return {name: {'status', 'seconds', 'result', 'error'}}."""
+
+        results = {}
+        waiting = dict(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers or max(1, len(self.stages))) as executor:
+            while waiting or running:
+                for name, (operation, depends) in list(waiting.items()):
+                    if any(results.get(dependency, {}).get('status') in ('failed', 'blocked') for dependency in depends):
+                        results[name] = {'status': 'blocked', 'seconds': 0.0, 'result': None,
+                                         'error': f"dependency {', '.join(depends)} did not succeed"}
+                        Utils.log(f"Stage '{name}' not run: {results[name]['error']}.", level='warning')
+                        METRICS.set('stage_success', 0, stage=name)
+                        del waiting[name]
+                    elif all(dependency in results for dependency in depends):
+                        Utils.log(f"Stage '{name}' started.")
+                        running[executor.submit(self._timed, operation)] = name
+                        del waiting[name]
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result, error, seconds = future.result()
+
+                    if error is not None or result is False:
+                        status = 'failed'
+                    elif result is None:
+                        status = 'skipped'
+                    else:
+                        status = 'ok'
+
+                    results[name] = {'status': status, 'seconds': seconds, 'result': result,
+                                     'error': str(error) if error is not None else None}
+                    METRICS.record('stage_seconds', seconds, stage=name)
+                    METRICS.set('stage_success', int(status != 'failed'), stage=name)
+                    level = 'error' if status == 'failed' else 'info'
+                    Utils.log(f"Stage '{name}' {status} in {seconds:.1f}s." + (f" {error}" if error else ""), level=level)
+
+        return results
+
+    @staticmethod
+    def summary(results):
+        """Format one line per stage with its status and wall-clock time."""
+        return "\n".join(f"  {name:<12} {info['status']:<8} {info['seconds']:8.1f}s" for name, info in results.items())
@@ -0,0 +1,131 @@
+import gzip
+import os
+import collections
+from encryption import EXTENSION, EncryptionError
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ParallelCompressor:
+    """
+        File-like writer that compresses a stream in fixed-size blocks across a thread pool.
+
+        Like pigz, every block is compressed independently and written in order, producing a
+        multi-member gzip file (or a sequence of zstd frames) that standard tools decompress
+        as a single stream. zlib and zstandard release the GIL while compressing, so the
+        blocks really do run on several cores.
+    """
+
+    EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, fileobj, method='gzip', level=None, workers=None, block_size=4 * 1024 * 1024):
+        if method not in self.EXTENSIONS:
+            raise ValueError(f"Unsupported compression method: {method}")
+
+        self.fileobj = fileobj
+        self.method = method
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+        if method == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd compression requires the 'zstandard' package (pip install zstandard).")
+            self._zstd = zstandard
+            self.level = 3 if level is None else level
+        else:
+            self.level = 6 if level is None else level
+
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._closed = False
+
+    @classmethod
+    def extension(cls, method):
+        return cls.EXTENSIONS.get(method, '') if method else ''
+
+    def _compress(self, block):
+        if self.method == 'zstd':
+            return self._zstd.ZstdCompressor(level=self.level).compress(block)
+        return gzip.compress(block, compresslevel=self.level, mtime=0)
+
+    def _drain(self, keep):
+        """Write finished blocks in order until at most `keep` are still in flight."""
+        while len(self._pending) > keep:
+            compressed = self._pending.popleft().result()
+            self.fileobj.write(compressed)
+            self.compressed_bytes += len(compressed)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(self._compress, block))
+        # Bound memory to roughly two blocks per worker
+        self._drain(self.workers * 2)
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self._buffer += data
+
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+
+        return len(data)
+
+    def close(self):
+        """Flush the remaining data and wait for every block to reach the output file."""
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            self._drain(0)
+            self.fileobj.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def openCompressed(path, method=None, cipher=None):
+    """
+        Open a file written by ParallelCompressor (or an uncompressed one) for streaming reads.
+
+        Files ending in .enc are decrypted on the fly with cipher (an encryption.BackupCipher).
+    """
+
+    source = None
+    if path.endswith(EXTENSION):
+        if cipher is None:
+            raise EncryptionError(f"{path} is encrypted; configure the encryption key to read it.")
+        source = cipher.open(path)
+        path = path[:-len(EXTENSION)]
+
+    if method is None:
+        method = next((name for name, extension in ParallelCompressor.EXTENSIONS.items() if path.endswith(extension)), None)
+
+    if method == 'gzip':
+        if source is None:
+            # gzip reads every member of a multi-member file
+            return gzip.open(path, 'rb')
+        stream = gzip.GzipFile(fileobj=source, mode='rb')
+        stream.myfileobj = source  # Closed with the gzip reader, as when gzip opens the file itself
+        return stream
+
+    if method == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd decompression requires the 'zstandard' package (pip install zstandard).")
+        return zstandard.ZstdDecompressor().stream_reader(source or open(path, 'rb'), read_across_frames=True, closefd=True)
+
+    return source or open(path, 'rb')
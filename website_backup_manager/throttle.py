@@ -0,0 +1,239 @@
+from metrics import METRICS
+import datetime
+import re
+import shlex
+import threading
+import time
+
+
+RATE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+class ThrottleConfigError(ValueError):
+    """Raised when a rate, schedule or priority setting cannot be parsed."""
+
+
+def parseRate(value):
+    """Convert '512K', '10M', '1.5G' or a number of bytes per second to bytes per second; 0 means unlimited."""
+
+    if value is None or value == '':
+        return 0
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    match = re.match(r'^\s*([\d.]+)\s*([kKmMgG]?)(?:i?B)?(?:/s)?\s*$', str(value))
+    if match is None:
+        raise ThrottleConfigError(f"Invalid rate '{value}'; use bytes per second or a K, M or G suffix.")
+    return float(match.group(1)) * RATE_UNITS[match.group(2).lower()]
+
+
+def _minuteOfDay(text):
+    hours, minutes = text.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class Schedule:
+    """
+        Bandwidth limit that depends on the time of day.
+
+        Parsed from a comma separated list of `HH:MM-HH:MM=RATE` windows and an optional
+        plain RATE used outside every window, e.g. "08:00-20:00=2M,20M" allows 2 MB/s during
+        the day and 20 MB/s at night. Windows may cross midnight ("22:00-06:00=0").
+        A plain "10M" is a constant limit.
+    """
+
+    def __init__(self, default=0, windows=()):
+        self.default = default
+        self.windows = list(windows)  # (start minute, end minute, bytes per second)
+
+    @classmethod
+    def parse(cls, spec):
+        if isinstance(spec, Schedule):
+            return spec
+        if spec is None or isinstance(spec, (int, float)):
+            return cls(parseRate(spec))
+
+        default = 0
+        windows = []
+        for part in str(spec).split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '=' not in part:
+                default = parseRate(part)
+                continue
+
+            window, rate = part.split('=', 1)
+            match = re.match(r'^(\d{1,2}:\d{2})\s*-\s*(\d{1,2}:\d{2})$', window.strip())
+            if match is None:
+                raise ThrottleConfigError(f"Invalid schedule window '{window}'; expected HH:MM-HH:MM.")
+            windows.append((_minuteOfDay(match.group(1)), _minuteOfDay(match.group(2)), parseRate(rate)))
+
+        return cls(default, windows)
+
+    def scaled(self, factor):
+        """Return the schedule with every limit multiplied by factor, e.g. to split it between processes."""
+        return Schedule(self.default * factor, [(start, end, rate * factor) for start, end, rate in self.windows])
+
+    def rateAt(self, moment=None):
+        """Bytes per second allowed at moment (default: now), 0 for unlimited."""
+
+        moment = moment or datetime.datetime.now()
+        minute = moment.hour * 60 + moment.minute
+        for start, end, rate in self.windows:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return self.default
+
+    def __bool__(self):
+        return bool(self.default) or any(rate for _, _, rate in self.windows)
+
+
+class TokenBucket:
+    """
+        Thread-safe token bucket in bytes.
+
+        reserve(n) takes n tokens even when fewer are available and returns how long the
+        caller must wait to pay the difference back, so one large read is delayed once
+        instead of being split. Up to `burst` bytes (one second of traffic by default) can
+        be sent without waiting after an idle period.
+    """
+
+    def __init__(self, rate, burst=None):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        with self._lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, self._capacity())
+
+    def _capacity(self):
+        return self.burst if self.burst is not None else self.rate
+
+    def reserve(self, nbytes):
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self._capacity(), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Throttle:
+    """
+        Shared bandwidth limits for every transfer path of the process.
+
+        Transfers call THROTTLE.consume(host, nbytes) after each block they move (FTP
+        callbacks, SSH and SFTP channel reads, dump streams) and are slowed down to the
+        global limit and to the limit of their host, whichever is lower. Async code uses
+        reserve() and awaits the returned delay instead of sleeping. Until configure() sets
+        a limit every call returns after one attribute check, like METRICS.
+
+        Limits are Schedules, so peak-hour and off-peak rates can differ. They are
+        re-evaluated at most once a minute.
+    """
+
+    RECHECK_SECONDS = 60
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self, rate=None, per_host=None, host_rates=None, share=1, host_share=1):
+        """
+            Set the limits; rate and per_host take a Schedule, a schedule string or bytes per second.
+
+            host_rates maps host names to their own limit instead of per_host. share and
+            host_share divide the limits, for processes that each get a part of them.
+        """
+
+        with self._lock:
+            self.rate = Schedule.parse(rate).scaled(1 / max(1, share))
+            self.per_host = Schedule.parse(per_host).scaled(1 / max(1, host_share))
+            self.host_rates = {host: Schedule.parse(spec).scaled(1 / max(1, host_share))
+                               for host, spec in (host_rates or {}).items()}
+            self.bucket = TokenBucket(0)
+            self.host_buckets = {}
+            self.checked = 0
+            self.enabled = bool(self.rate or self.per_host or any(self.host_rates.values()))
+
+    def _hostSchedule(self, host):
+        return self.host_rates.get(host, self.per_host)
+
+    def _refresh(self, now):
+        self.checked = now
+        moment = datetime.datetime.now()
+        self.bucket.setRate(self.rate.rateAt(moment))
+        for host, bucket in self.host_buckets.items():
+            bucket.setRate(self._hostSchedule(host).rateAt(moment))
+
+    def reserve(self, host, nbytes):
+        """Account for nbytes moved from host and return the seconds to wait before moving more."""
+        if not self.enabled:
+            return 0.0
+
+        with self._lock:
+            bucket = self.host_buckets.get(host)
+            if bucket is None:
+                bucket = self.host_buckets[host] = TokenBucket(self._hostSchedule(host).rateAt())
+            now = time.monotonic()
+            if now - self.checked >= self.RECHECK_SECONDS:
+                self._refresh(now)
+
+        delay = max(self.bucket.reserve(nbytes), bucket.reserve(nbytes))
+        if delay:
+            METRICS.record('throttle_wait_seconds', delay, host=host)
+        return delay
+
+    def consume(self, host, nbytes):
+        """Block until nbytes more from host fit within the limits."""
+        delay = self.reserve(host, nbytes)
+        if delay:
+            time.sleep(delay)
+
+
+def priorityCommand(nice=None, ionice=None):
+    """
+        Return the `nice` / `ionice` prefix for a command as a list of arguments.
+
+        nice is the niceness (0-19). ionice is 'idle', a best-effort level 0-7, or
+        'class:level' such as 'best-effort:7'. Both are optional.
+    """
+
+    prefix = []
+    if nice not in (None, ''):
+        prefix += ['nice', '-n', str(int(nice))]
+
+    if ionice not in (None, ''):
+        spec = str(ionice).lower()
+        kind, _, level = spec.partition(':')
+        if kind.isdigit() and not level:
+            kind, level = 'best-effort', kind
+        if kind not in IONICE_CLASSES:
+            raise ThrottleConfigError(f"Invalid ionice setting '{ionice}'; use idle, best-effort:<0-7> or a level 0-7.")
+        prefix += ['ionice', '-c', str(IONICE_CLASSES[kind])]
+        if level and kind != 'idle':
+            prefix += ['-n', str(int(level))]
+
+    return prefix
+
+
+def prioritizeShell(command, nice=None, ionice=None):
+    """Prefix a shell command string (as run over SSH) with nice / ionice."""
+    prefix = priorityCommand(nice, ionice)
+    return f"{shlex.join(prefix)} {command}" if prefix else command
+
+
+# Shared limiter the transfer paths report to; configured per run by remote_backup_manager
+THROTTLE = Throttle()